@@ -1,7 +1,12 @@
 
-from waximpl import Wax, WaxError, parse_wax
+from waximpl import Wax, WaxChain, WaxError, WaxHolder, WaxPatch, WaxStruct, \
+    WaxTemplate, parse_wax
+from waxdoc import WaxDocument
+from waxschema import WaxSchema, WaxSchemaError
+from waxshm import WaxView, open_view, wax_to_view, write_view
+from waxload import WaxCancelledError, WaxLoader
+from waxwatch import WaxWatcher
 __version__ = '0.3'
 
 
 
-
@@ -3,7 +3,9 @@
 
 
 # std
+import array
 import math
+import re
 import StringIO
 
 
@@ -16,7 +18,12 @@ DIGITS = set([str(i) for i in range(0, 10)])
 NUMSTART = DIGITS.union(['.','-','+'])
 NUMCHARS = NUMSTART.union(['e','E'])
 ESC_MAP = {'n':'\n','t':'\t','r':'\r','b':'\b','f':'\f'}
-REV_ESC_MAP = dict([(_v,_k) for _k,_v in ESC_MAP.iteritems()] + [('"','"')])
+REV_ESC_MAP = dict([(_v,_k) for _k,_v in ESC_MAP.iteritems()] +
+    [('"','"'), ('\\','\\')])
+# a string holding no escapes or non-ASCII characters
+RE_PLAIN_STR = re.compile(r'"([^"\\\x80-\xff]*)"')
+# characters which the emitter must escape
+RE_NEEDS_ESC = re.compile(u'[\x00-\x1f"\\\\]|[^\x00-\x7f]')
 
 # error messages
 E_BYTES = 'input string must be type str containing ASCII or UTF-8 bytes'
@@ -46,19 +53,33 @@ class JSONStream(object):
     # expose the methods below and not allow direct access to the 
     # underlying stream.
 
+    # optional function mapping each string and integer parsed to the
+    # object to use for it, so that equal values can be shared.
+    interner = None
+
+    # if true, lists holding only integers or only floats are returned as
+    # array.array('l') or array.array('d'), storing the numbers unboxed.
+    typed_arrays = False
+
     def __init__(self, data):
-        self._stm = StringIO.StringIO(data)
+        # the data is indexed directly, which is much cheaper per character
+        # than going through StringIO's methods.
+        self._data = data
+        self._pos = 0
 
     @property
     def pos(self):
-        return self._stm.pos
+        return self._pos
 
     @property
     def len(self):
-        return self._stm.len
+        return len(self._data)
 
     def getvalue(self):
-        return self._stm.getvalue()
+        return self._data
+
+    def seek(self, pos):
+        self._pos = pos
 
     def skipspaces(self):
         "post-cond: read pointer will be over first non-WS char"
@@ -72,15 +93,16 @@ class JSONStream(object):
             self.next()
 
     def next(self, size=1):
-        return self._stm.read(size)
+        pos = self._pos
+        res = self._data[pos:pos + size]
+        self._pos = pos + len(res)
+        return res
 
     def next_ord(self):
         return ord(self.next())
 
     def peek(self):
-        if self.pos == self.len:
-            return ''
-        return self.getvalue()[self.pos]
+        return self._data[self._pos:self._pos + 1]
 
     def substr(self, pos, length):
         return self.getvalue()[pos:pos+length]
@@ -126,6 +148,13 @@ def decode_escape(c, stm):
 
 
 def _from_json_string(stm):
+    m = RE_PLAIN_STR.match(stm.getvalue(), stm.pos)
+    if m is not None:
+        # nothing to decode, so take the string as it is
+        stm.seek(m.end())
+        if stm.interner is not None:
+            return stm.interner(m.group(1))
+        return m.group(1)
     # skip over '"'
     stm.next()  
     r = []
@@ -137,6 +166,8 @@ def _from_json_string(stm):
             c = stm.next()
             r.append(decode_escape(c, stm))
         elif c == '"':
+            if stm.interner is not None:
+                return stm.interner(''.join(r))
             return ''.join(r)
         elif c > '\x7f':
             r.append(_decode_utf8(c, stm))
@@ -174,9 +205,14 @@ def _from_json_number(stm):
         stm.next() 
 
     s = stm.substr(pos, stm.pos - pos)
-    if is_float:
-        return float(s)
-    return long(s)
+    try:
+        if is_float:
+            return float(s)
+        if stm.interner is not None:
+            return stm.interner(long(s))
+        return long(s)
+    except ValueError:
+        raise JSONError(E_MALF, stm, pos)
 
 
 def _from_json_list(stm):
@@ -192,6 +228,8 @@ def _from_json_list(stm):
 
         elif c == ']':
             stm.next()
+            if stm.typed_arrays and result:
+                return _typed_array(result)
             return result
 
         elif c == ',':
@@ -208,6 +246,25 @@ def _from_json_list(stm):
             raise JSONError(E_MALF, stm, stm.pos)
 
 
+def _typed_array(lst):
+    '''
+    Return 'lst' as an array if its items are all integers which fit in a
+    C long or all floats, otherwise return it unchanged.
+    '''
+    kinds = set(map(type, lst))
+    if len(kinds) != 1:
+        return lst
+    kind = kinds.pop()
+    if kind is float:
+        return array.array('d', lst)
+    if kind is long:
+        try:
+            return array.array('l', lst)
+        except OverflowError:
+            pass
+    return lst
+
+
 def _from_json_dict(stm):
     # skip over '{'
     stm.next()
@@ -270,17 +327,19 @@ def _from_json_raw(stm):
         raise JSONError(E_MALF, stm, stm.pos)
 
 
-def from_json(data):
+def from_json(data, typed_arrays=False):
     '''
     Converts 'data' which is UTF-8 (or the 7-bit pure ASCII subset) into
     a Python representation.  You must pass bytes to this in a str type,
-    not unicode.
+    not unicode.  If 'typed_arrays' is true, lists of only integers or only
+    floats are returned as array.array instances.
     '''
     if not isinstance(data, str):
         raise JSONError(E_BYTES)
     if not data:
         return None
     stm = JSONStream(data)
+    stm.typed_arrays = typed_arrays
     return _from_json_raw(stm)
 
 
@@ -288,20 +347,26 @@ class JsonEmitter(object):
 
     '''
     Wraps a stream-like object and writes the JSON representation of
-    an object to the stream.
+    an object to the stream.  If 'canonical' is true, dict keys are written
+    in sorted order and floats are written in full with repr(), so equal
+    objects always produce the same output.
     '''
 
-    def __init__(self, stm):
+    def __init__(self, stm, canonical=False):
         self._stm = stm
+        self._canonical = canonical
 
     def _to_json_string(self, buf):
         stm = self._stm
+        if not RE_NEEDS_ESC.search(buf):
+            stm.write('"%s"' % str(buf))
+            return
         stm.write('"')
         for c in buf:
             nc = REV_ESC_MAP.get(c, None)
             if nc:
                 stm.write('\\' + nc)
-            elif ord(c) <= 0x7F:
+            elif 0x1F < ord(c) <= 0x7F:
                 # force ascii
                 stm.write(str(c))
             else:
@@ -320,19 +385,24 @@ class JsonEmitter(object):
     def _to_json_dict(self, dct):
         stm = self._stm
         stm.write('{')
-        for i, key in enumerate(dct.iterkeys()):
+        keys = getattr(dct, 'iterkeys', dct.keys)
+        if self._canonical:
+            keys = _sorted_keys(dct)
+        else:
+            keys = ((key, key) for key in keys())
+        for i, (key, name) in enumerate(keys):
             if i:
                 stm.write(',')
             val = dct[key]
-            if not isinstance(key, (str, unicode)):
-                key = str(key)
-            self._to_json_string(key)
+            if not isinstance(name, (str, unicode)):
+                name = str(name)
+            self._to_json_string(name)
             stm.write(':')
             self.emit(val)
         stm.write('}')
 
     def emit(self, obj):
-        if isinstance(obj, (list, tuple)):
+        if isinstance(obj, (list, tuple, array.array)):
             self._to_json_list(obj)
         elif isinstance(obj, bool):
             if obj:
@@ -342,7 +412,10 @@ class JsonEmitter(object):
         elif isinstance(obj, float):
             if math.isnan(obj) or math.isinf(obj):
                 raise JSONError(E_BADFLOAT % obj)
-            self._stm.write("%s" % obj)
+            if self._canonical:
+                self._stm.write(repr(obj))
+            else:
+                self._stm.write("%s" % obj)
         elif isinstance(obj, (int, long)):
             self._stm.write("%d" % obj)
         elif obj is None:
@@ -360,15 +433,28 @@ class JsonEmitter(object):
             raise JSONError(E_UNSUPP % type(obj))
 
 
-def to_json(obj):
+def to_json(obj, canonical=False):
     '''
-    Converts 'obj' to an ASCII JSON string representation.
+    Converts 'obj' to an ASCII JSON string representation.  See JsonEmitter
+    for 'canonical'.
     '''
     stm = StringIO.StringIO('')
-    JsonEmitter(stm).emit(obj)
+    JsonEmitter(stm, canonical).emit(obj)
     return stm.getvalue()
 
 
+def _sorted_keys(dct):
+    "Return the (key, name) pairs of 'dct' sorted by the name written."
+    keys = []
+    for key in dct.keys():
+        name = key
+        if not isinstance(name, (str, unicode)):
+            name = str(name)
+        keys.append((name, key))
+    keys.sort()
+    return [(key, name) for name, key in keys]
+
+
 decode = from_json
 encode = to_json
 
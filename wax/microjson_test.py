@@ -1,5 +1,6 @@
 
 # std
+import array
 import sys
 import unittest
 
@@ -111,6 +112,9 @@ T_PARSE_MALFORMED = [
     '{"abc":',      # truncated dict with missing value
     '{',            # truncated dict
     '{,}',          # dict with empty slots
+    '1E',           # exponent missing digits
+    '[1.5e+]',      # signed exponent missing digits
+    '-',            # sign without digits
     u'[]',          # input must be a str
     ]
 
@@ -172,6 +176,10 @@ T_EMIT_VALID = [
     # non-string keys are cast to str
     ({1: 2}, '{"1":2}'),
 
+    # characters which need no escaping
+    ("plain \\ /text~", '"plain \\\\ /text~"'),
+    (u"plain", '"plain"'),
+
     ]
 
 T_EMIT_INVALID = [
@@ -212,12 +220,52 @@ class TestMicrojsonEmit(unittest.TestCase):
             pass
         self.assertRaises(microjson.JSONError, microjson.encode, NObj())
 
+    def test_mapping_object(self):
+        class Mapping(object):
+            def keys(self):
+                return ['a', 'b']
+            def __getitem__(self, key):
+                return key.upper()
+        self.assertEquals(microjson.to_json(Mapping()), '{"a":"A","b":"B"}')
+
+    def test_typed_arrays(self):
+        data = '{"i": [1, -2, 3], "f": [0.5, 1e+21], "m": [1, 2.5], ' \
+            '"b": [true, false], "big": [1, 18446744073709551616], ' \
+            '"e": [], "n": [[1, 2], ["x"]]}'
+        res = microjson.from_json(data, typed_arrays=True)
+        self.assertEquals(res['i'], array.array('l', [1, -2, 3]))
+        self.assertEquals(res['f'], array.array('d', [0.5, 1e21]))
+        self.assertEquals(res['n'][0], array.array('l', [1, 2]))
+        for key in ('m', 'b', 'big', 'e'):
+            self.assertEquals(type(res[key]), list)
+        self.assertEquals(microjson.to_json(res['i']), '[1,-2,3]')
+        self.assertEquals(microjson.to_json(res['f']),
+            microjson.to_json([0.5, 1e21]))
+        self.assertEquals(str(buffer(res['i'])), res['i'].tostring())
+
+    def test_canonical(self):
+        lt = {'b': [0.1 + 0.2, {'y': 1L, 'x': None}], 'a': 1.0, 3: u'\u00e9'}
+        rt = {3: u'\u00e9', 'a': 1.0, 'b': [0.1 + 0.2, {'x': None, 'y': 1}]}
+        res = microjson.to_json(lt, canonical=True)
+        self.assertEquals(res, '{"3":"\\u00e9","a":1.0,'
+            '"b":[0.30000000000000004,{"x":null,"y":1}]}')
+        self.assertEquals(microjson.to_json(rt, canonical=True), res)
+        self.assertEquals(microjson.from_json(res)['b'][0], 0.1 + 0.2)
+
     def test_unsupported_object(self):
         class Bag:
             pass
         obj = Bag()
         self.assertRaises(microjson.JSONError, microjson.to_json, obj)
 
+    def test_escapes(self):
+        for py in ('a\\b', '\\', '\\"', 'q"\\n', '\x00\x1f\x7f',
+                u'\u2018c:\\dir\u2019'):
+            js = microjson.to_json(py)
+            self.assertEquals(microjson.from_json(js), py)
+        self.assertEquals(microjson.to_json('a\\"b'), r'"a\\\"b"')
+        self.assertEquals(microjson.to_json('\x01'), r'"\u0001"')
+
 
 def main():
     unittest.main()
@@ -0,0 +1,433 @@
+
+# waxdoc - incremental parsing of Wax documents being edited.
+#
+# Author: Patrick Hensley <spaceboy@indirect.com>
+
+
+# std
+import bisect
+
+# local
+import microjson
+from waximpl import E_NOTSTR, E_SELECT, Wax, WaxError, WaxPatch, \
+    WaxStream, parse_wax_raw, validate_key
+from waxwatch import _parse_section, _prefix, _replace, _splice
+
+
+__all__ = ["WaxDocument"]
+
+
+E_NOKEY = "key '%s' is not assigned in the document"
+E_NOPATH = "no file to save the document to"
+E_NOSECTION = "group '%s' is not declared in the document"
+E_NOTVALUE = "key '%s' is a group. only values can be set or deleted"
+E_RANGE = "edit range %d:%d is outside the document"
+
+
+class WaxDocument(object):
+
+    '''
+    The text of a Wax document being edited, and the tree parsed from it.
+
+    The text is split into sections, one per group declaration, and the
+    offset at which each starts is kept.  edit() parses again only the
+    sections an edit touches, and replaces the groups they declare in a
+    copy of the tree which shares every other group with the previous one,
+    so editing a large document stays fast.  Edits which add, remove or
+    rename group declarations, move an annotation from one section to the
+    next, or set keys of other groups using dotted names, parse the whole
+    text.
+
+    'text' is the current text and 'wax' the current tree.  Treat trees as
+    read-only, since unchanged groups are shared between them.  Text which
+    does not parse is expected while typing, so edit() does not raise:
+    'error' holds the WaxError of the first section which failed, and the
+    tree keeps that section's last contents which parsed until it is
+    fixed.
+
+    set() and delete() change a key by patching the text of its assignment,
+    so comments, layout and the rest of the document are kept as written,
+    and save() writes back only the part of the file which changed.
+    '''
+
+    def __init__(self, text=''):
+        self.text = text
+        self.wax = None
+        self.error = None
+        self.path = None
+        # the length of the text in the file at 'path', and the (start, end)
+        # of the text changed since it was written, see save()
+        self._saved = None
+        self._dirty = None
+        self._load()
+
+    @classmethod
+    def open(cls, path):
+        "Read the document in the file at 'path', which save() writes to."
+        f = open(path, 'rb')
+        try:
+            doc = cls(f.read())
+        finally:
+            f.close()
+        doc.path = path
+        doc._saved = len(doc.text)
+        return doc
+
+    def edit(self, start, end, text):
+        '''
+        Replace the text from offset 'start' up to 'end' with 'text', update
+        the tree and return the WaxPatch from the previous tree.
+        '''
+        if not isinstance(text, str):
+            raise WaxError(E_NOTSTR)
+        old = self.text
+        if not 0 <= start <= end <= len(old):
+            raise WaxError(E_RANGE % (start, end))
+        data = self.text = old[:start] + text + old[end:]
+        self._mark(start, end, len(text))
+        if self._broken:
+            return self._reload()
+
+        # the sections holding the edit, and the one before it if the edit
+        # starts a section, since text inserted there ends the previous one
+        starts = self._starts
+        sections = self._sections
+        first = bisect.bisect_right(starts, start) - 1
+        if first and starts[first] == start:
+            first -= 1
+        last = bisect.bisect_right(starts, end) - 1
+        delta = len(text) - (end - start)
+        if last + 1 < len(starts):
+            stop = starts[last + 1]
+        else:
+            stop = len(old)
+        region = data[starts[first]:stop + delta]
+        if stop < len(old) and _open_line(region):
+            return self._reload()
+
+        prev = sections[first:last + 1]
+        try:
+            decls = _parse(region)[1]
+        except WaxError, exc:
+            if first != last:
+                return self._reload()
+            # keep the section as it was until the error is fixed
+            if first not in self._stale:
+                self._stale[first] = (prev[0][1], exc)
+            else:
+                self._stale[first] = (self._stale[first][0], exc)
+            sections[first] = (prev[0][0], region)
+            self._shift(last + 1, delta)
+            self._set_error()
+            return WaxPatch()
+        bounds = [offset for offset, group in decls]
+        groups = [group for offset, group in decls]
+        if not first:
+            bounds.insert(0, 0)
+            groups.insert(0, '')
+        if bounds[:1] != [0] or \
+                groups != [group for group, body in prev]:
+            return self._reload()
+        bounds.append(len(region))
+        for i in xrange(len(prev)):
+            sections[first + i] = (groups[i], region[bounds[i]:bounds[i + 1]])
+            starts[first + i] = starts[first] + bounds[i]
+        self._shift(last + 1, delta)
+
+        top = self.wax
+        copied = {}
+        ops = []
+        for i in xrange(first, last + 1):
+            group, body = sections[i]
+            applied = prev[i - first][1]
+            if i in self._stale:
+                applied = self._stale.pop(i)[0]
+            elif body == applied:
+                continue
+            if self._counts[group] != 1:
+                return self._reload()
+            curr = _parse_section(group, body)
+            before = self._parsed.get(i) or _parse_section(group, applied)
+            if curr is None or before is None:
+                return self._reload()
+            node = top._select_group(group)
+            spliced = _splice(node, before, curr)
+            if spliced is None:
+                return self._reload()
+            ops.extend(_prefix(group, node._diff(spliced)))
+            top = _replace(top, group, spliced, copied)
+            self._parsed[i] = curr
+        self.wax = top
+        self._set_error()
+        return WaxPatch(ops)
+
+    def span(self, group=''):
+        '''
+        Return the (start, end) offsets of the section declaring the dotted
+        'group', or of the text before the first declaration for ''.
+        '''
+        i = self._index.get(group)
+        if i is None:
+            raise WaxError(E_NOSECTION % group)
+        start = self._starts[i]
+        return start, start + len(self._sections[i][1])
+
+    def set(self, path, value):
+        '''
+        Set the dotted key 'path' to 'value' by replacing the text of its
+        last assignment, leaving the rest of the document as written.  A new
+        key is added after the last assignment in its group's section, and a
+        group with no section is declared at the end.  Returns the WaxPatch
+        from edit().
+        '''
+        if isinstance(value, Wax):
+            raise WaxError(E_NOTVALUE % path)
+        parts = path.split('.')
+        for part in parts:
+            validate_key(part)
+        self._check(path)
+        data = microjson.to_json(value)
+        found = self._assignments(path)
+        if found:
+            start, end = found[-1][1:]
+            return self.edit(start, end, data)
+
+        group = '.'.join(parts[:-1])
+        line = '%s = %s\n' % (parts[-1], data)
+        if group and not isinstance(self.wax.get(group), Wax):
+            # a new group, which must not go through a value
+            node = self.wax
+            for part in parts[:-1]:
+                if part not in node:
+                    break
+                node = node[part]
+                if not isinstance(node, Wax):
+                    raise WaxError(E_SELECT % path)
+        sections = self._declaring(group)
+        if not sections:
+            pos = len(self.text)
+            prefix = '\n'
+            if not self.text.endswith('\n'):
+                prefix = '\n\n'
+            return self.edit(pos, pos, '%s[%s]\n%s' % (prefix, group, line))
+
+        # after the line of the section's last assignment, or its header
+        index = sections[-1]
+        body = self._sections[index][1]
+        assigned = _assignments(body)
+        if assigned:
+            pos = assigned[-1][3]
+        elif index:
+            pos = body.index(']')
+        else:
+            return self.edit(0, 0, line)
+        pos = body.find('\n', pos) + 1
+        if not pos:
+            pos = len(body)
+            line = '\n' + line
+        pos += self._starts[index]
+        return self.edit(pos, pos, line)
+
+    def delete(self, path):
+        '''
+        Remove every assignment of the dotted key 'path' from the text,
+        along with the lines they leave empty and the annotation above them.
+        Returns the WaxPatch from the edits.
+        '''
+        self._check(path)
+        found = self._assignments(path)
+        if not found:
+            raise WaxError(E_NOKEY % path)
+        ops = []
+        for start, vstart, end in reversed(found):
+            text = self.text
+            # the whole line if nothing else is on it
+            lo = text.rfind('\n', 0, start) + 1
+            hi = text.find('\n', end)
+            if hi < 0:
+                hi = len(text)
+            if text[lo:start].strip() or text[end:hi].strip():
+                lo = start
+                hi = end
+            else:
+                while lo:
+                    prev = text.rfind('\n', 0, lo - 1) + 1
+                    if not text[prev:lo].lstrip().startswith(';'):
+                        break
+                    lo = prev
+                hi = min(hi + 1, len(text))
+            ops.extend(self.edit(lo, hi, ''))
+        return WaxPatch(ops)
+
+    def save(self, path=None):
+        '''
+        Write the text to the file at 'path', by default the one it was read
+        from or last saved to, and return the number of bytes written.
+        Saving to the same file writes only the text from the first change
+        since it was last written: up to the last change if the length is
+        the same, or to the end if not.  The file is changed in place, so
+        it must not be changed by others in between, and a reader may see it
+        partly written.
+        '''
+        if path is None:
+            path = self.path
+        if path is None:
+            raise WaxError(E_NOPATH)
+        text = self.text
+        if path != self.path or self._saved is None:
+            f = open(path, 'wb')
+            start = 0
+            end = len(text)
+        elif self._dirty is None:
+            return 0
+        else:
+            f = open(path, 'r+b')
+            start, end = self._dirty
+            if len(text) != self._saved:
+                end = len(text)
+        try:
+            f.seek(start)
+            f.write(text[start:end])
+            if len(text) != self._saved:
+                f.truncate()
+        finally:
+            f.close()
+        self.path = path
+        self._saved = len(text)
+        self._dirty = None
+        return end - start
+
+    def _check(self, path):
+        "Raise if the text does not parse, or 'path' is a group."
+        if self._broken or self._stale:
+            raise self.error
+        if isinstance(self.wax.get(path), Wax):
+            raise WaxError(E_NOTVALUE % path)
+
+    def _declaring(self, group):
+        "Return the index of each section declaring 'group'."
+        i = self._index.get(group)
+        if i is None:
+            return []
+        if self._counts[group] == 1:
+            return [i]
+        sections = self._sections
+        return [j for j in xrange(i, len(sections)) if sections[j][0] == group]
+
+    def _assignments(self, path):
+        '''
+        Return the (start, value start, value end) offsets of each
+        assignment of the dotted key 'path', in the order they appear.
+        '''
+        parts = path.split('.')
+        found = []
+        for i in xrange(len(parts)):
+            group = '.'.join(parts[:i])
+            key = '.'.join(parts[i:])
+            for index in self._declaring(group):
+                base = self._starts[index]
+                for name, start, vstart, vend in \
+                        _assignments(self._sections[index][1]):
+                    if name == key:
+                        found.append((base + start, base + vstart,
+                            base + vend))
+        found.sort()
+        return found
+
+    def _mark(self, start, end, size):
+        '''
+        Extend the range of text changed since the last save to cover the
+        edit of 'start' up to 'end' with 'size' characters.
+        '''
+        hi = start + size
+        if self._dirty is not None:
+            lo, prev = self._dirty
+            # text after the edit moves with it
+            if prev >= end:
+                hi = prev + size - (end - start)
+            start = min(lo, start)
+        self._dirty = (start, hi)
+
+    def _load(self):
+        '''
+        Parse all of the text, replacing the tree and the sections.  If it
+        does not parse, the tree is kept and every edit parses it again
+        until one succeeds.
+        '''
+        text = self.text
+        try:
+            self.wax, decls = _parse(text)
+        except WaxError, exc:
+            if self.wax is None:
+                raise
+            self.error = exc
+            self._broken = True
+            return
+        self.error = None
+        self._broken = False
+        self._starts = [0] + [offset for offset, group in decls]
+        groups = [''] + [group for offset, group in decls]
+        bounds = self._starts + [len(text)]
+        self._sections = []
+        self._index = {}
+        self._counts = {}
+        for i, group in enumerate(groups):
+            self._sections.append((group, text[bounds[i]:bounds[i + 1]]))
+            self._index.setdefault(group, i)
+            self._counts[group] = self._counts.get(group, 0) + 1
+        # parsed sections, and sections which failed with the text the tree
+        # still holds, by index
+        self._parsed = {}
+        self._stale = {}
+
+    def _reload(self):
+        "Parse all of the text and return the WaxPatch from the old tree."
+        old = self.wax
+        self._load()
+        return old._diff(self.wax)
+
+    def _shift(self, index, delta):
+        "Move the sections from 'index' on by 'delta' characters."
+        starts = self._starts
+        for i in xrange(index, len(starts)):
+            starts[i] += delta
+
+    def _set_error(self):
+        self.error = None
+        if self._stale:
+            self.error = self._stale[min(self._stale)][1]
+
+
+# Implementation details are below.  You shouldn't need these for
+# typical uses of WaxDocument.
+
+
+def _parse(text):
+    '''
+    Parse 'text', returning the tree and the (offset, group) of each group
+    declaration in it.
+    '''
+    stm = WaxStream(text)
+    stm.declarations = []
+    return parse_wax_raw(stm, Wax()), stm.declarations
+
+
+def _assignments(text):
+    '''
+    Parse 'text', returning the (key, start, value start, value end) of each
+    key assignment in it.
+    '''
+    stm = WaxStream(text)
+    stm.assignments = []
+    parse_wax_raw(stm, Wax())
+    return stm.assignments
+
+
+def _open_line(text):
+    '''
+    Return whether the last line of 'text' may run on into the text after
+    it: a comment, an annotation or a group declaration without its line
+    end swallows the rest of the line.
+    '''
+    tail = text[text.rfind('\n') + 1:]
+    return '#' in tail or ';' in tail or '[' in tail
@@ -0,0 +1,237 @@
+
+# waxdoc module unit tests.
+#
+# Author: Patrick Hensley <spaceboy@indirect.com>
+
+
+# std
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+# local
+from waximpl import parse_wax, Wax, WaxError
+from waxdoc import WaxDocument
+
+
+SAMPLE = """
+# top-level settings
+name = "sample"
+
+; the listening socket
+[server]
+address = "0.0.0.0"
+port = 8080
+# trailing server comment
+
+[logger.console]
+impl = "CONSOLE"
+levels = [
+  ["DEBUG", 1]
+]
+
+[logger]
+; log everything
+level = "ALL"
+
+[logger.file]
+impl = "FILE"
+level = "ERROR"
+"""
+
+
+class TestWaxDocument(unittest.TestCase):
+
+    def _check(self, doc):
+        "assert the tree is the same as parsing the text from scratch"
+        exp = parse_wax(doc.text)
+        self.assertEquals(doc.error, None)
+        self.assertEquals(doc.wax, exp)
+        self.assertEquals(str(doc.wax), str(exp))
+        self.assertEquals(doc.wax._fingerprint(True, True),
+            exp._fingerprint(True, True))
+
+    def _replace(self, doc, old, new):
+        start = doc.text.index(old)
+        return doc.edit(start, start + len(old), new)
+
+    def test_edit(self):
+        doc = WaxDocument(SAMPLE)
+        self._check(doc)
+        old = doc.wax
+        patch = self._replace(doc, '8080', '9090\nbacklog = 5')
+        self._check(doc)
+        self.assertEquals(patch.paths(),
+            ['server.port', 'server.backlog', 'server'])
+        self.assertEquals(old.server.port, 8080)
+        # unchanged groups are shared by both trees
+        self.assert_(doc.wax.logger is old.logger)
+        self.assert_(doc.wax.server is not old.server)
+
+        # a value spanning several lines, typed one character at a time
+        pos = doc.text.index('1]\n]') + 1
+        for c in ', 2':
+            doc.edit(pos, pos, c)
+            pos += 1
+        self._check(doc)
+        self.assertEquals(doc.wax.logger.console.levels, [['DEBUG', 1, 2]])
+        self.assert_(doc.wax.logger.file is old.logger.file)
+
+        # offsets of the sections follow the edits
+        start, end = doc.span('logger.file')
+        self.assertEquals(doc.text[start:end],
+            '[logger.file]\nimpl = "FILE"\nlevel = "ERROR"\n')
+        self.assertEquals(doc.span()[0], 0)
+        self.assertRaises(WaxError, doc.span, 'missing')
+        self.assertRaises(WaxError, doc.edit, 0, len(doc.text) + 1, '')
+
+    def test_structure(self):
+        doc = WaxDocument(SAMPLE)
+        cases = [
+            # new group
+            ('[logger.file]', '[extra]\nkey = 1\n[logger.file]'),
+            # renamed group
+            ('[server]', '[service]'),
+            # annotation of the following group
+            ('level = "ALL"\n', 'level = "ALL"\n; noted\n'),
+            # dotted key setting another group's key
+            ('port = 8080', 'port = 8080\nlimits.max = 3'),
+            # group declared after a value on the same line
+            ('port = 8080', 'port = 8080 [logger]'),
+            ]
+        for old, new in cases:
+            self._replace(doc, old, new)
+            self._check(doc)
+            self._replace(doc, new, old)
+            self._check(doc)
+            self.assertEquals(doc.text, SAMPLE)
+
+    def test_errors(self):
+        doc = WaxDocument(SAMPLE)
+        old = doc.wax
+        # an unfinished value keeps the last tree which parsed
+        patch = self._replace(doc, '"ERROR"', '"ERR')
+        self.assertEquals(len(patch), 0)
+        self.assert_(isinstance(doc.error, WaxError))
+        self.assert_(doc.wax is old)
+        # other sections are still updated
+        self._replace(doc, '8080', '1')
+        self.assertEquals(doc.wax.server.port, 1)
+        self.assertEquals(doc.wax.logger.file.level, 'ERROR')
+        self._replace(doc, '"ERR', '"WARN"')
+        self._check(doc)
+        self.assertEquals(doc.wax.logger.file.level, 'WARN')
+
+        # a broken group declaration parses in full until it is fixed
+        self._replace(doc, '[logger]\n', '[logger\n')
+        self.assert_(isinstance(doc.error, WaxError))
+        self._replace(doc, '[logger\n', '[logger]\n')
+        self._check(doc)
+        self.assertRaises(WaxError, WaxDocument, '[bad')
+
+    def test_set(self):
+        doc = WaxDocument(SAMPLE + 'limits.max = 3\n')
+        patch = doc.set('server.port', 9090)
+        self._check(doc)
+        self.assertEquals(patch.ops, [('change', 'server.port', 8080, 9090)])
+        # only the value is replaced
+        self.assertEquals(doc.text,
+            SAMPLE.replace('8080', '9090') + 'limits.max = 3\n')
+
+        doc.set('logger.file.limits.max', [1, 2])
+        doc.set('logger.console.levels', {'INFO': 2})
+        doc.set('server.backlog', 5)
+        doc.set('logger.file.color', True)
+        doc.set('top', u'\u00e9')
+        doc.set('queue.size', None)
+        self._check(doc)
+        self.assertEquals(doc.wax.logger.file.limits.max, [1, 2])
+        self.assertEquals(doc.wax.queue.size, None)
+        lines = doc.text.splitlines()
+        self.assertEquals(lines[:4],
+            ['', '# top-level settings', 'name = "sample"', 'top = "\\u00e9"'])
+        self.assert_('port = 9090\nbacklog = 5\n# trailing' in doc.text)
+        self.assert_('levels = {"INFO":2}\n\n[logger]' in doc.text)
+        self.assert_(doc.text.endswith(
+            'color = true\n\n[queue]\nsize = null\n'))
+
+        self.assertRaises(WaxError, doc.set, 'logger', 1)
+        self.assertRaises(WaxError, doc.set, 'name', Wax())
+        self.assertRaises(WaxError, doc.set, 'name.x.y', 1)
+        self.assertRaises(WaxError, doc.set, 'bad key', 1)
+        self._replace(doc, '"FILE"', '"FI')
+        self.assertRaises(WaxError, doc.set, 'name', 'x')
+
+    def test_delete(self):
+        doc = WaxDocument(SAMPLE + 'limits.max = 3\n[server]\nport = 1\n')
+        patch = doc.delete('server.port')
+        self._check(doc)
+        self.assertEquals(patch.ops[:2], [('change', 'server.port', 1, 8080),
+            ('remove', 'server.port')])
+        # the annotation goes with the key
+        doc.delete('logger.level')
+        doc.delete('logger.file.limits.max')
+        self._check(doc)
+        self.assertEquals(doc.text, SAMPLE.replace('port = 8080\n', '')
+            .replace('; log everything\nlevel = "ALL"\n', '') + '[server]\n')
+        doc = WaxDocument('a = 1 b = 2\n')
+        doc.delete('b')
+        self.assertEquals(doc.text, 'a = 1 \n')
+        self.assertRaises(WaxError, doc.delete, 'b')
+        self.assertRaises(WaxError, doc.delete, 'logger')
+
+    def test_save(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'sample.wax')
+            doc = WaxDocument(SAMPLE)
+            self.assertRaises(WaxError, doc.save)
+            self.assertEquals(doc.save(path), len(SAMPLE))
+            self.assertEquals(doc.save(), 0)
+            doc = WaxDocument.open(path)
+            self.assertEquals(doc.wax, parse_wax(SAMPLE))
+
+            # same length, so only the changed range is written
+            doc.set('server.port', 9090)
+            doc.set('logger.file.level', 'WARNS')
+            self.assertEquals(doc.save(),
+                doc.text.index('WARNS') + 6 - doc.text.index('9090'))
+            self.assertEquals(open(path).read(), doc.text)
+            doc.set('logger.file.level', 'ALL')
+            doc.set('server.port', 1)
+            self.assertEquals(doc.save(),
+                len(doc.text) - doc.text.index('port = 1') - 7)
+            self.assertEquals(open(path).read(), doc.text)
+            doc.delete('name')
+            doc.save()
+            self.assertEquals(open(path).read(), doc.text)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_random(self):
+        pieces = ['x', '1', ' ', '\n', '"', '= ', 'key = 2\n', '[server]\n',
+            '# c\n', '; a\n', '[new]\n', 'a.b = 3\n', ']', '[']
+        rnd = random.Random(7)
+        for trial in range(20):
+            doc = WaxDocument(SAMPLE)
+            for step in range(20):
+                old = doc.wax
+                size = len(doc.text)
+                start = rnd.randint(0, size)
+                end = min(size, start + rnd.choice([0, 1, 2, 5]))
+                patch = doc.edit(start, end, rnd.choice(pieces))
+                if doc.error is None:
+                    self._check(doc)
+                    tmp = Wax(old)
+                    tmp._apply(patch)
+                    self.assertEquals(tmp, doc.wax)
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == "__main__":
+    main()
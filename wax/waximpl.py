@@ -5,17 +5,23 @@
 
 
 # std
+import array
+import fnmatch
+import hashlib
 import re
 import string
 import sys
+import threading
 import traceback
 import UserDict
+import weakref
 
 # local
 import microjson
 
 
-__all__ = ["Wax", "WaxError", "parse_wax", "wax_to_dict"]
+__all__ = ["Wax", "WaxChain", "WaxError", "WaxHolder", "WaxPatch",
+    "WaxStruct", "WaxTemplate", "parse_wax", "wax_to_dict"]
 
 
 # Pychecker suppressions:
@@ -29,6 +35,22 @@ KEYSTART = set(CHARS)
 KEYVALID = set('_0123456789').union(KEYSTART)
 GRPVALID = set('.').union(KEYVALID)
 RE_KEYVALID = re.compile('^[%s][%s0-9\_]*$' % (CHARS, CHARS), re.M)
+RE_REFERENCE = re.compile(r'\$(?:\{([^}]*)\}|\$)')
+# whitespace, as skipped by WaxStream.skipspaces()
+RE_SPACES = re.compile(r'[ \t\r\n\b\f]*')
+# a dotted key up to its '=', allowing whitespace as parse_keyval does
+RE_KEYVAL = re.compile(r'[\w. \t\r\n\b\f]*=')
+# a dotted group name up to its ']'
+RE_GROUP = re.compile(r'[\w.]*\]')
+# the next bracket in a JSON value which is not inside a string, or the
+# start of an unterminated string
+RE_NESTING = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*'
+    r'([\[\]{}"]?)')
+RE_FORMAT = re.compile(r'%(?:\(([^)]*)\))?([#0 +-]*\d*(?:\.\d+)?[hlL]?'
+    r'[diouxXeEfFgGcrs%])')
+
+# How Wax.merge_all() combines lists
+LIST_POLICIES = ('replace', 'append', 'unique')
 
 # Illegal key names, you cannot use these as attributes on Wax instances
 BAD_KEY_NAMES = set(['and','as','assert','break','class','continue','def',
@@ -37,10 +59,18 @@ BAD_KEY_NAMES = set(['and','as','assert','break','class','continue','def',
     'raise','return','try','while','with','yield'])
 
 E_BADKEY = "key '%s' contains illegal characters."
+E_CYCLE = "reference cycle while interpolating key '%s'"
 E_DIFFTYPE = "attempt to overwrite key/val (%s=%s) with incompatible type %s"
 E_DOTSET = "attempt to %s key %s. cannot set/delete keys containing dots."
+E_FORMAT = "invalid template format '%s'"
+E_FROZEN = "cannot change a read-only instance"
 E_GROUP = "invalid group declaration '%s'"
+E_NOCHAIN = "Wax only knows how to chain Wax instances, not %s"
 E_NOCOPY = "Wax only knows how to copy Wax instances, not %s"
+E_NODIFF = "Wax only knows how to diff Wax instances, not %s"
+E_PATCH = "malformed patch operation %s"
+E_POLICY = "unknown list policy '%s'"
+E_PATTERN = "invalid key pattern '%s'"
 E_DOTKEY = "found key '%s' with a dot. only groups can contain dots."
 E_JSON = "bad JSON data"
 E_KEYNAME = "key name '%s' is illegal"
@@ -48,6 +78,8 @@ E_KEYTYPE = "key '%s' is illegal type '%s'. must be a str()"
 E_MALF = "malformed"
 E_NONTEXT = "cannot add %s value %s: must be text."
 E_NOTSTR = "input must be of type 'str'"
+E_READONLY = "cannot set key '%s' of a read-only view"
+E_REFERENCE = "reference '%s' in key '%s' does not exist"
 E_REWRITE = "attempt to rewrite value for key %s"
 E_SELECT = "group '%s' path goes through a non-Wax / non-dict type"
 E_TRUNC = "truncated input"
@@ -60,9 +92,24 @@ class Wax(object):
     frequent access to a large number of nested runtime attributes.  Values are
     rich types, defined using JSON syntax. 
 
+    Like namedtuple, methods other than get() and keys() start with '_' so
+    they cannot clash with key names.
+
     See docs/wax.txt for details.
     '''
 
+    # Optional per-instance state. These class-level defaults keep plain
+    # instances small; the instance attribute is only created when needed.
+    _fp_cache = None
+    _interp = None
+    _parents = None
+    _watchers = None
+    # true if this instance or one of its ancestors has watchers, see
+    # _set_watched().  while false, changes are not propagated upwards.
+    # it may stay true after the instance is removed from a watched tree,
+    # which only costs a short walk in _notify().
+    _watched = False
+
     def __init__(self, *n, **kv):
         self._key_order = []
         self._annotations = {}
@@ -93,6 +140,296 @@ class Wax(object):
             else:
                 dest[key] = val
 
+    @classmethod
+    def from_items(cls, items, intern_values=False):
+        '''
+        Build a new instance from an iterable of (dotted key, value) pairs,
+        keeping their order.  This is much faster than setting each key in
+        turn: each distinct key name is validated and interned once, and
+        groups are created directly rather than through __setattr__.
+        See parse_wax() for 'intern_values', which applies to string and
+        integer values but not to the contents of lists and dicts.  Wax
+        values are copied, so later pairs setting keys below them leave the
+        caller's instances unchanged.
+        '''
+        top = cls()
+        names = {}
+        groups = {}
+        shared = _value_interner(intern_values)
+
+        def _name(part):
+            res = names.get(part)
+            if res is None:
+                validate_key(part)
+                res = names[part] = intern(part)
+            return res
+
+        for path, val in items:
+            if not isinstance(path, str):
+                raise WaxError(E_KEYTYPE % (path, type(path)))
+            node = top
+            key = path
+            if '.' in path:
+                group, key = path.rsplit('.', 1)
+                node = groups.get(group)
+                if node is None:
+                    node = top
+                    for part in group.split('.'):
+                        part = _name(part)
+                        d = node.__dict__
+                        child = d.get(part)
+                        if child is None and part not in d:
+                            child = d[part] = Wax()
+                            node._key_order.append(part)
+                            node._link(part, child)
+                        elif not isinstance(child, Wax):
+                            raise WaxError(E_SELECT % path)
+                        node = child
+                    groups[group] = node
+            key = names.get(key) or _name(key)
+            if shared is not None and isinstance(val, _INTERN_TYPES):
+                val = shared(val)
+            elif isinstance(val, Wax):
+                val = Wax(val)
+            d = node.__dict__
+            old = d.get(key)
+            if old is None and key not in d:
+                node._key_order.append(key)
+            elif isinstance(old, Wax):
+                # a group was replaced, so forget the groups below it
+                groups.clear()
+            d[key] = val
+            if isinstance(val, Wax):
+                node._link(key, val)
+        return top
+
+    @classmethod
+    def merge_all(cls, layers, list_policy='replace'):
+        '''
+        Merge the Wax instances 'layers' into a new instance, giving the same
+        result as copying the first and adding each of the others to it with
+        '+=', but in a single pass over all of them.
+
+        'list_policy' decides how lists found under the same key in several
+        layers are combined: 'replace' keeps the topmost list as '+=' does,
+        'append' concatenates them and 'unique' concatenates them skipping
+        items already present.
+        '''
+        if list_policy not in LIST_POLICIES:
+            raise WaxError(E_POLICY % list_policy)
+        combine = list_policy != 'replace'
+        unique = list_policy == 'unique'
+        layers = list(layers)
+        for layer in layers:
+            if not isinstance(layer, Wax):
+                raise WaxError(E_NOCOPY % type(layer))
+        top = cls()
+        stack = [(layers, top)]
+        while stack:
+            srcs, dest = stack.pop()
+            d = dest.__dict__
+            order = dest._key_order
+            getters = [l._interp and l._stored_get or l.__dict__.get
+                for l in srcs]
+            getters.reverse()
+            noted = [l._annotations for l in srcs if l._annotations]
+            for key in _merged_order(srcs):
+                if isinstance(key, tuple):
+                    layer, idx = key
+                    dest._add_comment(layer._comments.get(idx, ''))
+                    continue
+                # walk down from the top layer, collecting the groups or
+                # lists which are merged rather than replaced.
+                groups = []
+                lists = []
+                val = _MISSING
+                for get in getters:
+                    tmp = get(key, _MISSING)
+                    if tmp is _MISSING:
+                        continue
+                    if groups:
+                        if not isinstance(tmp, Wax):
+                            break
+                        groups.append(tmp)
+                    elif lists:
+                        if not isinstance(tmp, _LISTS):
+                            break
+                        lists.append(tmp)
+                    elif isinstance(tmp, Wax):
+                        groups.append(tmp)
+                    elif combine and isinstance(tmp, _LISTS):
+                        lists.append(tmp)
+                    else:
+                        val = tmp
+                        break
+                if groups:
+                    groups.reverse()
+                    val = Wax()
+                    stack.append((groups, val))
+                    dest._link(key, val)
+                elif lists:
+                    lists.reverse()
+                    val = _merge_lists(lists, unique)
+                else:
+                    val = _copy_value(val)
+                d[key] = val
+                order.append(key)
+                note = ''
+                for notes in noted:
+                    note = notes.get(key) or note
+                if note:
+                    dest._annotations[key] = note
+        return top
+
+    @classmethod
+    def from_json(cls, data, intern_values=False, typed_arrays=False):
+        '''
+        Build a new instance from a JSON object, keeping key order.  Nested
+        objects become sub-instances, so dict values written by _to_json()
+        come back as groups.  Objects inside lists remain dicts.  Nesting
+        depth is not limited by the recursion limit.  See parse_wax() for
+        'intern_values' and 'typed_arrays'.
+        '''
+        if not isinstance(data, str):
+            raise WaxError(E_NOTSTR)
+        stm = WaxStream(data)
+        stm.interner = _value_interner(intern_values)
+        stm.typed_arrays = typed_arrays
+        stm.skipspaces()
+        if stm.next() != '{':
+            raise WaxError(E_JSON, stm, 0)
+        top = cls()
+        names = {}
+        # each frame holds an instance and the parser state within it:
+        # 0 = expecting key or '}', 1 = expecting ',' or '}', 2 = key only
+        stack = [[top, 0]]
+        try:
+            while stack:
+                frame = stack[-1]
+                stm.skipspaces()
+                c = stm.peek()
+                if not c:
+                    raise WaxError(E_TRUNC, stm, stm.pos)
+                elif c == '}' and frame[1] != 2:
+                    stm.next()
+                    stack.pop()
+                    if stack:
+                        stack[-1][1] = 1
+                    continue
+                elif frame[1] == 1:
+                    if c != ',':
+                        raise WaxError(E_JSON, stm, stm.pos)
+                    stm.next()
+                    frame[1] = 2
+                    continue
+                elif c != '"':
+                    raise WaxError(E_JSON, stm, stm.pos)
+
+                key = microjson._from_json_string(stm)
+                name = names.get(key)
+                if name is None:
+                    if not isinstance(key, str):
+                        raise WaxError(E_KEYTYPE % (key, type(key)), stm,
+                            stm.pos)
+                    validate_key(key)
+                    name = names[key] = intern(key)
+                stm.skipspaces()
+                if stm.next() != ':':
+                    raise WaxError(E_JSON, stm, stm.pos)
+                stm.skipspaces()
+                if stm.peek() == '{':
+                    stm.next()
+                    val = cls()
+                    stack.append([val, 0])
+                else:
+                    val = microjson._from_json_raw(stm)
+                node = frame[0]
+                d = node.__dict__
+                if name not in d:
+                    node._key_order.append(name)
+                d[name] = val
+                if isinstance(val, Wax):
+                    node._link(name, val)
+                frame[1] = 1
+        except microjson.JSONError, jexc:
+            raise WaxError(E_JSON, stm, stm.pos, jexc)
+        stm.skipspaces()
+        if stm.peek():
+            raise WaxError(E_JSON, stm, stm.pos)
+        return top
+
+    def _to_dict(self, dict_type=dict):
+        '''
+        Convert this instance and its sub-instances into nested dicts of
+        type 'dict_type'.  Keys are inserted in order, so passing
+        collections.OrderedDict preserves it.  Values are not copied.
+        '''
+        res = dict_type()
+        stack = [(self, res)]
+        while stack:
+            node, dest = stack.pop()
+            get = node._getter()
+            for key in node._key_order:
+                if isinstance(key, int):
+                    continue
+                val = get(key)
+                if isinstance(val, Wax):
+                    tmp = dest[key] = dict_type()
+                    stack.append((val, tmp))
+                else:
+                    dest[key] = val
+        return res
+
+    def _to_json(self):
+        '''
+        Return this instance as a JSON object, keeping key order.  Nesting
+        depth is not limited by the recursion limit.
+        '''
+        buf = []
+        write = buf.append
+        emitter = microjson.JsonEmitter(_ListWriter(buf))
+        write('{')
+        first = True
+        stack = [(self._getter(), iter(self._key_order))]
+        while stack:
+            get, keys = stack[-1]
+            for key in keys:
+                if isinstance(key, int):
+                    continue
+                if not first:
+                    write(',')
+                write('"%s":' % key)
+                val = get(key)
+                if isinstance(val, Wax):
+                    write('{')
+                    first = True
+                    stack.append((val._getter(), iter(val._key_order)))
+                    break
+                emitter.emit(val)
+                first = False
+            else:
+                stack.pop()
+                write('}')
+                first = False
+        return ''.join(buf)
+
+    def _to_struct(self, schema=None):
+        '''
+        Return a frozen copy of this instance as a WaxStruct, whose keys are
+        __slots__ attributes and so are read as fast as Python allows.
+        Sub-instances become nested structs.  A struct class is generated
+        once for each distinct list of key names and then reused.
+
+        If 'schema' is given, a WaxSchema or its description, each group
+        described by it has exactly the keys named in its 'fields', in
+        sorted order, so that all trees meeting the schema share the same
+        struct classes.  Missing keys are None, other keys are dropped.
+        '''
+        desc = getattr(schema, 'desc', schema)
+        if isinstance(desc, Wax):
+            desc = desc._to_dict()
+        return _build_struct(self, desc)
+
     def _get_annotation(self, key, default=None):
         '''
         Return the annotation for 'key' or 'default' if it does not exist.
@@ -107,6 +444,8 @@ class Wax(object):
         '''
         if not isinstance(text, (unicode, str)):
             raise WaxError(E_NONTEXT % ('annotation', repr(text)))
+        _staged(self)
+        self._invalidate()
         self._annotations[key] = text.rstrip()
 
     def _remove_annotation(self, key):
@@ -114,11 +453,15 @@ class Wax(object):
         If an annotation exists for 'key', remove it.
         '''
         if key in self._annotations:
+            _staged(self)
+            self._invalidate()
             del self._annotations[key]
 
     def _add_comment(self, text):
         if not isinstance(text, (unicode, str)):
             raise WaxError(E_NONTEXT % ('comment', repr(text)))
+        _staged(self)
+        self._invalidate()
         idx = self._comment_index
         self._comment_index += 1
         self._comments[idx] = text.rstrip()
@@ -130,13 +473,208 @@ class Wax(object):
         Since comments cannot be individually accessed (yet) we allow them
         to be cleared.
         '''
+        if self._comments:
+            _staged(self)
+            self._invalidate()
         self._comment_index = 0
         self._comments = {}
         self._key_order = [k for k in self._key_order if isinstance(k, str)]
 
+    def _link(self, key, child):
+        '''
+        Record that 'child' is stored under 'key' in this instance, so
+        changes to the child can be propagated upwards.
+        '''
+        if self._watched and not child._watched:
+            _set_watched(child)
+        refs = child._parents
+        if refs is None:
+            refs = child._parents = []
+        else:
+            for ref, name in refs:
+                if name == key and ref() is self:
+                    return
+            refs[:] = [(r, n) for r, n in refs if r() is not None]
+        refs.append((weakref.ref(self), key))
+
+    def _ancestors(self):
+        '''
+        Yield the instances which currently hold this instance as a value.
+        Stale links to parents which have since dropped or replaced this
+        instance are skipped.
+        '''
+        refs = self._parents
+        if not refs:
+            return
+        for ref, key in refs:
+            parent = ref()
+            if parent is not None and parent.__dict__.get(key) is self:
+                yield parent
+
+    def __getstate__(self):
+        '''
+        Return the state to pickle.  Parent links, cached fingerprints and
+        watchers are left out and rebuilt as needed after loading.
+        Interpolated and deferred values are stored as written, so
+        _interpolate() must be called again on the loaded instance.
+        '''
+        state = self.__dict__.copy()
+        for name in _NODE_ATTRS:
+            state.pop(name, None)
+        for key, entry in (self._interp or {}).iteritems():
+            state[key] = entry.raw
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for key in self.keys():
+            val = state[key]
+            if isinstance(val, Wax):
+                self._link(key, val)
+
+    def _invalidate(self):
+        '''
+        Discard the cached fingerprints of this instance and all of its
+        ancestors.  Propagation stops at any instance with no cached
+        fingerprint, since its ancestors cannot have one either.
+        '''
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node._fp_cache is None:
+                continue
+            del node.__dict__['_fp_cache']
+            stack.extend(node._ancestors())
+
+    def _memory_usage(self, deep=True, unique=False):
+        '''
+        Return the memory used by this instance, as measured by
+        sys.getsizeof(), broken down by group.  The result maps the dotted
+        path of each group ('' for this instance) to a dict of bytes:
+
+          node          the instance and its internal dicts and lists
+          keys          the key names
+          values        the values, other than sub-instances
+          comments      the comment texts
+          annotations   the annotation texts
+
+        If 'deep' is true every sub-instance is reported under its own path,
+        and values include the objects nested in lists and dicts; otherwise
+        only this instance is measured, with values measured shallowly.  If
+        'unique' is true, objects referenced more than once, such as
+        interned key names or shared values, are only counted the first
+        time they are found, walking the groups in key order.
+        '''
+        return _measure(self, deep, unique)
+
+    def _fingerprint(self, annotations=False, comments=False):
+        '''
+        Return a hex digest of this instance's keys, values and key order.
+        Annotations and comments are only included if requested.  Digests
+        are cached per instance and discarded whenever the instance or one
+        of its sub-instances is modified, so repeated calls on an unchanged
+        tree are constant time.
+
+        Lists and dicts can be modified in place without Wax noticing, so
+        subtrees which contain them are always re-hashed.
+        '''
+        return self._digest(annotations, comments)[0]
+
+    def _digest(self, annotations, comments):
+        '''
+        Implementation of _fingerprint().  Returns the digest and a flag
+        indicating whether it covers mutable values and so cannot be cached.
+        '''
+        variant = (annotations, comments)
+        cache = self._fp_cache
+        if cache and variant in cache:
+            return cache[variant], False
+        h = hashlib.sha1()
+        volatile = False
+        get = self._getter()
+        for key in self._key_order:
+            if isinstance(key, int):
+                if comments:
+                    _hash_text(h, 'c', self._comments.get(key, ''))
+                continue
+            _hash_text(h, 'k', key)
+            if annotations:
+                _hash_text(h, 'a', self._annotations.get(key, ''))
+            val = get(key)
+            if isinstance(val, Wax):
+                digest, tmp = val._digest(annotations, comments)
+                h.update('w' + digest)
+            else:
+                tmp = _hash_value(h, val)
+            volatile = volatile or tmp
+        digest = h.hexdigest()
+        if not volatile:
+            if cache is None:
+                cache = self._fp_cache = {}
+            cache[variant] = digest
+        return digest, volatile
+
+    def _cached_fingerprint(self, annotations, comments):
+        "Return the cached fingerprint for this variant, or None."
+        cache = self._fp_cache
+        if cache:
+            return cache.get((annotations, comments))
+        return None
+
+    def _canonical(self):
+        '''
+        Return this instance in canonical form: the layout of str(), with
+        the keys of every group and dict value sorted, floats written in
+        full, and no comments or annotations.  Interpolated strings are
+        written unresolved.  Trees with the same keys and values always
+        produce the same text, so it can be used as a cache key or to
+        address content.
+        '''
+        buf = []
+        self._write_canonical(buf.append)
+        return ''.join(buf)
+
+    def _canonical_digest(self):
+        '''
+        Return the hex SHA-1 digest of _canonical(), hashing the text as it
+        is produced rather than joining it first.
+        '''
+        h = hashlib.sha1()
+        self._write_canonical(h.update)
+        return h.hexdigest()
+
+    def _write_canonical(self, write):
+        "Implementation of _canonical(), passing each group's text to 'write'."
+        stack = [('', self)]
+        while stack:
+            parent, node = stack.pop()
+            buf = []
+            emitter = microjson.JsonEmitter(_ListWriter(buf), True)
+            get = node._getter()
+            keys = node.keys()
+            keys.sort()
+            subs = []
+            for key in keys:
+                val = get(key)
+                if isinstance(val, Wax):
+                    subs.append((key, val))
+                    continue
+                buf.append(key + ' = ')
+                emitter.emit(val)
+                buf.append('\n')
+            # a header for groups with values or no keys at all, as in str()
+            if parent and (len(subs) < len(keys) or not keys):
+                buf.insert(0, '\n[%s]\n' % parent)
+            if not stack and not subs:
+                buf.append('\n')
+            write(''.join(buf))
+            for key, sub in reversed(subs):
+                stack.append((parent and '%s.%s' % (parent, key) or key, sub))
+
     def __iadd__(self, obj):
         "Merge 'obj' into this instance."
-        self._deep_copy(obj, self)
+        with _Transaction():
+            self._deep_copy(obj, self)
         return self
 
     def __add__(self, obj):
@@ -145,20 +683,228 @@ class Wax(object):
         return self._deep_copy(obj, w)
 
     def __sub__(self, obj):
-        "Subtract 'obj' from this instance and return the result."
+        '''
+        Subtract 'obj' from this instance and return the result, which holds
+        the keys of this instance that are missing from 'obj'.  Use _diff()
+        for a complete comparison.
+        '''
         w = Wax()
-        for key in self.keys():
-            if key in obj:
-                lt = self[key]
-                rt = obj[key]
-                if isinstance(lt, Wax) and isinstance(rt, Wax):
-                    tmp = lt - rt
-                    if tmp.keys():
-                        w[key] = tmp
-            else:
-                w[key] = self[key]
+        for op in obj._diff(self, annotations=False, comments=False):
+            if op[0] == 'add':
+                w[op[1]] = op[2]
         return w
 
+    def _diff(self, obj, annotations=True, comments=True):
+        '''
+        Compare this instance with 'obj' and return a WaxPatch which, when
+        applied to this instance, makes it equal to 'obj'.  Annotation and
+        comment changes are included unless disabled.  Identical subtrees
+        are skipped without being walked.
+        '''
+        if not isinstance(obj, Wax):
+            raise WaxError(E_NODIFF % type(obj))
+        ops = []
+        # computing the top-level fingerprints caches those of every
+        # subtree, which lets _diff prune unchanged subtrees cheaply.
+        if self._fingerprint(annotations, comments) != \
+                obj._fingerprint(annotations, comments):
+            _diff_groups(self, obj, '', ops, annotations, comments)
+        return WaxPatch(ops)
+
+    def _apply(self, patch):
+        '''
+        Apply the operations in 'patch' to this instance and return it.
+        '''
+        with _Transaction():
+            self._apply_ops(patch)
+        return self
+
+    def _apply_ops(self, patch):
+        for op in patch:
+            kind, path = op[0], op[1]
+            if kind in ('add', 'change'):
+                self[path] = _copy_value(op[-1])
+            elif kind == 'remove':
+                del self[path]
+            elif kind == 'annotate':
+                node, key = self._select_parent(path)
+                if op[2]:
+                    node._set_annotation(key, op[2])
+                else:
+                    node._remove_annotation(key)
+            elif kind == 'order':
+                node = self._select_group(path)
+                _staged(node)
+                layout = _comment_layout(node)
+                node._key_order = list(op[2])
+                _set_comment_layout(node, layout)
+                node._invalidate()
+            elif kind == 'comments':
+                _set_comment_layout(self._select_group(path), op[2])
+            else:
+                raise WaxError(E_PATCH % repr(op))
+
+    def _batch(self):
+        '''
+        Return a context manager which batches changes made on this thread
+        until it exits.  Key names are validated once per batch and
+        subscription callbacks happen once at the end, and if the block
+        raises every instance changed within it is restored to its prior
+        state.  Nested batches join the outermost one.
+        '''
+        return _BatchContext()
+
+    def _subscribe(self, pattern, callback):
+        '''
+        Call 'callback' when keys matching the dotted 'pattern' change.  A
+        pattern segment may be '*' to match any one key or '**' to match
+        any number of keys.  Changes to keys below a matching key, or to the
+        groups containing it, are also reported.
+
+        The callback receives a list of (action, path) tuples, where action
+        is 'set' or 'delete' and path is relative to this instance.  Changes
+        made by a merge, patch or parse are delivered in a single call once
+        it completes.  Returns a subscription with a cancel() method.
+        '''
+        parts = tuple(pattern.split('.'))
+        for part in parts:
+            if part not in ('*', '**'):
+                try:
+                    validate_key(part)
+                except WaxError:
+                    raise WaxError(E_PATTERN % pattern)
+        index = None
+        for watcher in self._watchers or ():
+            if isinstance(watcher, _SubscriptionIndex):
+                index = watcher
+        if index is None:
+            index = _SubscriptionIndex()
+            self._add_watcher(index)
+        sub = _Subscription(self, index, parts, callback)
+        index.trie.add(parts, sub)
+        return sub
+
+    @classmethod
+    def chain(cls, *layers):
+        '''
+        Return a read-only WaxChain view of 'layers', which behaves like
+        their merge with '+=' without copying any of them.
+        '''
+        return WaxChain(*layers)
+
+    def _template(self, fmt, cache=False):
+        '''
+        Compile the '%(dotted.key)s' format string 'fmt' into a WaxTemplate
+        bound to this instance.  The format is parsed and each dotted key
+        resolved to an accessor once, so rendering avoids the per-key
+        lookups of 'fmt % wax'.  If 'cache' is true the rendered text is
+        kept until this instance or one of its sub-instances changes.
+        '''
+        return WaxTemplate(fmt, self, cache)
+
+    def _interpolate(self):
+        '''
+        Enable '${dotted.key}' references in the string values of this
+        instance and its sub-instances.  References are relative to this
+        instance and are resolved when the value is first read; '$$' stands
+        for a literal '$' in every string, with or without references.  A
+        value consisting of a single reference takes the referenced value as
+        is, otherwise the values are formatted into the string.
+
+        Resolved values are remembered until a key they reference, directly
+        or through another interpolated value, changes.  Serializing,
+        copying, merging, comparing and diffing all use the unresolved
+        strings.  Values set later are stored as-is; call _interpolate()
+        again to enable references in them.
+        '''
+        index = None
+        for watcher in self._watchers or ():
+            if isinstance(watcher, _InterpolationIndex):
+                index = watcher
+        if index is None:
+            index = _InterpolationIndex(self)
+            self._add_watcher(index)
+        stack = [(self, ())]
+        while stack:
+            node, prefix = stack.pop()
+            d = node.__dict__
+            interp = node._interp
+            for key in node.keys():
+                if interp and key in interp:
+                    continue
+                val = d[key]
+                if isinstance(val, Wax):
+                    stack.append((val, prefix + (key,)))
+                elif isinstance(val, basestring) and \
+                        ('${' in val or '$$' in val):
+                    entry = _Interpolation(index, node, key, prefix + (key,),
+                        val)
+                    if interp is None:
+                        interp = node._interp = {}
+                    interp[key] = entry
+                    del d[key]
+        return self
+
+    def _select(self, pattern, index=False):
+        '''
+        Yield (path, value) pairs for the keys below this instance whose
+        dotted path matches 'pattern'.  A pattern segment is a key name,
+        which may use fnmatch wildcards as in 'time*' or 'host[0-9]', '*' to
+        match any one key or '**' to match any number of keys.  Pairs are
+        produced lazily, in key order.
+
+        If 'index' is true, an index of key names is built the first time
+        and kept up to date as this instance changes.  Queries naming a key
+        then start from the keys with the least common name in the pattern
+        instead of visiting every key, but the pairs come in no particular
+        order.
+        '''
+        pattern = _PathPattern(pattern)
+        if index and (pattern.names or pattern.last):
+            idx = None
+            for watcher in self._watchers or ():
+                if isinstance(watcher, _KeyIndex):
+                    idx = watcher
+            if idx is None:
+                idx = _KeyIndex(self)
+                self._add_watcher(idx)
+            return idx.select(pattern)
+        return _select_paths(self, pattern)
+
+    def _add_watcher(self, watcher):
+        '''
+        Attach an object to be told about changes to this instance and its
+        sub-instances via its _wax_changed(parts, action) method.
+        '''
+        if self._watchers is None:
+            self._watchers = []
+            _set_watched(self)
+        self._watchers.append(watcher)
+
+    def _remove_watcher(self, watcher):
+        watchers = self._watchers
+        if watchers and watcher in watchers:
+            watchers.remove(watcher)
+            if not watchers:
+                del self.__dict__['_watchers']
+                _clear_watched(self)
+
+    def _select_group(self, path):
+        "Return the Wax instance at dotted 'path', which may be empty."
+        if not path:
+            return self
+        node = self[path]
+        if not isinstance(node, Wax):
+            raise WaxError(E_SELECT % path)
+        return node
+
+    def _select_parent(self, path):
+        "Return the Wax instance holding dotted 'path' and the final key."
+        if '.' in path:
+            group, key = path.rsplit('.', 1)
+            return self._select_group(group), key
+        return self, path
+
     def __len__(self):
         "Return the number of keys stored in this instance."
         return len(self.keys())
@@ -186,28 +932,44 @@ class Wax(object):
                 # src key's annotation wins
                 dst._set_annotation(key, src_note)
 
-            val = src[key]
+            val = src._stored(key)
             if isinstance(val, Wax):
-                if key in dst and isinstance(dst[key], Wax):
-                    self._deep_copy(val, dst[key])
-                else:
-                    dst[key] = Wax(val)
-            elif isinstance(val, dict):
-                dst[key] = val.copy()
-            elif isinstance(val, list):
-                dst[key] = list(val)
-            else:
-                dst[key] = val
+                try:
+                    tmp = dst._stored(key)
+                except KeyError:
+                    tmp = None
+                if isinstance(tmp, Wax):
+                    # skip subtrees already known to be identical
+                    digest = val._cached_fingerprint(True, True)
+                    if digest and \
+                            digest == tmp._cached_fingerprint(True, True):
+                        continue
+                    self._deep_copy(val, tmp)
+                    continue
+            dst[key] = _copy_value(val)
         return dst
 
     def _remove_key(self, key):
         if not isinstance(key, str):
             raise WaxError(E_KEYTYPE % (key, type(key)))
-        if key in self.__dict__:
-            del self.__dict__[key]
+        interp = self._interp
+        if key in self.__dict__ or (interp and key in interp):
+            batch = _staged(self)
+            old = self.__dict__.pop(key, None)
+            if interp and key in interp:
+                del interp[key]
             self._key_order.remove(key)
             if key in self._annotations:
                 del self._annotations[key]
+            group = isinstance(old, Wax)
+            self._invalidate()
+            if batch is not None:
+                if self._watched:
+                    batch.changes.append((self, key, 'delete', group))
+                    _notify(self, key, 'delete', group, True)
+                return
+            if self._watched:
+                _notify(self, key, 'delete', group)
 
     def __contains__(self, key):
         try:
@@ -239,7 +1001,55 @@ class Wax(object):
                 if not isinstance(curr, (Wax, dict, UserDict.DictMixin)):
                     raise WaxError(E_SELECT % key)
             key = parts[-1]
-        return curr.__dict__[key]
+            if not isinstance(curr, Wax):
+                return curr[key]
+        try:
+            return curr.__dict__[key]
+        except KeyError:
+            return curr._resolve(key)
+
+    def __getattr__(self, key):
+        "Called for keys not in __dict__, i.e. unresolved interpolations."
+        try:
+            return self._resolve(key)
+        except KeyError:
+            raise AttributeError(key)
+
+    def _resolve(self, key):
+        interp = self._interp
+        if interp and key in interp:
+            entry = interp[key]
+            if not isinstance(entry, _Deferred):
+                return entry.resolve()
+            # decoded values are stored as usual.  The value itself is
+            # unchanged, so fingerprints stay valid and nobody is notified.
+            val = self.__dict__.setdefault(key, entry.resolve())
+            interp.pop(key, None)
+            return val
+        raise KeyError(key)
+
+    def _stored(self, key):
+        '''
+        Return the value stored under 'key'.  Interpolated strings are
+        returned unresolved.
+        '''
+        interp = self._interp
+        if interp and key in interp:
+            return interp[key].raw
+        return self.__dict__[key]
+
+    def _stored_get(self, key, default=None):
+        "Like _stored(), but return 'default' if 'key' does not exist."
+        interp = self._interp
+        if interp and key in interp:
+            return interp[key].raw
+        return self.__dict__.get(key, default)
+
+    def _getter(self):
+        "Return _stored, or a faster equivalent if nothing is interpolated."
+        if self._interp:
+            return self._stored
+        return self.__dict__.__getitem__
 
     def __delitem__(self, key):
         if not isinstance(key, str):
@@ -254,8 +1064,7 @@ class Wax(object):
                     raise WaxError(E_SELECT % key)
             key = parts[-1]
             validate_key(key)
-        self = curr
-        Wax._remove_key(self, key)
+        curr._remove_key(key)
 
     def __setitem__(self, key, val):
         '''
@@ -278,19 +1087,60 @@ class Wax(object):
         if key and key[0] == '_':
             self.__dict__[key] = val
             return
+        batch = None
+        if _batch_count:
+            batch = getattr(_local, 'batch', None)
         curr = self
         if '.' in key:
             parts = key.split('.')
             for part in parts[:-1]:
                 validate_key(part)
-                if not hasattr(curr, part):
+                if part not in curr.__dict__ and \
+                        not (curr._interp and part in curr._interp):
                     setattr(curr, part, Wax())
                 curr = curr[part]
-            key = parts[-1]
-        validate_key(key)
-        curr.__dict__[key] = val
-        if key not in curr._key_order:
+                if not isinstance(curr, Wax):
+                    raise WaxError(E_SELECT % key)
+            key = intern(parts[-1])
+            if curr.__class__ is _FrozenWax:
+                raise WaxError(E_READONLY % key)
+        if batch is None:
+            validate_key(key)
+        elif key not in batch.valid:
+            validate_key(key)
+            batch.valid.add(key)
+            batch.stage(curr)
+        elif curr is not batch.last:
+            batch.stage(curr)
+        d = curr.__dict__
+        old = d.get(key)
+        interp = curr._interp
+        if interp and key in interp:
+            del interp[key]
+        elif old is None and key not in d:
             curr._key_order.append(key)
+        if isinstance(val, _Deferred):
+            # kept aside until first read, see _resolve()
+            d.pop(key, None)
+            if interp is None:
+                interp = curr._interp = {}
+            interp[key] = val
+        else:
+            d[key] = val
+        if isinstance(val, Wax):
+            curr._link(key, val)
+            group = True
+        else:
+            group = isinstance(old, Wax)
+        if curr._fp_cache is not None:
+            curr._invalidate()
+        if batch is not None:
+            if curr._watched:
+                batch.changes.append((curr, key, 'set', group))
+                _notify(curr, key, 'set', group, True)
+            return
+        if curr._watched:
+            _notify(curr, key, 'set', group)
 
     def __delattr__(self, key):
         self._remove_key(key)
@@ -314,14 +1164,20 @@ class Wax(object):
     def __eq__(self, obj):
         '''
         Compute recursive equivalence between two Wax instances.  Comments
-        and annotations are ignored in comparison.
+        and annotations are ignored in comparison.  Instances whose
+        fingerprints are both cached and match are equal without further
+        comparison.
         '''
         if not isinstance(obj, Wax):
             raise TypeError("argument is not of type Wax")
+        digest = self._cached_fingerprint(False, False)
+        if digest is not None and \
+                digest == obj._cached_fingerprint(False, False):
+            return True
         if not sorted(self.keys()) == sorted(obj.keys()):
             return False
         for key in self.keys():
-            if not self[key] == obj[key]:
+            if not self._stored(key) == obj._stored(key):
                 return False
         return True
 
@@ -330,14 +1186,7 @@ class Wax(object):
         Compute recursive inequality between two Wax instances.  Comments
         and annotations are ignored in comparison.
         '''
-        if not isinstance(obj, Wax):
-            raise TypeError("argument is not of type Wax")
-        if sorted(self.keys()) != sorted(obj.keys()):
-            return True
-        for key in self.keys():
-            if self[key] != obj[key]:
-                return True
-        return False
+        return not self.__eq__(obj)
 
 
     def __str__(self):
@@ -365,15 +1214,21 @@ class Wax(object):
                 buf += _format_comment('#', comment)
                 continue
 
-            val = obj[key]
-            if isinstance(val, Wax):
-                subs.append( (key, val) )
-                continue
+            entry = obj._interp and obj._interp.get(key)
+            if isinstance(entry, _Deferred) and entry.text is not None:
+                # never decoded, so write out the original text
+                text = entry.text
+            else:
+                val = obj._stored(key)
+                if isinstance(val, Wax):
+                    subs.append( (key, val) )
+                    continue
+                text = microjson.to_json(val)
 
             vals += 1
             note = obj._annotations.get(key, '')
             buf += _format_comment(';', note)
-            buf += key + ' = ' + microjson.to_json(val) + '\n'
+            buf += key + ' = ' + text + '\n'
 
         # output sub-instances
         for key, inst in subs:
@@ -391,17 +1246,45 @@ class Wax(object):
         return buf
 
 
-def parse_wax(data, dest=None):
+def parse_wax(data, dest=None, intern_values=False, typed_arrays=False,
+        keep_comments=True, defer_values=False):
     '''
     Parse a config file into a Wax instance, or merge the contents of the
     file to the 'dest' Wax instance.
+
+    Key names are interned.  If 'intern_values' is true, equal strings and
+    integers are also stored once, including those inside lists and dicts.
+    Pass a dict to share values between calls.
+
+    If 'typed_arrays' is true, lists holding only integers or only floats,
+    at any depth, are stored as array.array('l') or array.array('d').  These
+    take a fraction of the memory of a list, expose their contents through
+    the buffer protocol, and are written back out unchanged.
+
+    If 'keep_comments' is false, comments and annotations are skipped
+    without being stored, which makes the result smaller for programs which
+    only read the values.  Only the time spent on the comments themselves
+    is saved, so heavily commented input parses faster and other input
+    does not.
+
+    If 'defer_values' is true, list and dict values are only scanned for
+    their extent, and are decoded when first read.  Values which are never
+    read are written out as their original text.  Errors in their contents
+    are raised when they are read.  Groups, keys and scalars are still
+    parsed and stored, which remains the bulk of the cost for input with
+    many short values.
     '''
     if not isinstance(data, str):
         raise WaxError(E_NOTSTR)
     stm = WaxStream(data)
+    stm.interner = _value_interner(intern_values)
+    stm.typed_arrays = typed_arrays
+    stm.keep_comments = keep_comments
+    stm.defer_values = defer_values
     if dest is None:
         dest = Wax()
-    return parse_wax_raw(stm, dest)
+    with _Transaction():
+        return parse_wax_raw(stm, dest)
 
 
 def wax_to_dict(obj):
@@ -410,10 +1293,7 @@ def wax_to_dict(obj):
     '''
     if not isinstance(obj, Wax):
         return obj
-    d = dict()
-    for key in obj.keys():
-        d[key] = wax_to_dict(obj[key])
-    return d
+    return obj._to_dict()
 
 
 class WaxError(Exception):
@@ -428,163 +1308,2026 @@ class WaxError(Exception):
         Exception.__init__(self, msg)
  
 
-# Implementation details are below.  You shouldn't need these for 
-# typical uses of Wax.
+class WaxPatch(object):
 
+    '''
+    A list of operations which transform one Wax tree into another, as
+    returned by Wax._diff().  Each operation is a tuple whose first two
+    elements are the operation name and a dotted path:
+
+      ('add', path, value)          - key added
+      ('remove', path)              - key removed
+      ('change', path, old, new)    - value replaced
+      ('annotate', path, text)      - annotation changed ('' to remove)
+      ('order', group, keys)        - keys of a group reordered
+      ('comments', group, layout)   - comments of a group replaced
+
+    The root group's path is ''.  A comment layout is a list of
+    (key, text) pairs, where each comment follows 'key' or, if it is
+    None, precedes all keys.
+    '''
 
-class WaxStream(microjson.JSONStream):
+    def __init__(self, ops=None):
+        self.ops = list(ops or [])
 
-    def __init__(self, data):
-        self.lineno = 1
-        microjson.JSONStream.__init__(self, data)
+    def __iter__(self):
+        return iter(self.ops)
 
-    def next(self, num=1):
-        s = super(WaxStream, self).next(num)
-        self.lineno += len([c for c in s if c == '\n'])
-        return s
-    
-    def skipto(self, ch):
-        "post-cond: read pointer will be over first occurrance of 'ch'"
-        self._skip(lambda c: c == ch)
+    def __len__(self):
+        return len(self.ops)
 
+    def __eq__(self, obj):
+        return isinstance(obj, WaxPatch) and self.ops == obj.ops
 
-def validate_key(key):
-    '''
-    Checks if a key is valid.  Caller must handle splitting dotted keys
-    and calling this with each part.
-    '''
-    if not RE_KEYVALID.match(key):
-        raise WaxError(E_BADKEY % key)
-    if key in BAD_KEY_NAMES:
-        raise WaxError(E_KEYNAME % key)
+    def __ne__(self, obj):
+        return not self.__eq__(obj)
 
+    def __str__(self):
+        return self.to_json()
 
-def parse_dotted(stm):
-    # skip '['
-    stm.next()
-    pos = stm.pos
-    group = None
-    while True:
-        c = stm.next()
-        if c in GRPVALID:
-            continue
+    def __repr__(self):
+        return 'WaxPatch(%r)' % self.ops
 
-        # end of group
-        elif c == ']':
-            group = stm.substr(pos, stm.pos - pos - 1)
-            break
+    def paths(self):
+        '''
+        Return the dotted paths touched by this patch, in order.
+        '''
+        return [op[1] for op in self.ops]
 
-        elif c == '':
-            raise WaxError(E_TRUNC, stm, stm.pos)
+    def to_json(self):
+        '''
+        Serialize this patch as a JSON list of objects.  Wax values are
+        stored in Wax format under the 'wax' / 'old_wax' fields.
+        '''
+        res = []
+        for op in self.ops:
+            obj = {'op': op[0], 'path': op[1]}
+            if op[0] in ('add', 'change'):
+                _encode_patch_value(obj, 'value', 'wax', op[-1])
+            if op[0] == 'change':
+                _encode_patch_value(obj, 'old', 'old_wax', op[2])
+            elif op[0] == 'annotate':
+                obj['text'] = op[2]
+            elif op[0] == 'order':
+                obj['keys'] = list(op[2])
+            elif op[0] == 'comments':
+                obj['layout'] = [list(pair) for pair in op[2]]
+            res.append(obj)
+        return microjson.to_json(res)
 
-        partial = stm.substr(pos, stm.pos - pos)
-        raise WaxError(E_GROUP % partial, stm, stm.pos)
-    stm.skipto('\n')
-    return pos, group
+    @classmethod
+    def from_json(cls, data):
+        '''
+        Reconstruct a patch serialized by to_json().
+        '''
+        ops = []
+        for obj in microjson.from_json(data) or []:
+            try:
+                kind, path = obj['op'], str(obj['path'])
+                if kind == 'add':
+                    op = (kind, path, _decode_patch_value(obj, 'value', 'wax'))
+                elif kind == 'change':
+                    op = (kind, path,
+                        _decode_patch_value(obj, 'old', 'old_wax'),
+                        _decode_patch_value(obj, 'value', 'wax'))
+                elif kind == 'remove':
+                    op = (kind, path)
+                elif kind == 'annotate':
+                    op = (kind, path, obj['text'])
+                elif kind == 'order':
+                    op = (kind, path, [str(k) for k in obj['keys']])
+                elif kind == 'comments':
+                    op = (kind, path, [(k is not None and str(k) or None, t)
+                        for k, t in obj['layout']])
+                else:
+                    raise WaxError(E_PATCH % repr(obj))
+            except (KeyError, TypeError, ValueError):
+                raise WaxError(E_PATCH % repr(obj))
+            ops.append(op)
+        return cls(ops)
 
 
-def parse_group(stm, top, annotation=None):
-    pos, group = parse_dotted(stm)
-    # create a path to the group from the top instance.
-    prev = curr = top
-    parts = group.split('.')
-    for part in parts:
-        if part in BAD_KEY_NAMES:
-            raise WaxError(E_KEYNAME % part, stm, pos)
-        if not hasattr(curr, part):
-            curr[part] = Wax()
-        prev = curr
-        curr = curr[part]
-        if not isinstance(curr, Wax):
-            raise WaxError(E_SELECT % group, stm, pos)
-    stm.next()
-    prev._set_annotation(parts[-1], annotation.decode('utf-8'))
-    return curr
+class WaxTemplate(object):
 
+    '''
+    A '%(dotted.key)s' format string compiled for rendering against Wax
+    instances, as returned by Wax._template().  Rendering produces the same
+    text as 'fmt % wax'.
 
-def parse_keyval(stm, dest, annotation=None):
-    "Parse an INI key/value pair, where the value is a JSON type."
-    pos = stm.pos
-    key = None
-    while True:
-        c = stm.next()
-        if c == '':
-            raise WaxError(E_TRUNC, stm, stm.pos - 1)
+    A caching template is only told about changes made through Wax, so it
+    will not notice a list or dict value being modified in place.
+    '''
 
-        elif c in microjson.WS:
-            continue
+    def __init__(self, fmt, wax=None, cache=False):
+        self.fmt = fmt
+        self.wax = wax
+        self._format, self._getters = _compile_format(fmt)
+        self._text = None
+        self._cache = cache and wax is not None
+        if self._cache:
+            wax._add_watcher(_CacheWatcher(self, wax))
 
-        # parse "key = <json>"
-        elif c == '=':
-            key = stm.substr(pos, stm.pos - pos - 1)
-            key = key.strip()
-            stm.skipspaces()
-            c = stm.peek()
-            val = None
-            try:
-                val = microjson._from_json_raw(stm)
-            except microjson.JSONError, jexc:
-                raise WaxError(E_JSON, stm, stm.pos, jexc)
-            try:
-                setattr(dest, key, val)
-            except WaxError, exc:
-                raise WaxError(str(exc), stm, stm.pos)
-            dest._set_annotation(key, annotation.decode('utf-8'))
-            break
+    def render(self, obj=None):
+        '''
+        Render this template against 'obj', or the instance it is bound to.
+        '''
+        if obj is None or obj is self.wax:
+            if self._text is not None:
+                return self._text
+            obj = self.wax
+        text = self._format % tuple([get(obj) for get in self._getters])
+        if self._cache and obj is self.wax:
+            self._text = text
+        return text
 
-        elif c not in KEYVALID and c != '.':
-            key = stm.substr(pos, stm.pos - pos - 1)
-            raise WaxError(E_BADKEY % key, stm, stm.pos - 1)
-    return key
+    def _wax_changed(self, parts, action, group):
+        self._text = None
 
+    def __mod__(self, obj):
+        return self.render(obj)
 
-def parse_wax_raw(stm, top):
-    comment = ''
-    annotation = ''
-    curr = top
-    while True:
-        stm.skipspaces()
-        c = stm.peek()
-        if c != '#' and comment:
-            curr._add_comment(comment.decode('utf-8'))
-            comment = ''
+    def __str__(self):
+        return self.render()
 
-        # end of stream
-        if c == '':
-            return top
+    def __repr__(self):
+        return 'WaxTemplate(%r)' % self.fmt
 
-        # [dotted.group]
-        elif c == '[':
-            curr = parse_group(stm, top, annotation)
-            annotation = ''
 
-        # '# comment text'
-        elif c == '#':
-            stm.next()
-            pos = stm.pos
-            stm.skipto('\n')
-            comment += stm.substr(pos, stm.pos - pos) + '\n'
-            stm.next()
+class WaxChain(object):
+
+    '''
+    A read-only view of Wax instances layered on top of each other, as
+    returned by Wax.chain().  Looking up a key gives the same result as in
+    the merge of the layers with '+=', later layers taking precedence, but
+    nothing is copied.  Groups present in several layers are returned as
+    chains of the groups.  The layers are kept in '_layers', lowest
+    precedence first.
+
+    Resolved keys are cached, and the cache is discarded on the next lookup
+    after a layer changes.  Each layer keeps a change counter attached for
+    this, so creating a chain does not walk the layers.  As with
+    fingerprints, lists and dicts modified in place are not noticed.
+    '''
+
+    def __init__(self, *layers):
+        for layer in layers:
+            if not isinstance(layer, Wax):
+                raise WaxError(E_NOCHAIN % type(layer))
+        self._layers = layers
+        self._gens = tuple([_generation(layer) for layer in layers])
+        self._counts = None
+        self._cache = {}
+        self._order = None
+
+    @classmethod
+    def _sub(cls, layers, gens, counts):
+        '''
+        Return a chain of 'layers' whose cache is checked against the change
+        counters 'gens' of the top-level layers.
+        '''
+        chain = cls.__new__(cls)
+        chain._layers = layers
+        chain._gens = gens
+        chain._counts = counts
+        chain._cache = {}
+        chain._order = None
+        return chain
+
+    def _check(self):
+        "Discard the cache if a top-level layer changed since it was filled."
+        counts = [gen.count for gen in self._gens]
+        if counts != self._counts:
+            self._counts = counts
+            self._cache = {}
+            self._order = None
+
+    def _get(self, key):
+        self._check()
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        groups = []
+        val = _MISSING
+        volatile = False
+        for layer in reversed(self._layers):
+            interp = layer._interp
+            if interp and key in interp:
+                tmp = layer._resolve(key)
+                volatile = True
+            else:
+                tmp = layer.__dict__.get(key, _MISSING)
+                if tmp is _MISSING:
+                    continue
+            if isinstance(tmp, Wax):
+                groups.append(tmp)
+                continue
+            # a value below a group was replaced by it
+            if not groups:
+                val = tmp
+            break
+        if groups:
+            groups.reverse()
+            val = WaxChain._sub(tuple(groups), self._gens, self._counts)
+        elif val is _MISSING:
+            raise KeyError(key)
+        if not volatile:
+            self._cache[key] = val
+        return val
+
+    def __getitem__(self, key):
+        if not isinstance(key, str):
+            raise WaxError(E_KEYTYPE % (key, type(key)))
+        curr = self
+        if '.' in key:
+            parts = key.split('.')
+            for part in parts[:-1]:
+                curr = curr[part]
+                if not isinstance(curr, (WaxChain, dict, UserDict.DictMixin)):
+                    raise WaxError(E_SELECT % key)
+            key = parts[-1]
+            if not isinstance(curr, WaxChain):
+                return curr[key]
+        return curr._get(key)
+
+    def __getattr__(self, key):
+        if key[:1] == '_':
+            raise AttributeError(key)
+        try:
+            return self._get(key)
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, val):
+        if key[:1] != '_':
+            raise WaxError(E_READONLY % key)
+        self.__dict__[key] = val
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except (WaxError, KeyError):
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        '''
+        Given 'key' return a value. If 'key' doesn't exist, return 'default'.
+        Also 'key' may be dotted.
+        '''
+        try:
+            return self[key]
+        except (WaxError, KeyError):
+            return default
+
+    def keys(self):
+        '''
+        Return the keys of all layers, in the order a merge would give them.
+        '''
+        self._check()
+        order = self._order
+        if order is None:
+            order = self._order = [k for k in _merged_order(self._layers)
+                if not isinstance(k, tuple)]
+        return list(order)
+
+    def _to_dict(self, dict_type=dict):
+        '''
+        Convert this chain into nested dicts of type 'dict_type'.
+        '''
+        res = dict_type()
+        for key in self.keys():
+            val = self._get(key)
+            if isinstance(val, WaxChain):
+                val = val._to_dict(dict_type)
+            res[key] = val
+        return res
+
+    def __str__(self):
+        return self._render('') + '\n'
+
+    def _render(self, parent):
+        '''
+        Implementation of __str__.  Output matches that of the merged
+        instance.
+        '''
+        buf = ''
+        subs = []
+        vals = 0
+        for key in _merged_order(self._layers):
+            if isinstance(key, tuple):
+                layer, idx = key
+                buf += _format_comment('#', layer._comments.get(idx, ''))
+                continue
+            val = self._get(key)
+            note = ''
+            for layer in self._layers:
+                note = layer._annotations.get(key) or note
+            if isinstance(val, WaxChain):
+                subs.append((key, note, val))
+            else:
+                vals += 1
+                for layer in reversed(self._layers):
+                    if key in layer.__dict__ or key in (layer._interp or ()):
+                        val = layer._stored(key)
+                        break
+                buf += _format_comment(';', note)
+                buf += key + ' = ' + microjson.to_json(val) + '\n'
+        for key, note, sub in subs:
+            buf += _format_comment(';', note)
+            buf += sub._render(parent and '%s.%s' % (parent, key) or key)
+        if parent and (vals or not subs):
+            return ('\n[%s]\n' % parent) + buf
+        return buf
+
+    def __repr__(self):
+        return 'WaxChain(%s)' % ', '.join([repr(l) for l in self._layers])
+
+
+class WaxStruct(object):
+
+    '''
+    Base class of the frozen struct classes returned by Wax._to_struct().
+    Like namedtuple, methods and class attributes start with '_' so they
+    cannot clash with key names.  '_fields' lists the keys of the struct.
+    '''
+
+    __slots__ = ()
+    _fields = ()
+
+    # slot setters, used to populate instances
+    _setters = ()
+
+    @classmethod
+    def _make(cls, values):
+        "Return a new instance holding 'values' in field order."
+        obj = cls.__new__(cls)
+        for setter, val in zip(cls._setters, values):
+            setter(obj, val)
+        return obj
+
+    def __setattr__(self, key, val):
+        raise WaxError(E_READONLY % key)
+
+    def __delattr__(self, key):
+        raise WaxError(E_READONLY % key)
+
+    def __getitem__(self, key):
+        curr = self
+        for part in key.split('.'):
+            if part not in curr._fields:
+                raise KeyError(key)
+            curr = getattr(curr, part)
+        return curr
+
+    def __eq__(self, obj):
+        if not isinstance(obj, WaxStruct) or self._fields != obj._fields:
+            return False
+        for key in self._fields:
+            if getattr(self, key) != getattr(obj, key):
+                return False
+        return True
+
+    def __ne__(self, obj):
+        return not self.__eq__(obj)
+
+    def __repr__(self):
+        return 'WaxStruct(%s)' % ', '.join(['%s=%r' % (k, getattr(self, k))
+            for k in self._fields])
+
+    def _to_wax(self):
+        '''
+        Convert this struct and its nested structs back into a new Wax
+        instance.
+        '''
+        res = Wax()
+        for key in self._fields:
+            val = getattr(self, key)
+            if isinstance(val, WaxStruct):
+                val = val._to_wax()
+            else:
+                val = _copy_value(val)
+            res[key] = val
+        return res
+
+
+class WaxHolder(object):
+
+    '''
+    Holds the current version of a Wax tree, shared by many reader threads
+    and updated by occasional writers.
+
+    Readers take 'wax' without locking, and may keep using it as long as
+    they like: a version is never modified once published.  Writers build
+    the next version and publish it by replacing the reference, so readers
+    see either the old version or the new one.  apply(), set() and delete()
+    copy only the groups along the changed paths and share all others with
+    the previous version.  Published versions are therefore read-only:
+    setting or deleting a key in one raises WaxError, while Wax(version)
+    returns a copy which can be changed.  Writers are serialized by a lock
+    which readers never take.
+    '''
+
+    def __init__(self, wax=None):
+        self._lock = threading.Lock()
+        self._struct = None
+        if wax is None:
+            self.wax = _freeze(Wax())
+        else:
+            self.wax = _freeze(Wax(wax))
+
+    def snapshot(self):
+        '''
+        Return the current version as a frozen WaxStruct.  The struct is
+        converted once per version, on first use.
+        '''
+        wax = self.wax
+        cached = self._struct
+        if cached is None or cached[0] is not wax:
+            cached = self._struct = (wax, wax._to_struct())
+        return cached[1]
+
+    def apply(self, patch):
+        '''
+        Publish a new version with the WaxPatch 'patch' applied, and return
+        it.  If the patch fails the current version is kept.
+        '''
+        with self._lock:
+            top = self.wax
+            copied = {}
+            for op in patch:
+                path = op[1]
+                if op[0] not in ('order', 'comments'):
+                    path = '.' in path and path.rsplit('.', 1)[0] or ''
+                top = _path_copy(top, path, copied)
+            top._apply(patch)
+            self.wax = _freeze(top)
+        return self.wax
+
+    def set(self, path, val):
+        "Publish a new version with dotted 'path' set to a copy of 'val'."
+        return self.apply(WaxPatch([('add', path, val)]))
+
+    def delete(self, path):
+        "Publish a new version without dotted 'path'."
+        return self.apply(WaxPatch([('remove', path)]))
+
+    def update(self, func):
+        '''
+        Call 'func' with a complete copy of the current version to modify,
+        and publish a read-only copy of it once it returns.  Use this for
+        changes which are awkward to express as a patch.
+        '''
+        with self._lock:
+            top = Wax(self.wax)
+            func(top)
+            self.wax = _freeze(top)
+        return self.wax
+
+
+# Implementation details are below.  You shouldn't need these for 
+# typical uses of Wax.
+
+
+# per-thread transaction state, see _Transaction.
+_local = threading.local()
+
+# number of batches active on any thread. while zero, changes do not look
+# for the batch of the current thread.
+_batch_count = 0
+_batch_lock = threading.Lock()
+
+_MISSING = object()
+
+
+class _Transaction(object):
+
+    '''
+    Context manager which holds back subscription callbacks until the
+    outermost transaction on this thread exits, so that each subscriber
+    receives the changes made within it in a single call.
+    '''
+
+    def __enter__(self):
+        _local.depth = getattr(_local, 'depth', 0) + 1
+        return self
+
+    def __exit__(self, *exc):
+        _local.depth -= 1
+        if not _local.depth:
+            _flush()
+
+
+class _Batch(object):
+
+    "State of the batch active on a thread, see Wax._batch()."
+
+    def __init__(self):
+        # key names already validated
+        self.valid = set()
+        # id(node) -> (node, state before the batch)
+        self.saved = {}
+        # (node, key, action, group) changes to report to watchers
+        self.changes = []
+        self.last = None
+
+    def stage(self, node):
+        "Save the state of 'node' the first time it changes in this batch."
+        self.last = node
+        if id(node) not in self.saved:
+            state = dict(node.__dict__)
+            state['_key_order'] = list(node._key_order)
+            state['_annotations'] = dict(node._annotations)
+            state['_comments'] = dict(node._comments)
+            if node._interp is not None:
+                state['_interp'] = dict(node._interp)
+            self.saved[id(node)] = (node, state)
+
+    def commit(self):
+        if self.changes:
+            with _Transaction():
+                for change in self.changes:
+                    _notify(*change + (False,))
+
+    def rollback(self):
+        for node, state in self.saved.itervalues():
+            node.__dict__.clear()
+            node.__dict__.update(state)
+            node.__dict__.pop('_fp_cache', None)
+            for parent in node._ancestors():
+                parent._invalidate()
+        # watchers told of changes as they happened must see them undone
+        for change in self.changes:
+            _notify(*change + (True,))
+
+
+class _BatchContext(object):
+
+    "Context manager returned by Wax._batch()."
+
+    def __enter__(self):
+        global _batch_count
+        if getattr(_local, 'batch', None) is None:
+            self.batch = _local.batch = _Batch()
+            with _batch_lock:
+                _batch_count += 1
+        else:
+            self.batch = None
+        return self
+
+    def __exit__(self, exc_type, exc_val, tb):
+        global _batch_count
+        batch = self.batch
+        if batch is not None:
+            _local.batch = None
+            with _batch_lock:
+                _batch_count -= 1
+            if exc_type is None:
+                batch.commit()
+            else:
+                batch.rollback()
+
+
+def _staged(node):
+    '''
+    If a batch is active on this thread, save the state of 'node' so it can
+    be rolled back, and return the batch.
+    '''
+    if not _batch_count:
+        return None
+    batch = getattr(_local, 'batch', None)
+    if batch is not None:
+        batch.stage(node)
+    return batch
+
+
+def _queue(sub, change):
+    "Queue 'change' for delivery to subscription 'sub' by _flush()."
+    pending = getattr(_local, 'pending', None)
+    if pending is None:
+        pending = _local.pending = ([], {})
+    order, changes = pending
+    if sub in changes:
+        changes[sub].append(change)
+    else:
+        order.append(sub)
+        changes[sub] = [change]
+
+
+def _flush():
+    '''
+    Deliver queued changes to their subscribers.  The queue is emptied
+    before any callback runs, so changes made by a callback are queued
+    afresh.  Every subscriber is called even if an earlier one raises, and
+    the first error is raised once all have been called.
+    '''
+    pending = getattr(_local, 'pending', None)
+    _local.pending = None
+    if not pending:
+        return
+    error = None
+    order, changes = pending
+    for sub in order:
+        if not sub.active:
+            continue
+        try:
+            sub.callback(changes[sub])
+        except Exception:
+            if error is None:
+                error = sys.exc_info()
+    if error is not None:
+        raise error[0], error[1], error[2]
+
+
+def _notify(node, key, action, group, sync=None):
+    '''
+    Report a change to 'key' of 'node' to the watchers of the instance and
+    of each of its ancestors, along with the path of the key relative to
+    the watched instance.  'group' is true if a Wax instance was added or
+    removed, meaning keys below the path changed as well.
+
+    Watchers whose 'sync' attribute is true keep caches which must not go
+    stale while a batch holds back changes.  If 'sync' is given, only
+    watchers with a matching attribute are told.  Subscribers are called
+    once every watcher has been told, unless a transaction is open.
+    '''
+    stack = [(node, (key,))]
+    while stack:
+        node, parts = stack.pop()
+        if node._watchers:
+            for watcher in list(node._watchers):
+                if sync is None or watcher.sync == sync:
+                    watcher._wax_changed(parts, action, group)
+        if node._parents:
+            for ref, name in node._parents:
+                parent = ref()
+                if parent is not None and parent._watched and \
+                        parent.__dict__.get(name) is node:
+                    stack.append((parent, (name,) + parts))
+    if not getattr(_local, 'depth', 0):
+        _flush()
+
+
+def _set_watched(top):
+    '''
+    Mark 'top' and the groups below it as watched, so that their changes
+    are passed to _notify().  Marked groups are skipped, since everything
+    below them is marked already.
+    '''
+    stack = [top]
+    while stack:
+        node = stack.pop()
+        if node._watched:
+            continue
+        node._watched = True
+        d = node.__dict__
+        for key in node.keys():
+            val = d.get(key)
+            if isinstance(val, Wax):
+                stack.append(val)
+
+
+def _clear_watched(top):
+    '''
+    Undo _set_watched() for 'top' and the groups below it once the last
+    watcher of 'top' is removed.  Groups which have watchers, or are held
+    by another watched instance, stay marked.
+    '''
+    stack = [top]
+    while stack:
+        node = stack.pop()
+        if not node._watched or node._watchers:
+            continue
+        for parent in node._ancestors():
+            if parent._watched:
+                break
+        else:
+            del node.__dict__['_watched']
+            d = node.__dict__
+            for key in node.keys():
+                val = d.get(key)
+                if isinstance(val, Wax):
+                    stack.append(val)
+
+
+class _PathTrie(object):
+
+    '''
+    Maps dotted key patterns, given as tuples of segments, to items.  A
+    segment may be '*' to match any one key, or '**' to match any number
+    of keys.
+    '''
+
+    __slots__ = ('children', 'items', 'glob')
+
+    def __init__(self, glob=False):
+        self.children = {}
+        self.items = []
+        self.glob = glob
+
+    def add(self, parts, item):
+        node = self
+        for part in parts:
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = _PathTrie(part == '**')
+            node = child
+        node.items.append(item)
+
+    def remove(self, parts, item):
+        path = [self]
+        for part in parts:
+            node = path[-1].children.get(part)
+            if node is None:
+                return
+            path.append(node)
+        if item in path[-1].items:
+            path[-1].items.remove(item)
+        # prune nodes left empty
+        for i in range(len(parts), 0, -1):
+            node = path[i]
+            if node.items or node.children:
+                break
+            del path[i - 1].children[parts[i - 1]]
+
+    def match(self, parts, below=True):
+        '''
+        Return the items whose pattern matches the key path 'parts' or a
+        prefix of it.  If 'below' is true, items whose pattern extends the
+        path are returned as well.
+        '''
+        res = []
+        seen = set()
+
+        def _collect(node):
+            for item in node.items:
+                if id(item) not in seen:
+                    seen.add(id(item))
+                    res.append(item)
+
+        states = _glob_closure([self])
+        for part in parts:
+            nxt = []
+            for node in states:
+                _collect(node)
+                children = node.children
+                for name in (part, '*'):
+                    child = children.get(name)
+                    if child is not None:
+                        nxt.append(child)
+                if node.glob:
+                    nxt.append(node)
+            states = _glob_closure(nxt)
+            if not states:
+                return res
+
+        stack = list(states)
+        while stack:
+            node = stack.pop()
+            _collect(node)
+            if below:
+                stack.extend(node.children.values())
+        return res
+
+
+def _glob_closure(nodes):
+    "Add the '**' children of 'nodes', which can match zero keys."
+    res = []
+    seen = set()
+    while nodes:
+        node = nodes.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        res.append(node)
+        child = node.children.get('**')
+        if child is not None:
+            nodes.append(child)
+    return res
+
+
+class _SubscriptionIndex(object):
+
+    "Watcher which dispatches changes to the matching subscriptions."
+
+    sync = False
+
+    def __init__(self):
+        self.trie = _PathTrie()
+
+    def _wax_changed(self, parts, action, group):
+        change = (action, '.'.join(parts))
+        for sub in self.trie.match(parts, group):
+            _queue(sub, change)
+
+
+class _Subscription(object):
+
+    "Handle returned by Wax._subscribe()."
+
+    def __init__(self, node, index, parts, callback):
+        self.node = node
+        self.index = index
+        self.parts = parts
+        self.callback = callback
+        self.active = True
+
+    def cancel(self):
+        "Stop delivering changes to this subscription."
+        if self.active:
+            self.active = False
+            self.index.trie.remove(self.parts, self)
+            if not self.index.trie.children and not self.index.trie.items:
+                self.node._remove_watcher(self.index)
+
+
+class _CacheWatcher(object):
+
+    '''
+    Watcher which forwards changes to 'wax' to the _wax_changed() method of
+    'owner', a cache built from it.  It detaches itself once the owner goes
+    away, so that short-lived caches do not accumulate on the instance.
+    '''
+
+    sync = True
+
+    def __init__(self, owner, wax):
+        wax = weakref.ref(wax)
+
+        def _detach(ref):
+            node = wax()
+            if node is not None:
+                node._remove_watcher(self)
+        self.owner = weakref.ref(owner, _detach)
+
+    def _wax_changed(self, parts, action, group):
+        owner = self.owner()
+        if owner is not None:
+            owner._wax_changed(parts, action, group)
+
+
+class _Generation(object):
+
+    '''
+    Watcher counting the changes made to a Wax instance and its
+    sub-instances, see _generation().  Caches built from the instance note
+    the count and check it when used, rather than each attaching a watcher.
+    '''
+
+    sync = True
+
+    def __init__(self):
+        self.count = 0
+
+    def _wax_changed(self, parts, action, group):
+        self.count += 1
+
+
+def _generation(wax):
+    '''
+    Return the change counter of 'wax', attaching one on first use.  It
+    stays attached, so that later callers do not walk the tree again.
+    '''
+    for watcher in wax._watchers or ():
+        if isinstance(watcher, _Generation):
+            return watcher
+    gen = _Generation()
+    wax._add_watcher(gen)
+    return gen
+
+
+class _InterpolationIndex(object):
+
+    '''
+    Watcher which discards remembered interpolated values when a key they
+    reference changes, see Wax._interpolate().
+    '''
+
+    sync = True
+
+    def __init__(self, root):
+        self.root = root
+        # reference path -> interpolations using it
+        self.trie = _PathTrie()
+
+    def _wax_changed(self, parts, action, group):
+        stack = [parts]
+        while stack:
+            parts = stack.pop()
+            for entry in self.trie.match(parts):
+                # values referencing a discarded value are stale as well
+                if entry.invalidate():
+                    stack.append(entry.parts)
+
+
+class _Deferred(object):
+
+    '''
+    A list or dict value stored as its JSON text by parse_wax(), and kept in
+    the _interp mapping of its instance until it is first read.
+    '''
+
+    __slots__ = ('text', 'value', 'interner', 'typed_arrays')
+
+    _lock = threading.Lock()
+
+    def __init__(self, text, interner=None, typed_arrays=False):
+        self.text = text
+        self.value = None
+        self.interner = interner
+        self.typed_arrays = typed_arrays
+
+    @property
+    def raw(self):
+        return self.resolve()
+
+    def resolve(self):
+        "Decode the text the first time, then return the same value."
+        if self.text is None:
+            return self.value
+        with self._lock:
+            if self.text is not None:
+                stm = WaxStream(self.text)
+                stm.interner = self.interner
+                stm.typed_arrays = self.typed_arrays
+                try:
+                    self.value = microjson._from_json_raw(stm)
+                except microjson.JSONError, jexc:
+                    raise WaxError(E_JSON, stm, stm.pos, jexc)
+                self.text = None
+        return self.value
+
+
+class _Interpolation(object):
+
+    "A string value containing '${dotted.key}' references."
+
+    def __init__(self, index, node, key, parts, raw):
+        self.index = index
+        self.node = weakref.ref(node)
+        self.key = key
+        self.parts = parts
+        self.raw = raw
+        # bumped on invalidation so a resolution racing with a change is
+        # not remembered.
+        self.generation = 0
+        pieces = []
+        self.refs = []
+        pos = 0
+        for m in RE_REFERENCE.finditer(raw):
+            pieces.append(raw[pos:m.start()].replace('%', '%%'))
+            ref = m.group(1)
+            if ref is None:
+                pieces.append('$')
+            else:
+                self.refs.append(ref.encode('utf-8'))
+                pieces.append('%s')
+            pos = m.end()
+        pieces.append(raw[pos:].replace('%', '%%'))
+        self.format = ''.join(pieces)
+        self.whole = len(self.refs) == 1 and self.format == '%s'
+        self.getters = [_accessor(ref) for ref in self.refs]
+        # entries stay in the trie after the value is replaced, since a
+        # batch rollback can restore them.  invalidate() ignores them.
+        for ref in self.refs:
+            index.trie.add(tuple(ref.split('.')), self)
+
+    def resolve(self):
+        "Compute the value of this interpolation and remember it."
+        resolving = getattr(_local, 'resolving', None)
+        if resolving is None:
+            resolving = _local.resolving = set()
+        if self in resolving:
+            raise WaxError(E_CYCLE % '.'.join(self.parts))
+        generation = self.generation
+        root = self.index.root
+        vals = []
+        resolving.add(self)
+        try:
+            for ref, get in zip(self.refs, self.getters):
+                try:
+                    vals.append(get(root))
+                except KeyError:
+                    raise WaxError(E_REFERENCE % (ref, '.'.join(self.parts)))
+        finally:
+            resolving.discard(self)
+        if self.whole:
+            val = vals[0]
+        else:
+            val = self.format % tuple(vals)
+        node = self.node()
+        if node is not None and generation == self.generation and \
+                node._interp and node._interp.get(self.key) is self:
+            node.__dict__[self.key] = val
+        return val
+
+    def invalidate(self):
+        '''
+        Forget the remembered value, if any.  Returns true if there was one.
+        '''
+        self.generation += 1
+        node = self.node()
+        if node is None or not node._interp or \
+                node._interp.get(self.key) is not self:
+            return False
+        return node.__dict__.pop(self.key, _MISSING) is not _MISSING
+
+
+class _PathPattern(object):
+
+    "A compiled _select() pattern, matched one key at a time."
+
+    def __init__(self, pattern):
+        if not isinstance(pattern, str):
+            raise WaxError(E_KEYTYPE % (pattern, type(pattern)))
+        self.pattern = pattern
+        self.segs = []
+        for seg in pattern.split('.'):
+            if seg in ('*', '**'):
+                self.segs.append(seg)
+                continue
+            if not seg.strip('*?[]!-'):
+                raise WaxError(E_PATTERN % pattern)
+            if '*' in seg or '?' in seg or '[' in seg:
+                self.segs.append(re.compile(fnmatch.translate(seg)).match)
+                continue
+            try:
+                validate_key(seg)
+            except WaxError:
+                raise WaxError(E_PATTERN % pattern)
+            self.segs.append(seg)
+        self.end = len(self.segs)
+        self.start = self._closure([0])
+        # key names every match contains
+        self.names = [seg for seg in self.segs
+            if isinstance(seg, str) and seg not in ('*', '**')]
+        # predicate for the last key name of a match, if it is a wildcard
+        self.last = None
+        if not isinstance(self.segs[-1], str):
+            self.last = self.segs[-1]
+
+    def _closure(self, states):
+        "Add the states reached by letting '**' match no keys."
+        res = []
+        for i in states:
+            while i not in res:
+                res.append(i)
+                if i < self.end and self.segs[i] == '**':
+                    i += 1
+        return tuple(sorted(res))
+
+    def step(self, states, key):
+        "Return the states reached from 'states' by matching 'key'."
+        nxt = []
+        for i in states:
+            if i == self.end:
+                continue
+            seg = self.segs[i]
+            if seg == '**':
+                nxt.append(i)
+            elif seg == '*' or seg == key or (
+                    not isinstance(seg, str) and seg(key)):
+                nxt.append(i + 1)
+        return nxt and self._closure(nxt)
+
+    def run(self, parts):
+        "Return the states reached by matching the keys 'parts'."
+        states = self.start
+        for part in parts:
+            states = self.step(states, part)
+            if not states:
+                break
+        return states
+
+
+def _select_paths(top, pattern, prefix='', states=None):
+    '''
+    Implementation of Wax._select() without an index.  The keys of 'top'
+    are matched starting from 'states', and have 'prefix' prepended to
+    their paths.
+    '''
+    end = pattern.end
+    stack = [(top, prefix, states or pattern.start, iter(top.keys()))]
+    while stack:
+        node, prefix, states, keys = stack[-1]
+        for key in keys:
+            nxt = pattern.step(states, key)
+            if not nxt:
+                continue
+            interp = node._interp
+            if interp and key in interp:
+                val = interp[key].resolve()
+                group = False
+            else:
+                val = node.__dict__[key]
+                group = isinstance(val, Wax)
+            path = prefix + key
+            if nxt[-1] == end:
+                yield path, val
+            if group and nxt[0] < end:
+                stack.append((val, path + '.', nxt, iter(val.keys())))
+                break
+        else:
+            stack.pop()
+
+
+class _KeyIndex(object):
+
+    '''
+    Watcher which maps key names to the paths of the keys with that name,
+    see Wax._select().  Paths are added as keys are set, while the paths of
+    removed keys are dropped by select() when it finds them missing.
+    '''
+
+    sync = True
+
+    def __init__(self, root):
+        self.root = root
+        self.paths = {}
+        self._add(root, ())
+
+    def _add(self, node, prefix):
+        "Add the paths of 'node' and its sub-instances."
+        paths = self.paths
+        stack = [(node, prefix)]
+        while stack:
+            node, prefix = stack.pop()
+            d = node.__dict__
+            interp = node._interp
+            for key in node.keys():
+                path = prefix + (key,)
+                tmp = paths.get(key)
+                if tmp is None:
+                    tmp = paths[key] = set()
+                tmp.add(path)
+                val = d.get(key)
+                if isinstance(val, Wax) and not (interp and key in interp):
+                    stack.append((val, path))
+
+    def _wax_changed(self, parts, action, group):
+        if action != 'set':
+            return
+        node = self._lookup(parts)
+        if node is None:
+            return
+        tmp = self.paths.get(parts[-1])
+        if tmp is None:
+            tmp = self.paths[parts[-1]] = set()
+        tmp.add(parts)
+        if group:
+            val = node.__dict__.get(parts[-1])
+            if isinstance(val, Wax):
+                self._add(val, parts)
+
+    def _lookup(self, parts):
+        '''
+        Return the instance holding the key at 'parts', or None if the key
+        does not exist.
+        '''
+        node = self.root
+        for part in parts[:-1]:
+            if node._interp and part in node._interp:
+                return None
+            node = node.__dict__.get(part)
+            if not isinstance(node, Wax):
+                return None
+        key = parts[-1]
+        if key in node.__dict__ or (node._interp and key in node._interp):
+            return node
+        return None
+
+    def select(self, pattern):
+        if pattern.names:
+            # start from the least common name, matches continue below it
+            name = min(pattern.names,
+                key=lambda n: len(self.paths.get(n, ())))
+            return self._select(pattern, [name], False)
+        names = [k for k in self.paths.keys() if pattern.last(k)]
+        return self._select(pattern, names, True)
+
+    def _select(self, pattern, names, last):
+        '''
+        Yield the matches found at, or if 'last' is false also below, the
+        keys with the given names.
+        '''
+        end = pattern.end
+        seen = set()
+        for name in names:
+            paths = self.paths.get(name)
+            if not paths:
+                continue
+            for path in list(paths):
+                node = self._lookup(path)
+                if node is None:
+                    paths.discard(path)
+                    continue
+                states = pattern.run(path)
+                if not states:
+                    continue
+                dotted = '.'.join(path)
+                val = node[name]
+                if states[-1] == end and dotted not in seen:
+                    seen.add(dotted)
+                    yield dotted, val
+                if last or states[0] == end or not isinstance(val, Wax) or \
+                        (node._interp and name in node._interp):
+                    continue
+                for res in _select_paths(val, pattern, dotted + '.', states):
+                    if res[0] not in seen:
+                        seen.add(res[0])
+                        yield res
 
-        # '; annotation text'
-        elif c == ';':
-            stm.next()
-            pos = stm.pos
-            stm.skipto('\n')
-            annotation += stm.substr(pos, stm.pos - pos) + '\n'
-            stm.next()
+
+class WaxStream(microjson.JSONStream):
+
+    # if false, comments and annotations are skipped rather than stored.
+    keep_comments = True
+
+    # if true, list and dict values are stored undecoded, see _Deferred.
+    defer_values = False
+
+    # if a list, the (offset, group) of each group declaration parsed is
+    # appended to it.
+    declarations = None
+
+    # if a list, the (key, offset, value start, value end) of each key
+    # assignment parsed is appended to it.
+    assignments = None
+
+    @property
+    def lineno(self):
+        "Line number of the read pointer, only needed for error messages."
+        return self.getvalue().count('\n', 0, self.pos) + 1
+
+    def skipto(self, ch):
+        "post-cond: read pointer will be over first occurrance of 'ch'"
+        pos = self.getvalue().find(ch, self.pos)
+        if pos < 0:
+            pos = self.len
+        self.seek(pos)
+
+    def skipspaces(self):
+        "post-cond: read pointer will be over first non-WS char"
+        self._pos = RE_SPACES.match(self._data, self._pos).end()
+
+    def skipvalue(self):
+        '''
+        post-cond: read pointer will be after the list or dict starting at
+        the read pointer, whose text is returned.  Only strings and brackets
+        are examined, so the contents are not validated.
+        '''
+        data = self.getvalue()
+        match = RE_NESTING.match
+        start = pos = self.pos
+        depth = 0
+        while True:
+            m = match(data, pos)
+            tok = m.group(1)
+            pos = m.end()
+            if tok == '[' or tok == '{':
+                depth += 1
+            elif tok == ']' or tok == '}':
+                depth -= 1
+                if not depth:
+                    self.seek(pos)
+                    return data[start:pos]
+            else:
+                raise microjson.JSONError(microjson.E_TRUNC, self, start)
+
+
+def validate_key(key):
+    '''
+    Checks if a key is valid.  Caller must handle splitting dotted keys
+    and calling this with each part.
+    '''
+    if not RE_KEYVALID.match(key):
+        raise WaxError(E_BADKEY % key)
+    if key in BAD_KEY_NAMES:
+        raise WaxError(E_KEYNAME % key)
+
+
+def parse_dotted(stm):
+    # skip '['
+    stm.next()
+    pos = stm.pos
+    group = None
+    m = RE_GROUP.match(stm.getvalue(), pos)
+    if m is not None:
+        # a well-formed name, so go straight to the ']'
+        stm.seek(m.end() - 1)
+    while True:
+        c = stm.next()
+        if c in GRPVALID:
+            continue
+
+        # end of group
+        elif c == ']':
+            group = stm.substr(pos, stm.pos - pos - 1)
+            break
+
+        elif c == '':
+            raise WaxError(E_TRUNC, stm, stm.pos)
+
+        partial = stm.substr(pos, stm.pos - pos)
+        raise WaxError(E_GROUP % partial, stm, stm.pos)
+    stm.skipto('\n')
+    return pos, group
+
+
+def parse_group(stm, top, annotation=None):
+    pos, group = parse_dotted(stm)
+    if stm.declarations is not None:
+        stm.declarations.append((pos - 1, group))
+    # create a path to the group from the top instance.
+    prev = curr = top
+    parts = group.split('.')
+    for part in parts:
+        if part in BAD_KEY_NAMES:
+            raise WaxError(E_KEYNAME % part, stm, pos)
+        part = intern(part)
+        if part not in curr.__dict__ and \
+                not (curr._interp and part in curr._interp):
+            curr[part] = Wax()
+        prev = curr
+        curr = curr[part]
+        if not isinstance(curr, Wax):
+            raise WaxError(E_SELECT % group, stm, pos)
+    stm.next()
+    if annotation is not None:
+        prev._set_annotation(parts[-1], annotation.decode('utf-8'))
+    return curr
+
+
+def parse_keyval(stm, dest, annotation=None):
+    "Parse an INI key/value pair, where the value is a JSON type."
+    pos = stm.pos
+    key = None
+    m = RE_KEYVAL.match(stm.getvalue(), pos)
+    if m is not None:
+        # a well-formed key, so go straight to the '='
+        stm.seek(m.end() - 1)
+    while True:
+        c = stm.next()
+        if c == '':
+            raise WaxError(E_TRUNC, stm, stm.pos - 1)
+
+        elif c in microjson.WS:
+            continue
+
+        # parse "key = <json>"
+        elif c == '=':
+            key = stm.substr(pos, stm.pos - pos - 1)
+            key = key.strip()
+            stm.skipspaces()
+            c = stm.peek()
+            start = stm.pos
+            val = None
+            try:
+                if stm.defer_values and (c == '[' or c == '{'):
+                    val = _Deferred(stm.skipvalue(), stm.interner,
+                        stm.typed_arrays)
+                else:
+                    val = microjson._from_json_raw(stm)
+            except microjson.JSONError, jexc:
+                raise WaxError(E_JSON, stm, stm.pos, jexc)
+            try:
+                setattr(dest, key, val)
+            except WaxError, exc:
+                raise WaxError(str(exc), stm, stm.pos)
+            if annotation is not None:
+                dest._set_annotation(key, annotation.decode('utf-8'))
+            if stm.assignments is not None:
+                stm.assignments.append((key, pos, start, stm.pos))
+            break
+
+        elif c not in KEYVALID and c != '.':
+            key = stm.substr(pos, stm.pos - pos - 1)
+            raise WaxError(E_BADKEY % key, stm, stm.pos - 1)
+    return key
+
+
+def parse_wax_raw(stm, top):
+    keep = stm.keep_comments
+    comment = ''
+    annotation = ''
+    if not keep:
+        # tells parse_group and parse_keyval not to set annotations
+        annotation = None
+    curr = top
+    while True:
+        stm.skipspaces()
+        c = stm.peek()
+        if c != '#' and comment:
+            curr._add_comment(comment.decode('utf-8'))
+            comment = ''
+
+        # end of stream
+        if c == '':
+            return top
+
+        # [dotted.group]
+        elif c == '[':
+            curr = parse_group(stm, top, annotation)
+            if annotation:
+                annotation = ''
+
+        # skip comments and annotations without storing them
+        elif not keep and (c == '#' or c == ';'):
+            stm.skipto('\n')
+            stm.next()
+
+        # '# comment text'
+        elif c == '#':
+            stm.next()
+            pos = stm.pos
+            stm.skipto('\n')
+            comment += stm.substr(pos, stm.pos - pos) + '\n'
+            stm.next()
+
+        # '; annotation text'
+        elif c == ';':
+            stm.next()
+            pos = stm.pos
+            stm.skipto('\n')
+            annotation += stm.substr(pos, stm.pos - pos) + '\n'
+            stm.next()
 
         # 'key = "val"'
         elif c in KEYSTART:
             # parse key, val pair where val is a json type
             parse_keyval(stm, curr, annotation)
-            annotation = ''
+            if annotation:
+                annotation = ''
 
         # illegal char
         else:
             raise WaxError(E_MALF, stm, stm.pos)
 
 
+class _ListWriter(object):
+
+    "Minimal stream which collects written strings in a list."
+
+    def __init__(self, buf):
+        self.write = buf.append
+
+
+def _compile_format(fmt):
+    '''
+    Split a '%(dotted.key)s' format string into an equivalent positional
+    format and a list of accessors, one per conversion.
+    '''
+    pieces = []
+    getters = []
+    accessors = {}
+    pos = 0
+    for m in RE_FORMAT.finditer(fmt):
+        text = fmt[pos:m.start()]
+        if '%' in text:
+            raise WaxError(E_FORMAT % fmt)
+        pieces.append(text)
+        key, spec = m.group(1), m.group(2)
+        if spec == '%':
+            pieces.append('%%')
+        elif key is None:
+            raise WaxError(E_FORMAT % fmt)
+        else:
+            if key not in accessors:
+                accessors[key] = _accessor(key)
+            getters.append(accessors[key])
+            pieces.append('%' + spec)
+        pos = m.end()
+    if '%' in fmt[pos:]:
+        raise WaxError(E_FORMAT % fmt)
+    pieces.append(fmt[pos:])
+    return ''.join(pieces), getters
+
+
+def _accessor(path):
+    "Return a function which looks up dotted 'path' like Wax.__getitem__."
+    parts = path.split('.')
+    for part in parts:
+        validate_key(part)
+    last = parts.pop()
+    if not parts:
+        def get(obj):
+            try:
+                return obj.__dict__[last]
+            except KeyError:
+                return obj._resolve(last)
+        return get
+
+    def get(obj):
+        for part in parts:
+            if isinstance(obj, Wax):
+                try:
+                    obj = obj.__dict__[part]
+                except KeyError:
+                    obj = obj._resolve(part)
+            else:
+                obj = obj[part]
+            if not isinstance(obj, (Wax, dict, UserDict.DictMixin)):
+                raise WaxError(E_SELECT % path)
+        if isinstance(obj, Wax):
+            try:
+                return obj.__dict__[last]
+            except KeyError:
+                return obj._resolve(last)
+        return obj[last]
+    return get
+
+
+# field names -> generated WaxStruct subclass
+_struct_classes = {}
+
+
+def _struct_class(fields):
+    "Return the WaxStruct subclass with the given field names."
+    cls = _struct_classes.get(fields)
+    if cls is None:
+        cls = type('WaxStruct', (WaxStruct,), {'__slots__': fields,
+            '_fields': fields})
+        cls._setters = tuple([cls.__dict__[k].__set__ for k in fields])
+        cls = _struct_classes.setdefault(fields, cls)
+    return cls
+
+
+def _build_struct(node, desc):
+    '''
+    Implementation of Wax._to_struct().  'desc' is the schema description
+    of 'node', or None.
+    '''
+    described = {}
+    if desc and desc.get('fields'):
+        described = desc['fields']
+        fields = tuple(sorted(described))
+    elif desc and (desc.get('patterns') or desc.get('type') == 'group'):
+        # only named keys can become slots
+        fields = ()
+    else:
+        described = None
+        fields = tuple(node.keys())
+    vals = []
+    d = node.__dict__
+    for key in fields:
+        if key in d:
+            val = d[key]
+        else:
+            # errors resolving interpolated values are raised, only keys
+            # missing from a described group become None
+            try:
+                val = node._resolve(key)
+            except KeyError:
+                val = None
+        if isinstance(val, Wax):
+            sub = described and described.get(key)
+            if isinstance(sub, Wax):
+                sub = sub._to_dict()
+            val = _build_struct(val, sub)
+        else:
+            val = _copy_value(val)
+        vals.append(val)
+    return _struct_class(fields)._make(vals)
+
+
+def _merged_order(layers):
+    '''
+    Return the keys and comments of 'layers' in the order merging them with
+    '+=' would give them.  As in _deep_copy, each layer's comments replace
+    those of the layers below.  Comments are (layer, index) pairs.
+    '''
+    order = []
+    seen = set()
+    for layer in layers:
+        order = [k for k in order if not isinstance(k, tuple)]
+        for key in layer._key_order:
+            if isinstance(key, int):
+                order.append((layer, key))
+            elif key not in seen:
+                seen.add(key)
+                order.append(key)
+    return order
+
+
+# Types of list values: plain lists and the typed arrays of parse_wax().
+_LISTS = (list, array.array)
+
+
+def _merge_lists(lists, unique):
+    '''
+    Concatenate 'lists'.  If 'unique' is true, items of later lists which
+    are already present are skipped.
+    '''
+    res = list(lists[0])
+    if not unique:
+        for val in lists[1:]:
+            res.extend(val)
+        return res
+    seen = set()
+    for item in res:
+        try:
+            seen.add(item)
+        except TypeError:
+            pass
+    for val in lists[1:]:
+        for item in val:
+            try:
+                if item in seen:
+                    continue
+                seen.add(item)
+            except TypeError:
+                # unhashable, fall back to a scan
+                if item in res:
+                    continue
+            res.append(item)
+    return res
+
+
+def _copy_value(val):
+    '''
+    Copy a value before storing it in another Wax tree, so that the two
+    trees share no mutable values.
+    '''
+    if isinstance(val, Wax):
+        return Wax(val)
+    elif isinstance(val, dict):
+        return val.copy()
+    elif isinstance(val, list):
+        return list(val)
+    elif isinstance(val, array.array):
+        return val[:]
+    return val
+
+
+def _shallow_copy(node):
+    "Return a copy of the group 'node' which shares its values."
+    res = Wax()
+    res._key_order = list(node._key_order)
+    res._annotations = node._annotations.copy()
+    res._comments = node._comments.copy()
+    res._comment_index = node._comment_index
+    d = res.__dict__
+    get = node._getter()
+    for key in node.keys():
+        val = d[key] = get(key)
+        if isinstance(val, Wax):
+            res._link(key, val)
+    return res
+
+
+class _FrozenWax(Wax):
+
+    '''
+    Class of the read-only instances published by WaxHolder, see _freeze().
+    Reading is unchanged, while every change raises WaxError.
+    '''
+
+    def __setattr__(self, key, val):
+        if isinstance(key, str) and key[:1] == '_':
+            self.__dict__[key] = val
+            return
+        raise WaxError(E_READONLY % key)
+
+    def _remove_key(self, key):
+        raise WaxError(E_READONLY % key)
+
+    def _set_annotation(self, key, text):
+        raise WaxError(E_READONLY % key)
+
+    def _remove_annotation(self, key):
+        raise WaxError(E_READONLY % key)
+
+    def _frozen(self, *args):
+        raise WaxError(E_FROZEN)
+
+    __iadd__ = _add_comment = _clear_comments = _frozen
+    _apply_ops = _interpolate = _frozen
+
+
+def _freeze(top):
+    '''
+    Return a read-only copy of 'top' and the groups below it.  Groups which
+    are read-only already, such as those shared with a previous version,
+    are shared rather than copied.  Instances passed in are left writable,
+    since the caller may still hold some of them.
+    '''
+    if top.__class__ is _FrozenWax:
+        return top
+    top = _shallow_copy(top)
+    stack = [top]
+    while stack:
+        node = stack.pop()
+        object.__setattr__(node, '__class__', _FrozenWax)
+        d = node.__dict__
+        for key in node.keys():
+            val = d.get(key)
+            if isinstance(val, Wax) and val.__class__ is not _FrozenWax:
+                val = d[key] = _shallow_copy(val)
+                node._link(key, val)
+                stack.append(val)
+    return top
+
+
+def _path_copy(top, path, copied):
+    '''
+    Return a copy of 'top' in which the groups along dotted 'path' are
+    copies too, sharing every other group with 'top'.  'copied' maps the
+    id of each copy made to the copy, so that repeated calls for the same
+    new version copy each group once.
+    '''
+    if id(top) not in copied:
+        top = _shallow_copy(top)
+        copied[id(top)] = top
+    curr = top
+    for part in path and path.split('.') or ():
+        child = curr.__dict__.get(part)
+        if not isinstance(child, Wax):
+            break
+        if id(child) not in copied:
+            child = _shallow_copy(child)
+            copied[id(child)] = child
+            curr.__dict__[part] = child
+            curr._link(part, child)
+        curr = child
+    return top
+
+
+# Types of the values shared by the 'intern_values' options.
+_INTERN_TYPES = (str, unicode, int, long)
+
+
+def _value_interner(table):
+    '''
+    Return a function mapping each str, unicode or integer value to the
+    first equal value of the same type it was given, recording them in
+    'table' if it is a dict.  Other values are returned as they are.
+    Returns None if 'table' is False or None, meaning no interning.
+    '''
+    if table is False or table is None:
+        return None
+    if not isinstance(table, dict):
+        table = {}
+    setdefault = table.setdefault
+
+    def intern_value(val):
+        if isinstance(val, _INTERN_TYPES):
+            return setdefault((type(val), val), val)
+        return val
+    return intern_value
+
+
+# Optional per-instance state, counted by _memory_usage() as part of a node
+# and left out when pickling.
+_NODE_ATTRS = ('_fp_cache', '_interp', '_parents', '_watched', '_watchers')
+
+
+def _measure(top, deep, unique):
+    "Implementation of Wax._memory_usage()."
+    getsizeof = sys.getsizeof
+    seen = set()
+
+    def size(obj):
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        return getsizeof(obj)
+
+    if not unique:
+        size = getsizeof
+
+    res = {}
+    stack = [('', top)]
+    while stack:
+        path, node = stack.pop()
+        d = node.__dict__
+        used = size(node) + size(d) + size(node._key_order) + \
+            size(node._annotations) + size(node._comments)
+        for name in _NODE_ATTRS:
+            if name in d:
+                used += size(d[name])
+        keys = 0
+        values = 0
+        groups = []
+        get = node._getter()
+        interp = node._interp
+        prefix = path and path + '.' or ''
+        for key in node.keys():
+            keys += size(key)
+            entry = interp and interp.get(key)
+            if isinstance(entry, _Deferred) and entry.text is not None:
+                # count the text of values which have not been decoded
+                values += size(entry) + size(entry.text)
+                continue
+            val = get(key)
+            if isinstance(val, Wax):
+                groups.append((prefix + key, val))
+                continue
+            values += size(val)
+            if deep and isinstance(val, (list, dict)):
+                nested = [val]
+                while nested:
+                    obj = nested.pop()
+                    if isinstance(obj, dict):
+                        items = obj.items()
+                        obj = [k for k, v in items] + [v for k, v in items]
+                    for item in obj:
+                        values += size(item)
+                        if isinstance(item, (list, dict)):
+                            nested.append(item)
+        comments = 0
+        for text in node._comments.itervalues():
+            comments += size(text)
+        annotations = 0
+        for text in node._annotations.itervalues():
+            annotations += size(text)
+        res[path] = {'node': used, 'keys': keys, 'values': values,
+            'comments': comments, 'annotations': annotations}
+        if deep:
+            groups.reverse()
+            stack.extend(groups)
+    return res
+
+
+def _value_kind(val):
+    "Classify a value for comparison, treating int/long and str/unicode alike."
+    if isinstance(val, bool):
+        return bool
+    elif isinstance(val, (int, long)):
+        return int
+    elif isinstance(val, basestring):
+        return basestring
+    return type(val)
+
+
+def _same_value(lt, rt):
+    return lt is rt or (_value_kind(lt) is _value_kind(rt) and lt == rt)
+
+
+def _comment_layout(node):
+    '''
+    Return the comments of 'node' as a list of (key, text) pairs, where key
+    is the key preceding the comment or None.
+    '''
+    res = []
+    anchor = None
+    for key in node._key_order:
+        if isinstance(key, int):
+            res.append((anchor, node._comments.get(key, '')))
+        else:
+            anchor = key
+    return res
+
+
+def _set_comment_layout(node, layout):
+    '''
+    Replace the comments of 'node' with those in 'layout'.  Comments whose
+    key no longer exists are placed at the end.
+    '''
+    keys = node.keys()
+    node._clear_comments()
+    after = {}
+    for anchor, text in layout:
+        if anchor is not None and anchor not in keys:
+            anchor = ''
+        after.setdefault(anchor, []).append(text)
+    order = []
+    for key in [None] + keys + ['']:
+        if key:
+            order.append(key)
+        for text in after.get(key, ()):
+            idx = node._comment_index
+            node._comment_index += 1
+            node._comments[idx] = text
+            order.append(idx)
+    node._key_order = order
+    node._invalidate()
+
+
+def _diff_groups(lt, rt, prefix, ops, annotations, comments):
+    '''
+    Implementation of Wax._diff().  Appends the operations transforming 'lt'
+    into 'rt' to 'ops'.
+    '''
+    lget = lt._getter()
+    rget = rt._getter()
+    lkeys = lt.keys()
+    rkeys = rt.keys()
+    lset = set(lkeys)
+    rset = set(rkeys)
+    order = []
+    for key in lkeys:
+        if key in rset:
+            order.append(key)
+        else:
+            ops.append(('remove', prefix + key))
+    for key in rkeys:
+        path = prefix + key
+        rval = rget(key)
+        if key not in lset:
+            order.append(key)
+            ops.append(('add', path, rval))
+        else:
+            lval = lget(key)
+            if isinstance(lval, Wax) and isinstance(rval, Wax):
+                if lval is not rval:
+                    digest = lval._cached_fingerprint(annotations, comments)
+                    if not digest or digest != \
+                            rval._cached_fingerprint(annotations, comments):
+                        _diff_groups(lval, rval, path + '.', ops, annotations,
+                            comments)
+            elif not _same_value(lval, rval):
+                ops.append(('change', path, lval, rval))
+        if annotations:
+            note = rt._annotations.get(key, '')
+            if note != lt._annotations.get(key, ''):
+                ops.append(('annotate', path, note))
+    group = prefix[:-1]
+    if order != rkeys:
+        ops.append(('order', group, rkeys))
+    if comments:
+        layout = _comment_layout(rt)
+        if layout != _comment_layout(lt):
+            ops.append(('comments', group, layout))
+
+
+def _encode_patch_value(obj, name, wax_name, val):
+    if isinstance(val, Wax):
+        obj[wax_name] = str(val).decode('utf-8')
+    else:
+        obj[name] = val
+
+
+def _decode_patch_value(obj, name, wax_name):
+    if wax_name in obj:
+        return parse_wax(obj[wax_name].encode('utf-8'))
+    return obj[name]
+
+
+def _hash_text(h, tag, text):
+    "Feed a tagged, length-prefixed string into hash 'h'."
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    h.update('%s%d:' % (tag, len(text)))
+    h.update(text)
+
+
+def _hash_value(h, val):
+    '''
+    Feed a JSON value into hash 'h'.  Values of different types hash
+    differently, except for int and long, and for str and unicode text
+    which compare equal.  Returns True if the value is mutable or not equal
+    to itself, meaning the resulting digest must not be cached.
+    '''
+    if val is None:
+        h.update('n')
+    elif isinstance(val, bool):
+        h.update(val and 't' or 'f')
+    elif isinstance(val, (int, long)):
+        h.update('i%d;' % val)
+    elif isinstance(val, float):
+        h.update('f%r;' % val)
+        # NaN
+        return val != val
+    elif isinstance(val, str):
+        _hash_text(h, 's', val)
+    elif isinstance(val, unicode):
+        text = val.encode('utf-8')
+        if len(text) == len(val):
+            # ASCII, so equal to the same text as a str
+            _hash_text(h, 's', text)
+        else:
+            _hash_text(h, 'u', text)
+    elif isinstance(val, array.array):
+        h.update('a%s%d;' % (val.typecode, len(val)))
+        h.update(val.tostring())
+        return True
+    elif isinstance(val, (list, tuple)):
+        if isinstance(val, tuple):
+            h.update('p%d;' % len(val))
+        else:
+            h.update('l%d;' % len(val))
+        for elem in val:
+            _hash_value(h, elem)
+        return True
+    elif isinstance(val, dict):
+        h.update('d%d;' % len(val))
+        for key in sorted(val):
+            _hash_value(h, key)
+            _hash_value(h, val[key])
+        return True
+    else:
+        # other objects only hash alike if they are the same object
+        h.update('o%d;' % id(val))
+        return True
+    return False
+
+
 def _format_comment(delim, text):
     '''
     Format a comment / annotation, ensuring there is at least one space
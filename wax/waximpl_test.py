@@ -5,11 +5,18 @@
 
 
 # std
+import array
+import hashlib
+import pickle
+import sys
+import threading
+import time
 import unittest
 import UserDict
 
 # local
-from waximpl import parse_wax, wax_to_dict, Wax, WaxError, BAD_KEY_NAMES
+from waximpl import parse_wax, wax_to_dict, Wax, WaxChain, WaxError, \
+    WaxHolder, WaxPatch, WaxStruct, WaxTemplate, BAD_KEY_NAMES
 
 
 # Pychecker suppressions:
@@ -20,6 +27,23 @@ from waximpl import parse_wax, wax_to_dict, Wax, WaxError, BAD_KEY_NAMES
 __pychecker__ = 'no-objattrs maxrefs=20 no-constattr'
 
 
+class _OrderedDict(dict):
+
+    "Remembers insertion order, as collections.OrderedDict does in 2.7."
+
+    def __init__(self):
+        dict.__init__(self)
+        self.order = []
+
+    def __setitem__(self, key, val):
+        if key not in self:
+            self.order.append(key)
+        dict.__setitem__(self, key, val)
+
+    def keys(self):
+        return list(self.order)
+
+
 class TestWax(unittest.TestCase):
 
     """
@@ -73,6 +97,56 @@ class TestWax(unittest.TestCase):
         self.assertEquals(wx.bb.cc, 2)
         self.assertEquals(wx.bb.dd, 3)
 
+    def test_from_items(self):
+        items = [('b', 1), ('a.y', 2), ('a.x', Wax(z=3)), ('a.x.w', 4),
+            ('c', [1, 2]), ('b', 5)]
+        w = Wax.from_items(items)
+        self.assertEquals(w.keys(), ['b', 'a', 'c'])
+        self.assertEquals(w.a.keys(), ['y', 'x'])
+        self.assertEquals(w.a.x.keys(), ['z', 'w'])
+        self.assertEquals(w.b, 5)
+        exp = Wax()
+        for key, val in items:
+            exp[key] = val
+        self.assertEquals(str(w), str(exp))
+
+        # key names are shared between groups
+        w = Wax.from_items([('one.' + 'host', 1), ('two.' + 'host', 2)])
+        self.assertTrue(w.one.keys()[0] is w.two.keys()[0])
+
+        # replacing a group
+        w = Wax.from_items([('a.b.c', 1), ('a.b', 2), ('a.b', Wax()),
+            ('a.b.d', 3)])
+        self.assertEquals(w, Wax(a=Wax(b=Wax(d=3))))
+
+        # groups passed in are copied, not written into
+        v = Wax(x=1)
+        v._fingerprint()
+        res = []
+        v._subscribe('**', res.append)
+        w = Wax.from_items([('a', v), ('a.y', 2)])
+        self.assertEquals(w.a, Wax(x=1, y=2))
+        self.assertFalse(w.a is v)
+        self.assertEquals(v.keys(), ['x'])
+        self.assertEquals(v, Wax(x=1))
+        self.assertEquals(res, [])
+
+        # a group may share the name of the classmethod
+        w = Wax.from_items([('from_items.x', 1), ('from_items.y', 2)])
+        self.assertEquals(w.from_items, Wax(x=1, y=2))
+        w = parse_wax('[from_items]\nx = 1\n')
+        w['from_items.y'] = 2
+        self.assertEquals(w.from_items, Wax(x=1, y=2))
+
+        # a classmethod, so a key of the same name does not hide it
+        w = Wax.from_items([('from_items', 1)])
+        self.assertEquals(w.from_items, 1)
+
+        self.assertRaises(WaxError, Wax.from_items, [('a', 1), ('a.b', 2)])
+        self.assertRaises(WaxError, Wax.from_items, [('bad-key', 1)])
+        self.assertRaises(WaxError, Wax.from_items, [('a.keys', 1)])
+        self.assertRaises(WaxError, Wax.from_items, [(1, 1)])
+
     def test_annotations(self):
         inp = '; one\n; two\n[foo]\n; three\nval1 = 123'
         w = parse_wax(inp)
@@ -219,6 +293,188 @@ class TestWax(unittest.TestCase):
         res = Wax(sub=Wax(y=2))
         self.assertEquals(res, w1 - w2)
 
+    def test_diff(self):
+        w1 = parse_wax(WELLFORMED)
+        w2 = Wax(w1)
+        self.assertEquals(len(w1._diff(w2)), 0)
+
+        w2.num = 456
+        w2.one.two.extra = [1, 2]
+        del w2.a.b.c.num
+        w2.level1._set_annotation('level2', 'new note')
+        w2.one._add_comment('new comment')
+        patch = w1._diff(w2)
+        self.assertEquals(patch.ops[:4], [
+            ('change', 'num', 123, 456),
+            ('add', 'one.two.extra', [1, 2]),
+            ('comments', 'one', [('baz', 'new comment')]),
+            ('remove', 'a.b.c.num'),
+            ])
+        self.assertEquals(patch.ops[4][:2], ('annotate', 'level1.level2'))
+
+        # applying the patch makes the trees identical
+        w1._apply(patch)
+        self.assertEquals(str(w1), str(w2))
+        self.assertEquals(len(w1._diff(w2)), 0)
+
+        # key order and annotations can be ignored
+        w1 = Wax()
+        w1.a = 1
+        w1.b = 2
+        w2 = Wax()
+        w2.b = 2
+        w2.a = 1
+        w2._set_annotation('a', 'note')
+        self.assertEquals(w1._diff(w2).ops,
+            [('annotate', 'a', 'note'), ('order', '', ['b', 'a'])])
+        self.assertEquals(len(w1._diff(w2, annotations=False)), 1)
+        self.assertEquals(w1._apply(w1._diff(w2)).keys(), ['b', 'a'])
+
+        self.assertRaises(WaxError, w1._diff, {'a': 1})
+        self.assertRaises(WaxError, w1._apply, [('bogus', 'a')])
+
+        # keys may share the names of the methods
+        w1 = parse_wax('diff = 1\napply = 2\n')
+        w2 = parse_wax('diff = 3\napply = 2\n')
+        self.assertEquals(w1._apply(w1._diff(w2)).diff, 3)
+
+    def test_patch_json(self):
+        w1 = Wax(foo=1, sub=Wax(x=1))
+        w2 = Wax(foo=2, sub=Wax(x=1, y=Wax(z=u'\u2018')))
+        w2.sub._add_comment('comment')
+        patch = w1._diff(w2)
+        res = WaxPatch.from_json(str(patch))
+        self.assertEquals(res, patch)
+        self.assertEquals(w1._apply(res), w2)
+        self.assertEquals(w1.sub.y.z, u'\u2018')
+
+        # strings needing escapes survive, in values and in Wax text
+        for val in ('c:\\dir\\', 'say "\\n"', u'\u00e9\\"'):
+            w2 = Wax(foo=val, sub=Wax(x=1, y=Wax(z=val)))
+            w2._set_annotation('foo', val)
+            patch = w1._diff(w2)
+            res = WaxPatch.from_json(patch.to_json())
+            self.assertEquals(res, patch)
+            self.assertEquals(w1._apply(res), w2)
+            self.assertEquals(w1._apply(res).sub.y.z, val)
+        self.assertRaises(WaxError, WaxPatch.from_json, '[{"op": "add"}]')
+
+    def test_subscribe(self):
+        w = parse_wax(WELLFORMED)
+        res = []
+        sub1 = w._subscribe('one.*', lambda c: res.append(('one', c)))
+        sub2 = w._subscribe('**.level3', lambda c: res.append(('level3', c)))
+        w.one.num = 1
+        w.one['two.str'] = 'bar'
+        del w.level1.level2
+        w.str = 'unwatched'
+        self.assertEquals(res, [
+            ('one', [('set', 'one.num')]),
+            ('one', [('set', 'one.two.str')]),
+            ('level3', [('delete', 'level1.level2')]),
+            ])
+
+        # merges deliver one batch per subscriber
+        del res[:]
+        w += parse_wax('[one]\nnum = 2\nfoo = 3\n[x.y]\nlevel3 = 1\n')
+        self.assertEquals(res, [
+            ('one', [('set', 'one.num'), ('set', 'one.foo')]),
+            ('level3', [('set', 'x')]),
+            ])
+
+        del res[:]
+        sub1.cancel()
+        sub2.cancel()
+        w.one.num = 3
+        self.assertEquals(res, [])
+        self.assertEquals(w._watchers, None)
+        self.assertRaises(WaxError, w._subscribe, 'one.-', None)
+
+        # a key may share the method's name
+        w = Wax()
+        w._subscribe('*', res.append)
+        w.subscribe = 1
+        self.assertEquals(res, [[('set', 'subscribe')]])
+
+        # only trees with watchers report changes
+        w = Wax(sub=Wax(x=1))
+        other = Wax(sub=Wax(x=1))
+        sub = w._subscribe('**', res.append)
+        self.assertTrue(w.sub._watched)
+        self.assertFalse(other._watched or other.sub._watched)
+        w.other = other
+        self.assertTrue(other.sub._watched)
+        sub.cancel()
+        self.assertFalse(w.sub._watched or other.sub._watched)
+
+    def test_subscribe_errors(self):
+        w = Wax(a=1)
+        res = []
+
+        def fail(changes):
+            raise ValueError(changes)
+        w._subscribe('a', fail)
+        w._subscribe('a', res.append)
+        # every subscriber is called and the first error raised
+        self.assertRaises(ValueError, setattr, w, 'a', 2)
+        self.assertEquals(res, [[('set', 'a')]])
+        # nothing is left queued
+        self.assertRaises(ValueError, setattr, w, 'a', 3)
+        self.assertEquals(res[1:], [[('set', 'a')]])
+
+    def test_batch(self):
+        w = Wax(foo=1, sub=Wax(x=1))
+        w.sub._set_annotation('x', 'note')
+        fp = w._fingerprint()
+        res = []
+        w._subscribe('**', res.append)
+        with w._batch():
+            for i in range(3):
+                w.sub['y%d' % i] = i
+                w.sub['y%d' % i] = i + 1
+            w['new.key'] = 2
+            self.assertEquals(w.sub.y2, 3)
+            self.assertEquals(res, [])
+            # fingerprints follow the changes made so far
+            self.assertNotEquals(w._fingerprint(), fp)
+        self.assertEquals(w.sub.keys(), ['x', 'y0', 'y1', 'y2'])
+        self.assertEquals(len(res), 1)
+        self.assertEquals(len(res[0]), 8)
+        self.assertNotEquals(w._fingerprint(), fp)
+
+        # errors roll back every change made in the batch
+        fp = w._fingerprint(annotations=True, comments=True)
+        text = str(w)
+        del res[:]
+        def _fail():
+            with w._batch():
+                w.foo = 2
+                del w.sub.x
+                w.sub.z = Wax(a=1)
+                w.sub._add_comment('comment')
+                w.new._set_annotation('key', 'note')
+                w['bad-key'] = 1
+        self.assertRaises(WaxError, _fail)
+        self.assertEquals(str(w), text)
+        self.assertEquals(w.sub.keys(), ['x', 'y0', 'y1', 'y2'])
+        self.assertEquals(w._fingerprint(annotations=True, comments=True), fp)
+        self.assertEquals(res, [])
+
+        w = Wax(a=Wax(b=1))
+        old = Wax(a=Wax(b=1))
+        w._fingerprint()
+        old._fingerprint()
+        with w._batch():
+            w.a.b = 2
+            self.assertNotEquals(w, old)
+            w.a._set_annotation('b', 'note')
+            self.assertNotEquals(w._fingerprint(True), old._fingerprint(True))
+
+        # a key may share the method's name
+        with w._batch():
+            w.batch = 1
+        self.assertEquals(w.batch, 1)
+
     def test_len(self):
         wx = Wax(aa=1, bb=Wax(cc=2))
         self.assertEquals(len(wx), 2)
@@ -242,6 +498,130 @@ class TestWax(unittest.TestCase):
         self.assertFalse(w1 != w2)
         self.assertRaises(TypeError, w1.__ne__, {'foo': 1})
 
+    def test_fingerprint(self):
+        w1 = Wax()
+        w1.foo = 1
+        w1.sub = Wax(x=1)
+        w2 = Wax()
+        w2.foo = 1
+        w2.sub = Wax(x=1)
+        self.assertEquals(w1._fingerprint(), w2._fingerprint())
+        self.assertEquals(len(w1._fingerprint()), 40)
+
+        # key order is significant, int/long are not
+        w3 = Wax()
+        w3.sub = Wax(x=1L)
+        w3.foo = 1
+        self.assertNotEquals(w1._fingerprint(), w3._fingerprint())
+        self.assertEquals(w1.sub._fingerprint(), w3.sub._fingerprint())
+        self.assertEquals(w1, w3)
+
+        # changes below a cached instance are noticed
+        old = w1._fingerprint()
+        w1.sub.x = 2
+        self.assertNotEquals(old, w1._fingerprint())
+        del w1.sub.x
+        w1['sub.x'] = 1
+        self.assertEquals(old, w1._fingerprint())
+
+        # annotations and comments are optional
+        w2.sub._set_annotation('x', 'note')
+        w2.sub._add_comment('comment')
+        self.assertEquals(w1._fingerprint(), w2._fingerprint())
+        self.assertNotEquals(w1._fingerprint(annotations=True),
+            w2._fingerprint(annotations=True))
+        self.assertNotEquals(w1._fingerprint(comments=True),
+            w2._fingerprint(comments=True))
+
+        # mutable values are always re-hashed
+        w = Wax(sub=Wax(lst=[1, 2]))
+        old = w._fingerprint()
+        w.sub.lst.append(3)
+        self.assertNotEquals(old, w._fingerprint())
+
+        # the method does not clash with a key of the same name
+        w = parse_wax('fingerprint = 1\n')
+        self.assertEquals(w.fingerprint, 1)
+        self.assertEquals(len(w._fingerprint()), 40)
+
+    def test_fingerprint_equality(self):
+        class Thing(object):
+            def __repr__(self):
+                return 'thing'
+        for lt, rt in ([1], (1,)), (array.array('i', [1]), [1]), \
+                (Thing(), Thing()), ({1: 2}, {'1': 2}):
+            self.assertNotEquals(Wax(a=lt)._fingerprint(),
+                Wax(a=rt)._fingerprint())
+            self.assertNotEquals(Wax(a=lt), Wax(a=rt))
+        # NaN is not equal to itself, so its digest is never cached
+        w = Wax(a=float('nan'))
+        w._fingerprint()
+        self.assertEquals(w._cached_fingerprint(False, False), None)
+        self.assertNotEquals(w, Wax(a=w.a))
+        self.assertEquals(Wax(a=u'x')._fingerprint(),
+            Wax(a='x')._fingerprint())
+
+        # comparing does not compute fingerprints, but uses cached ones
+        w1 = Wax(a=Wax(b=1), c=2)
+        w2 = Wax(c=2, a=Wax(b=1))
+        self.assertEquals(w1, w2)
+        self.assertEquals(w1._cached_fingerprint(False, False), None)
+        w1._fingerprint()
+        w2.a._fingerprint()
+        self.assertEquals(w1, w2)
+        w2.a.b = 2
+        self.assertNotEquals(w1, w2)
+
+    def test_pickle(self):
+        w = parse_wax('# c\n[a]\n; note\nb = 1\nc = "${a.b}"\n[d]\n'
+            'e = [1, 2]\n', defer_values=True)
+        w._interpolate()
+        w._subscribe('**', lambda changes: None)
+        old = w._fingerprint(True, True)
+        for proto in (0, 2):
+            res = pickle.loads(pickle.dumps(w, proto))
+            self.assertEquals(res, w)
+            self.assertEquals(str(res), str(w))
+            self.assertEquals(res._fingerprint(True, True), old)
+            self.assertEquals(res.a.c, '${a.b}')
+            self.assertEquals(res.d.e, [1, 2])
+            # parent links are rebuilt, so changes below are noticed
+            res.a.b = 2
+            self.assertNotEquals(res._fingerprint(True, True), old)
+        self.assertEquals(pickle.loads(pickle.dumps(Wax(a=Wax(b=1)))),
+            Wax(a=Wax(b=1)))
+
+    def test_canonical(self):
+        w1 = parse_wax('# notes\nport = 80\nrate = 0.5\n'
+            '[srv.b]\n; note\nopts = {"z": 1, "a": [2.5]}\n[srv]\n'
+            'name = "%(port)s"\n[srv.a]\n[empty]\n')
+        w2 = Wax()
+        w2.empty = Wax()
+        w2.srv = Wax(a=Wax())
+        w2.srv.b = Wax(opts={'a': [2.5], 'z': 1})
+        w2.srv.name = '%(port)s'
+        w2.rate = 0.5
+        w2.port = 80
+        text = w1._canonical()
+        self.assertEquals(text, 'port = 80\nrate = 0.5\n\n[empty]\n'
+            '\n[srv]\nname = "%(port)s"\n\n[srv.a]\n'
+            '\n[srv.b]\nopts = {"a":[2.5],"z":1}\n\n')
+        self.assertEquals(w2._canonical(), text)
+        self.assertEquals(w1._canonical_digest(),
+            hashlib.sha1(text).hexdigest())
+        self.assertEquals(w2._canonical_digest(), w1._canonical_digest())
+        self.assertEquals(parse_wax(text), w1)
+        self.assertEquals(Wax()._canonical(), str(Wax()))
+
+        w2.rate = 0.1 + 0.2
+        self.assertNotEquals(w2._canonical_digest(), w1._canonical_digest())
+        self.assertEquals(parse_wax(w2._canonical()).rate, 0.1 + 0.2)
+
+        # the methods start with '_', so these are ordinary keys
+        w = Wax(canonical_digest=2, canonical=1)
+        self.assertEquals(w._canonical(),
+            'canonical = 1\ncanonical_digest = 2\n\n')
+
     def test_contains(self):
         w = Wax(foo=1, sub=Wax(bar=2))
         self.assertTrue('foo' in w)
@@ -330,6 +710,549 @@ class TestWax(unittest.TestCase):
         wd = wax_to_dict(w)
         self.assertEquals(wd, {'a': {'b': {'c': {'d': 1}}}})
 
+    def test_to_dict(self):
+        w = parse_wax(WELLFORMED)
+        res = w._to_dict(_OrderedDict)
+        self.assertEquals(res.keys(), w.keys())
+        self.assertEquals(res['one'].keys(), w.one.keys())
+        self.assertEquals(res['one']['two'], {'str': 'foo'})
+        self.assertEquals(res, wax_to_dict(w))
+        self.assertTrue(res['dict'] is w.dict)
+
+    def test_json(self):
+        w = parse_wax(WELLFORMED)
+        res = Wax.from_json(w._to_json())
+        # dict values come back as groups
+        self.assertEquals(res.dict, Wax(abc=123, list=[1, 2, 3]))
+        del w.dict
+        del res.dict
+        self.assertEquals(res, w)
+        self.assertEquals(res.one.keys(), w.one.keys())
+        self.assertEquals(Wax(foo=Wax(), bar=[1])._to_json(),
+            '{"foo":{},"bar":[1]}')
+
+        # nesting beyond the recursion limit
+        depth = sys.getrecursionlimit() * 2
+        data = '{"a":' * depth + '[{"b":1}]' + '}' * depth
+        w = Wax.from_json(data)
+        self.assertEquals(w._to_json(), data)
+        self.assertEquals(len(w._to_dict()), 1)
+
+        # the methods start with '_', so these are ordinary keys
+        data = '{"to_json":1,"to_dict":2,"from_json":3}'
+        w = Wax.from_json(data)
+        self.assertEquals(w.to_json, 1)
+        self.assertEquals(w._to_json(), data)
+        self.assertEquals(w._to_dict()['to_dict'], 2)
+        w = parse_wax('[from_json]\nx = 1\n')
+        w['from_json.y'] = 2
+        self.assertEquals(w.from_json, Wax(x=1, y=2))
+        self.assertEquals(Wax.from_json(w._to_json()), w)
+
+        for data in ('[]', '{"a":1,}', '{"a":1', '{"a" 1}', '{"a":1} 2',
+                '{"bad-key":1}', '{"keys":1}', u'{}', '{"a":1 "b":2}'):
+            self.assertRaises(WaxError, Wax.from_json, data)
+
+    def test_template(self):
+        w = Wax(server=Wax(host='localhost', port=1234), opts={'a': 1})
+        fmt = '%(server.host)s:%(server.port)06d %(opts.a)r %(server.host)s %%'
+        t = w._template(fmt)
+        self.assertTrue(isinstance(t, WaxTemplate))
+        self.assertEquals(t.render(), fmt % w)
+        w2 = Wax(server=Wax(host='example.com', port=80), opts={'a': 'x'})
+        self.assertEquals(t.render(w2), fmt % w2)
+        self.assertEquals(t % w2, fmt % w2)
+        del w2.server.port
+        self.assertRaises(KeyError, t.render, w2)
+        w2.server = 1
+        self.assertRaises(WaxError, t.render, w2)
+        for fmt in ('%s', '%(server.host)s %', '%(bad-key)s', '%(keys)s'):
+            self.assertRaises(WaxError, w._template, fmt)
+
+        # cached text is discarded when the tree changes
+        t = w._template('%(server.port)s', cache=True)
+        self.assertEquals(str(t), '1234')
+        w.server.port = 80
+        self.assertEquals(str(t), '80')
+        w.server = Wax(port=443)
+        self.assertEquals(str(t), '443')
+        self.assertEquals(len(w._watchers), 1)
+        del t
+        self.assertEquals(w._watchers, None)
+
+        # the method starts with '_', so 'template' is an ordinary key
+        w = parse_wax('template = "%(name)s"\nname = "x"\n')
+        self.assertEquals(w._template(w.template).render(), 'x')
+
+    def test_interpolate(self):
+        w = parse_wax(
+            '[server]\nhost = "localhost"\nport = 1234\n'
+            '[client]\nurl = "http://${server.host}:${server.port}/"\n'
+            'port = "${server.port}"\nlink = "${client.url}?q=$$x%s"\n')
+        text = str(w)
+        self.assertTrue(w._interpolate() is w)
+        self.assertEquals(w.client.url, 'http://localhost:1234/')
+        self.assertEquals(w['client.port'], 1234)
+        self.assertEquals(w.client.get('link'),
+            'http://localhost:1234/?q=$x%s')
+        self.assertEquals(w._template('%(client.port)s').render(), '1234')
+        self.assertEquals(str(w), text)
+        self.assertEquals(Wax(w), w)
+
+        # values are remembered until a reference changes
+        self.assertTrue('url' in w.client.__dict__)
+        w.other = 1
+        self.assertTrue('url' in w.client.__dict__)
+        w.server.host = 'example.com'
+        self.assertFalse('link' in w.client.__dict__)
+        self.assertEquals(w.client.link, 'http://example.com:1234/?q=$x%s')
+        w.server = Wax(host='a', port=1)
+        self.assertEquals(w.client.url, 'http://a:1/')
+        with w._batch():
+            w.server.port = 2
+            self.assertEquals(w.client.port, 2)
+        try:
+            with w._batch():
+                w.server.port = 3
+                self.assertEquals(w.client.port, 3)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEquals(w.client.port, 2)
+
+        # replacing and removing interpolated values
+        w.client.port = 5
+        w.server.port = 6
+        self.assertEquals(w.client.port, 5)
+        self.assertEquals(w.client.keys(), ['url', 'port', 'link'])
+        del w.client.url
+        self.assertEquals(w.client.keys(), ['port', 'link'])
+        self.assertRaises(WaxError, getattr, w.client, 'link')
+
+        w = Wax(a='${b}', b='${a}', c='${a', d='$x')._interpolate()
+        self.assertRaises(WaxError, getattr, w, 'a')
+        self.assertEquals((w.c, w.d), ('${a', '$x'))
+        self.assertRaises(AttributeError, getattr, w, 'missing')
+        self.assertRaises(WaxError, Wax(a='${bad-key}')._interpolate)
+
+        # '$$' is unescaped with or without references in the string
+        text = 'a = "$$5 for ${b}"\nb = "x"\nc = "$$5 %s"\nd = "5%"\n\n'
+        w = parse_wax(text)._interpolate()
+        self.assertEquals((w.a, w.c, w.d), ('$5 for x', '$5 %s', '5%'))
+        self.assertEquals(str(w), text)
+
+        # the method starts with '_', so 'interpolate' is an ordinary key
+        w = Wax(interpolate='${a}', a=1)._interpolate()
+        self.assertEquals(w.interpolate, 1)
+
+    def test_chain(self):
+        base = parse_wax(WELLFORMED)
+        env = parse_wax('# env\n[one]\nfoo = 2\n[one.two]\nnew = 1\n'
+            '[dict]\nabc = 1\n')
+        host = parse_wax('bar = 3\none = 4\n; note\nlast = 5\n')
+        for layers in ((base, env), (env, base), (base, env, host),
+                (host, env, base), (base,)):
+            c = Wax.chain(*layers)
+            m = Wax(layers[0])
+            for layer in layers[1:]:
+                m += layer
+            self.assertEquals(c.keys(), m.keys())
+            self.assertEquals(str(c), str(m))
+            self.assertEquals(c._to_dict(), m._to_dict())
+        c = Wax.chain(base, env)
+        self.assertTrue(isinstance(c.one.two, WaxChain))
+        self.assertEquals(c['one.two.new'], 1)
+        self.assertEquals(c['one.foo'], 2)
+        self.assertEquals(c.dict.abc, 1)
+        self.assertEquals(c.get('one.missing', 7), 7)
+        self.assertFalse('missing' in c)
+        self.assertRaises(AttributeError, getattr, c, 'missing')
+        self.assertRaises(WaxError, setattr, c, 'foo', 1)
+        self.assertRaises(WaxError, Wax.chain, base, {})
+
+        # methods start with '_', so these are ordinary keys
+        names = Wax(chain=1, layers=2, to_dict=3)
+        nc = Wax.chain(Wax(a=0), names)
+        self.assertEquals((nc.chain, nc.layers, nc.to_dict), (1, 2, 3))
+        self.assertEquals(nc._to_dict()['layers'], 2)
+        w = parse_wax('[chain]\nx = 1\n[chain.sub]\ny = 2\n')
+        w['chain.z'] = 3
+        self.assertEquals(w.chain, Wax(x=1, sub=Wax(y=2), z=3))
+
+        # cached lookups follow changes to the layers
+        env.one.foo = 3
+        self.assertEquals(c.one.foo, 3)
+        env.one.two.new = Wax(a=1)
+        self.assertEquals(c.one.two.new.a, 1)
+        del env.one
+        self.assertFalse('foo' in c.one)
+        self.assertEquals(c.one.num, 123)
+        env.one = 1
+        self.assertEquals(c.keys(), (base + env).keys())
+        self.assertEquals(c.one, 1)
+        held = c.dict
+        env.dict.abc = 2
+        self.assertEquals(held.abc, 2)
+
+        # layers share one change counter, so chains cost no tree walk
+        self.assertEquals(len(base._watchers), 1)
+        del c, held
+        big = Wax.from_items([('group%d.key%d' % (g, k), k)
+            for g in range(2000) for k in range(11)])
+        Wax.chain(big, env)
+        start = time.time()
+        for i in range(1000):
+            Wax.chain(big, env).group7.key3
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEquals(len(big._watchers), 1)
+        self.assertEquals(len(base._watchers), 1)
+
+    def test_merge_all(self):
+        base = parse_wax(WELLFORMED)
+        env = parse_wax('# env\n[one]\nfoo = 2\nlist = [1]\n[one.two]\n'
+            'new = 1\n[dict]\nabc = 1\n')
+        host = parse_wax('bar = 3\none = 4\n; note\nlast = 5\n'
+            'list = ["is", 2, {}]\n')
+        for layers in ((base, env), (env, base), (base, env, host),
+                (host, env, base), (base,), ()):
+            m = Wax()
+            for layer in layers:
+                m += layer
+            res = Wax.merge_all(layers)
+            self.assertEquals(res, m)
+            self.assertEquals(str(res), str(m))
+        res = Wax.merge_all([base, host], 'append')
+        self.assertEquals(res.list, base.list + host.list)
+        res = Wax.merge_all([base, host, host], list_policy='unique')
+        self.assertEquals(res.list, base.list + [2, {}])
+
+        # the result shares no mutable values with the layers
+        res = Wax.merge_all([base, env])
+        res.one.two.str = 'bar'
+        res.dict['abc'] = 1
+        self.assertEquals(base.one.two.str, 'foo')
+        self.assertEquals(base.dict['abc'], 123)
+        self.assertRaises(WaxError, Wax.merge_all, [base], 'bad')
+        self.assertRaises(WaxError, Wax.merge_all, [base, {}])
+
+        # a classmethod, so a key of the same name does not hide it
+        res = Wax.merge_all([Wax(merge_all=1), Wax(merge_all=2)])
+        self.assertEquals(res.merge_all, 2)
+        a = parse_wax('[merge_all]\nx = 1\n')
+        b = Wax()
+        b['merge_all.y'] = 2
+        res = Wax.merge_all([a, b])
+        self.assertEquals(res.merge_all, Wax(x=1, y=2))
+
+    def test_select(self):
+        w = parse_wax(WELLFORMED)
+        w.x = Wax(a=Wax(x=Wax(num=1)), num=2)
+        self.assertEquals(list(w._select('one.*')),
+            [('one.' + k, w.one[k]) for k in w.one.keys()])
+        self.assertEquals([p for p, v in w._select('**.num')],
+            ['num', 'one.num', 'a.b.c.d.e.f.g.num', 'a.b.c.num',
+            'x.a.x.num', 'x.num'])
+        self.assertEquals([p for p, v in w._select('*.t*')], ['one.two'])
+        self.assertEquals([p for p, v in w._select('x.**')],
+            ['x', 'x.a', 'x.a.x', 'x.a.x.num', 'x.num'])
+        self.assertEquals(list(w._select('one.missing')), [])
+        for pattern in ('', 'a..b', 'bad-key', 'keys', None):
+            self.assertRaises(WaxError, w._select, pattern)
+
+        # indexed queries give the same pairs and follow changes
+        patterns = ('**.num', '**.x.**', '**.x.num', 'one.*', '**.s*',
+            'a.**.num', 'x.*.x')
+        for pattern in patterns:
+            self.assertEquals(sorted(w._select(pattern, index=True)),
+                sorted(w._select(pattern)))
+        w.one.two.num = 1
+        del w.x.a
+        w.y = Wax(x=Wax(num=3))
+        with w._batch():
+            w.z = Wax(num=4)
+        for pattern in patterns:
+            self.assertEquals(sorted(w._select(pattern, index=True)),
+                sorted(w._select(pattern)))
+
+        # the method starts with '_', so 'select' is an ordinary key
+        w = parse_wax('[select]\nselect = 1\n')
+        self.assertEquals(list(w._select('select.select')),
+            [('select.select', 1)])
+
+    def test_to_struct(self):
+        w = parse_wax(WELLFORMED)
+        s = w._to_struct()
+        self.assertTrue(isinstance(s, WaxStruct))
+        self.assertEquals(s._fields, tuple(w.keys()))
+        self.assertEquals(s.one.two.str, 'foo')
+        self.assertEquals(s['a.b.c.num'], 1)
+        self.assertRaises(KeyError, s.__getitem__, 'one.missing')
+        self.assertRaises(AttributeError, getattr, s, 'missing')
+        self.assertRaises(WaxError, setattr, s, 'num', 1)
+        self.assertRaises(WaxError, delattr, s.one, 'str')
+        self.assertFalse(hasattr(s, '__dict__'))
+        self.assertEquals(s._to_wax(), w)
+        self.assertEquals(s, w._to_struct())
+
+        # classes are shared by groups with the same keys
+        self.assertTrue(type(Wax(a=1)._to_struct()) is
+            type(Wax(a=2)._to_struct()))
+        self.assertFalse(type(s.one) is type(s.one.two))
+
+        # values are copied
+        s.list.append(1)
+        self.assertEquals(len(w.list), 4)
+
+        # the schema decides the keys of described groups
+        schema = {'fields': {'one': {'fields': {'str': {}, 'x': {}}},
+            'a': {'patterns': [['*', {}]]}, 'num': {}}}
+        s = w._to_struct(schema)
+        self.assertEquals(s._fields, ('a', 'num', 'one'))
+        self.assertEquals(s.one._fields, ('str', 'x'))
+        self.assertEquals((s.one.str, s.one.x, s.a._fields), ('foo', None, ()))
+
+        # interpolated values are resolved, and errors raised
+        w = Wax(a='${b}', b=1, c='${missing}')._interpolate()
+        self.assertRaises(WaxError, w._to_struct)
+        del w.c
+        self.assertEquals(w._to_struct().a, 1)
+
+        # the method starts with '_', so 'to_struct' is an ordinary key
+        self.assertEquals(Wax(to_struct=1)._to_struct().to_struct, 1)
+
+    def test_intern(self):
+        data = ''.join(['[h%d.net]\nhost = "web-%d"\nrole = "frontend"\n'
+            'tags = ["prod", "web"]\nport = 8080\n' % (i, i % 2)
+            for i in range(3)])
+        w = parse_wax(data)
+        # key names are always shared
+        self.assertTrue(w.h0.keys()[0] is w.h1.keys()[0])
+        self.assertTrue(w.h0.net.keys()[1] is w.h2.net.keys()[1])
+        self.assertFalse(w.h0.net.role is w.h1.net.role)
+
+        w = parse_wax(data, intern_values=True)
+        self.assertEquals(w, parse_wax(data))
+        self.assertTrue(w.h0.net.role is w.h1.net.role)
+        self.assertTrue(w.h0.net.host is w.h2.net.host)
+        self.assertFalse(w.h0.net.host is w.h1.net.host)
+        self.assertTrue(w.h0.net.port is w.h2.net.port)
+        self.assertTrue(w.h0.net.tags[1] is w.h1.net.tags[1])
+        self.assertFalse(w.h0.net.tags is w.h1.net.tags)
+
+        # a dict shares values between calls
+        table = {}
+        w1 = parse_wax(data, intern_values=table)
+        w2 = Wax.from_json(w._to_json(), intern_values=table)
+        self.assertTrue(w1.h0.net.role is w2.h2.net.role)
+        w3 = Wax.from_items([('a', 'web-%d' % 1), ('b', 1.5)],
+            intern_values=table)
+        self.assertTrue(w3.a is w1.h1.net.host)
+
+    def test_typed_arrays(self):
+        data = 'ids = [1, 2, 3]\nweights = [0.25, -1.5]\nnames = ["a"]\n' \
+            '[grid]\ncells = [[1, 2], [3, 4.5]]\n'
+        w = parse_wax(data, typed_arrays=True)
+        plain = parse_wax(data)
+        self.assertEquals(w.ids, array.array('l', [1, 2, 3]))
+        self.assertEquals(w.weights, array.array('d', [0.25, -1.5]))
+        self.assertEquals(w.grid.cells[0], array.array('l', [1, 2]))
+        self.assertEquals(type(w.grid.cells[1]), list)
+        self.assertEquals(w.names, ['a'])
+        self.assertEquals(str(w), str(plain))
+        self.assertEquals(w._to_json(), plain._to_json())
+        # arrays are not equal to lists
+        self.assertNotEquals(w._fingerprint(), plain._fingerprint())
+        self.assertNotEquals(w, plain)
+        self.assertEquals(Wax.from_json(w._to_json(), typed_arrays=True).ids,
+            w.ids)
+
+        # copies and merges do not share the arrays
+        c = Wax(w)
+        self.assertFalse(c.ids is w.ids)
+        self.assertEquals(c.ids, w.ids)
+        m = Wax.merge_all([w, parse_wax('ids = [4]')], list_policy='append')
+        self.assertEquals(list(m.ids), [1, 2, 3, 4])
+
+    def test_keep_comments(self):
+        full = parse_wax(WELLFORMED)
+        w = parse_wax(WELLFORMED, keep_comments=False)
+        self.assertEquals(w, full)
+        groups = lambda top: [top] + [g for k, g in top._select('**')
+            if isinstance(g, Wax)]
+        for node in groups(w):
+            self.assertEquals(node._comments, {})
+            self.assertEquals(node._annotations, {})
+            self.assertEquals([k for k in node._key_order
+                if not isinstance(k, basestring)], [])
+        for node in groups(full):
+            node._clear_comments()
+            node._annotations.clear()
+        self.assertEquals(str(w), str(full))
+
+        # comment lines are not parsed, up to the end of the input
+        w = parse_wax('a = 1\n# [bad\n; = 2\n[b]\nc = 3 # trailing',
+            keep_comments=False)
+        self.assertEquals(w, Wax(a=1, b=Wax(c=3)))
+        try:
+            parse_wax('# x\na = \n', keep_comments=False)
+            self.fail('expected a WaxError')
+        except WaxError, exc:
+            self.assertTrue('line 2' in str(exc))
+
+    def test_defer_values(self):
+        data = 'a = [1, 2,\n  3]\nb = {"x": [{"y": "]}\\""}]}\n' \
+            'c = "${a}" # done\n[g]\nd = ["${c}"]\n; note\ne = 1\n'
+        plain = parse_wax(data)
+        w = parse_wax(data, defer_values=True)
+        self.assertEquals(w._fingerprint(), plain._fingerprint())
+        w = parse_wax(data, defer_values=True)
+        # values which were not read are written out as they were
+        self.assertEquals(str(w), 'a = [1, 2,\n  3]\n'
+            'b = {"x": [{"y": "]}\\""}]}\nc = "${a}"\n\n# done\n\n'
+            '[g]\nd = ["${c}"]\n\n; note\ne = 1\n\n')
+        self.assertEquals(w.g.e, 1)
+        self.assertEquals(w.b, {'x': [{'y': ']}"'}]})
+        self.assertTrue(w.b is w.b)
+        self.assertTrue('b' in w.__dict__)
+        self.assertTrue('b = {"x":[' in str(w))
+        self.assertEquals(w, plain)
+        self.assertEquals(w._interpolate().c, [1, 2, 3])
+
+        # only lists and dicts are deferred
+        w = parse_wax('a = [1, 2]\nb = "x"\n', defer_values=True,
+            typed_arrays=True)
+        self.assertEquals(sorted(w._interp), ['a'])
+        w._memory_usage()
+        self.assertEquals(w._interp['a'].text, '[1, 2]')
+        self.assertEquals(w.a, array.array('l', [1, 2]))
+        w.a = 3
+        self.assertEquals(w._interp, {})
+
+        # errors in the contents are raised when the value is read
+        w = parse_wax('a = [1, x]\nb = 2\n', defer_values=True)
+        self.assertEquals(w.b, 2)
+        self.assertRaises(WaxError, getattr, w, 'a')
+        self.assertRaises(WaxError, parse_wax, 'a = [1, "]\n',
+            defer_values=True)
+
+    def test_memory_usage(self):
+        w = parse_wax(WELLFORMED)
+        usage = w._memory_usage()
+        self.assertEquals(sorted(usage), ['', 'a', 'a.b', 'a.b.c',
+            'a.b.c.d', 'a.b.c.d.e', 'a.b.c.d.e.f', 'a.b.c.d.e.f.g', 'level1',
+            'level1.level2', 'one', 'one.two'])
+        top = usage['']
+        self.assertEquals(sorted(top), ['annotations', 'comments', 'keys',
+            'node', 'values'])
+        size = sys.getsizeof
+        self.assertEquals(top['keys'], sum([size(k) for k in w.keys()]))
+        self.assertTrue(top['node'] >= size(w) + size(w.__dict__))
+        shallow = w._memory_usage(deep=False)
+        self.assertEquals(shallow.keys(), [''])
+        # nested list items are only counted when deep
+        self.assertTrue(shallow['']['values'] < top['values'])
+
+        # shared objects are counted once
+        v = Wax(a=Wax(x='shared value'), b=Wax(x='shared value'))
+        v.b.x = v.a.x
+        usage = v._memory_usage(unique=True)
+        self.assertEquals(usage['a']['values'], size(v.a.x))
+        self.assertEquals((usage['b']['values'], usage['b']['keys']), (0, 0))
+        usage = v._memory_usage()
+        self.assertEquals(usage['b']['values'], size(v.a.x))
+
+        # the method starts with '_', so 'memory_usage' is an ordinary key
+        w = Wax(memory_usage=Wax(a=1))
+        self.assertTrue('memory_usage' in w._memory_usage())
+
+    def test_holder(self):
+        src = parse_wax(WELLFORMED)
+        h = WaxHolder(src)
+        self.assertEquals(h.wax, src)
+        self.assertFalse(h.wax is src)
+        v0 = h.wax
+
+        # only the groups along the changed path are copied
+        v1 = h.set('a.b.c.num', 2)
+        self.assertTrue(h.wax is v1)
+        self.assertEquals((v0.a.b.c.num, v1.a.b.c.num), (1, 2))
+        self.assertFalse(v1.a.b is v0.a.b)
+        self.assertTrue(v1.one is v0.one)
+        self.assertEquals(v0, src)
+
+        v2 = h.delete('one.two')
+        self.assertFalse('two' in v2.one)
+        self.assertTrue('two' in v1.one)
+        h.apply(WaxPatch([('add', 'x.y', [1]), ('remove', 'num')]))
+        self.assertEquals((h.wax.x.y, 'num' in h.wax), ([1], False))
+        self.assertTrue(h.wax.a is v2.a)
+
+        # a failed patch publishes nothing
+        v3 = h.wax
+        self.assertRaises(WaxError, h.apply,
+            WaxPatch([('add', 'num', 7), ('bogus', 'num')]))
+        self.assertTrue(h.wax is v3)
+        self.assertFalse('num' in v3)
+
+        # structs are converted once per version
+        s = h.snapshot()
+        self.assertTrue(s is h.snapshot())
+        self.assertEquals(s.x.y, [1])
+        h.update(lambda w: setattr(w, 'num', 5))
+        self.assertEquals((h.wax.num, h.snapshot().num, v3.get('num')),
+            (5, 5, None))
+
+        # instances handed to update() stay writable for the caller
+        mine = Wax(port=1)
+        held = []
+        res = h.update(lambda w: (setattr(w, 'mine', mine), held.append(w)))
+        self.assertTrue(res is h.wax)
+        mine.port = 2
+        held[0].num = 6
+        self.assertEquals((res.mine.port, res.num), (1, 5))
+        self.assertRaises(WaxError, setattr, res.mine, 'port', 3)
+
+        # published versions are read-only, so writes cannot reach the
+        # groups they share
+        v4 = h.wax
+        for func, args in ((setattr, (v4.one, 'num', 2)),
+                (v4.__setitem__, ('a.b.c.num', 2)),
+                (v4.__delitem__, ('one.num',)),
+                (v4.__iadd__, (Wax(num=2),)),
+                (v4.one._set_annotation, ('num', 'x')),
+                (v4._apply, (WaxPatch([('add', 'num', 2)]),)),
+                (Wax(x=v4.one).__setitem__, ('x.num', 2))):
+            self.assertRaises(WaxError, func, *args)
+        v5 = h.set('one.num', 2)
+        self.assertTrue(v5.a is v4.a)
+        self.assertEquals((v4.one.num, v5.one.num), (123, 2))
+        copy = Wax(v5)
+        copy.a.b.c.num = 3
+        self.assertEquals((v5.a.b.c.num, copy.a.b.c.num), (2, 3))
+
+    def test_holder_threads(self):
+        h = WaxHolder(Wax(pair=Wax(a=0, b=0)))
+        done = []
+        errors = []
+
+        def read():
+            while not done:
+                pair = h.wax.pair
+                if pair.a != pair.b:
+                    errors.append((pair.a, pair.b))
+
+        readers = [threading.Thread(target=read) for i in range(4)]
+        for t in readers:
+            t.start()
+        for i in range(1, 500):
+            h.apply(WaxPatch([('change', 'pair.a', i - 1, i),
+                ('change', 'pair.b', i - 1, i)]))
+        done.append(1)
+        for t in readers:
+            t.join()
+        self.assertEquals(errors, [])
+        self.assertEquals(h.wax.pair.b, 499)
+
     def test_copy(self):
         w1 = Wax(foo=1, bar={"a":1,"b":[1,2]}, baz=[1,2,3])
         w1.sub = Wax(foo=1, bar=Wax(baz=3.1415))
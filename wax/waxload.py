@@ -0,0 +1,344 @@
+
+# waxload - parse Wax files without blocking the caller.
+#
+# Author: Patrick Hensley <spaceboy@indirect.com>
+
+
+# std
+import cStringIO
+import Queue
+import re
+import threading
+import time
+
+# local
+from waximpl import Wax, WaxError, parse_wax
+from waxwatch import RE_SECTION, _open_annotation
+
+
+__all__ = ["WaxCancelledError", "WaxJob", "WaxLoader"]
+
+
+E_CANCELLED = "job was cancelled"
+E_CLOSED = "loader is closed"
+E_TIMEOUT = "timed out waiting for job"
+
+
+class WaxCancelledError(WaxError):
+
+    '''
+    Raised by WaxJob.result() for a job which was cancelled.
+    '''
+
+    def __init__(self):
+        WaxError.__init__(self, E_CANCELLED)
+
+
+class WaxJob(object):
+
+    '''
+    The pending result of work submitted to a WaxLoader.  The methods follow
+    those of concurrent.futures.Future, so a job can be adapted to most
+    event loops through add_done_callback().
+    '''
+
+    def __init__(self, func, args):
+        self._func = func
+        self._args = args
+        self._cond = threading.Condition()
+        self._state = 'pending'
+        self._result = None
+        self._exc = None
+        self._callbacks = []
+
+    def cancel(self):
+        '''
+        Cancel the job, returning False if it has already finished.  A job
+        which has not started never runs; a parse in progress stops at the
+        next chunk boundary.
+        '''
+        with self._cond:
+            if self._state in ('finished', 'cancelled'):
+                return self._state == 'cancelled'
+            self._state = 'cancelled'
+            self._exc = WaxCancelledError()
+            self._cond.notifyAll()
+        self._run_callbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def done(self):
+        return self._state in ('finished', 'cancelled')
+
+    def result(self, timeout=None):
+        '''
+        Wait up to 'timeout' seconds for the job to finish and return its
+        result, raising its exception if it failed.
+        '''
+        with self._cond:
+            if not self.done():
+                self._cond.wait(timeout)
+            if not self.done():
+                raise WaxError(E_TIMEOUT)
+            if self._exc is not None:
+                raise self._exc
+            return self._result
+
+    def add_done_callback(self, func):
+        '''
+        Call 'func(job)' once the job finishes or is cancelled, on the thread
+        which finished it, or immediately if it already has.
+        '''
+        with self._cond:
+            if not self.done():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _check(self):
+        "Raise WaxCancelledError if the job was cancelled."
+        if self._state == 'cancelled':
+            raise WaxCancelledError()
+
+    def _run(self):
+        with self._cond:
+            if self._state != 'pending':
+                return
+            self._state = 'running'
+        # anything not caught below, such as KeyboardInterrupt, stops the
+        # job as if it were cancelled.
+        res = None
+        exc = WaxCancelledError()
+        try:
+            res = self._func(self, *self._args)
+            exc = None
+        except Exception, exc:
+            pass
+        finally:
+            self._finish(res, exc)
+
+    def _finish(self, res, exc):
+        "Record the outcome of _run(), unless cancel() got there first."
+        with self._cond:
+            if self._state != 'running':
+                return
+            if isinstance(exc, WaxCancelledError):
+                self._state = 'cancelled'
+            else:
+                self._state = 'finished'
+            self._result = res
+            self._exc = exc
+            self._cond.notifyAll()
+        self._run_callbacks()
+
+    def _run_callbacks(self):
+        callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
+
+
+class WaxLoader(object):
+
+    '''
+    Loads and parses Wax files on worker threads, returning a WaxJob for
+    each request so the calling thread is never blocked.
+
+    At most 'workers' jobs run at once.  By default the loader starts its
+    own daemon threads; pass 'executor', any object with a submit(func)
+    method such as a concurrent.futures executor, to run jobs there
+    instead.
+
+    Input is parsed in chunks of about 'chunk_size' bytes, split at group
+    declarations, giving up the interpreter between chunks so that other
+    threads stay responsive, and checking for cancellation.  The result is
+    the same as calling parse_wax() on the whole input.
+    '''
+
+    def __init__(self, workers=2, executor=None, chunk_size=1 << 16):
+        self.workers = workers
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self._slots = threading.BoundedSemaphore(workers)
+        self._queue = None
+        self._threads = []
+        self._closed = False
+
+    def load(self, path):
+        "Read and parse the file at 'path'."
+        return self.submit(_load_path, path, self.chunk_size)
+
+    def parse(self, data):
+        "Parse the str 'data'."
+        return self.submit(_load_stream, cStringIO.StringIO(data).read,
+            self.chunk_size)
+
+    def parse_stream(self, read):
+        '''
+        Parse the data returned by calling 'read(size)' until it returns an
+        empty string, such as the read method of a file or socket file.
+        Parsing proceeds as the data arrives.
+        '''
+        return self.submit(_load_stream, read, self.chunk_size)
+
+    def submit(self, func, *args):
+        '''
+        Run 'func(job, *args)' as a job, for work such as WaxWatcher.poll()
+        which should share the loader's limits.  'func' may call
+        job._check() to stop early if the job is cancelled.
+        '''
+        if self._closed:
+            raise WaxError(E_CLOSED)
+        job = WaxJob(func, args)
+        if self.executor is not None:
+            self.executor.submit(self._run, job)
+            return job
+        if self._queue is None:
+            self._queue = Queue.Queue()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work,
+                    name='WaxLoader-%d' % i)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put(job)
+        return job
+
+    def close(self):
+        '''
+        Stop accepting jobs and wait for the loader's own threads to finish
+        those already submitted.
+        '''
+        self._closed = True
+        if self._queue is not None:
+            for thread in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            self._run(job)
+
+    def _run(self, job):
+        if job.done():
+            return
+        self._slots.acquire()
+        try:
+            job._run()
+        finally:
+            self._slots.release()
+
+
+# Implementation details are below.  You shouldn't need these for
+# typical uses of WaxLoader.
+
+
+def _load_path(job, path, size):
+    f = open(path, 'rb')
+    try:
+        return _load_stream(job, f.read, size)
+    finally:
+        f.close()
+
+
+def _load_stream(job, read, size):
+    '''
+    Parse the data from 'read' into a new Wax instance, one run of whole
+    sections at a time.  If a run fails to parse on its own, the whole input
+    is parsed again so the error is reported as parse_wax() would.
+    '''
+    dest = Wax()
+    pieces = []
+    scanner = _Scanner()
+    while True:
+        job._check()
+        data = read(size)
+        if data:
+            pieces.append(data)
+            end = scanner.feed(data)
+        else:
+            end = scanner.size
+        if end:
+            try:
+                parse_wax(scanner.take(end), dest)
+            except WaxError:
+                while data:
+                    data = read(size)
+                    pieces.append(data)
+                return parse_wax(''.join(pieces))
+            # let other threads run between chunks
+            time.sleep(0)
+        if not data:
+            return dest
+
+
+# an incomplete line which may still turn out to declare a group
+RE_SECTION_START = re.compile(r'[ \t]*(\[[^\]\n]*)?\Z')
+
+
+class _Scanner(object):
+
+    '''
+    Finds the group declarations at which the data read so far can be split
+    into runs of whole sections, see _load_stream().  feed() searches only
+    the new data and the incomplete line before it, so that a long run
+    without a usable declaration is not searched again for each chunk.
+    '''
+
+    def __init__(self):
+        # data not taken yet, and its length
+        self.pending = []
+        self.size = 0
+        # the incomplete last line, or a stand-in for it once it can no
+        # longer declare a group: its first character and any ';'
+        self.line = ''
+        # true if the complete lines end with an annotation
+        self.note = False
+
+    def feed(self, data):
+        '''
+        Add 'data' and return the offset of the last group declaration at
+        which the data not taken yet can be split, or 0 if there is none.
+        '''
+        text = self.line + data
+        base = self.size - len(self.line)
+        self.pending.append(data)
+        self.size += len(data)
+        prev = self.note and ';\n' or ''
+        end = 0
+        starts = [m.start() for m in RE_SECTION.finditer(text)]
+        for i in range(len(starts) - 1, -1, -1):
+            pos = starts[i]
+            if base + pos <= 0:
+                break
+            # _open_annotation() stops at the declaration before, if any
+            if i:
+                before = text[starts[i - 1]:pos]
+            else:
+                before = prev + text[:pos]
+            if not _open_annotation(before):
+                end = base + pos
+                break
+        nl = text.rfind('\n') + 1
+        if nl:
+            self.note = _open_annotation(prev + text[:nl])
+        line = text[nl:]
+        head = line.lstrip()[:1]
+        if head and not RE_SECTION_START.match(line):
+            # only what _open_annotation() looks at matters from here on
+            line = (head == '#' and '#' or 'x') + (';' in line and ';' or '')
+        self.line = line
+        return end
+
+    def take(self, end):
+        "Remove and return the first 'end' bytes of the data not taken yet."
+        text = ''.join(self.pending)
+        self.pending = [text[end:]]
+        self.size -= end
+        return text[:end]
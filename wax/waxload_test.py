@@ -0,0 +1,192 @@
+
+# waxload module unit tests.
+#
+# Author: Patrick Hensley <spaceboy@indirect.com>
+
+
+# std
+import cStringIO
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+# local
+from waximpl import parse_wax, Wax, WaxError
+from waxload import WaxCancelledError, WaxLoader, _Scanner
+
+
+SAMPLE = """
+# top-level settings
+name = "sample"
+
+; the listening socket
+[server]
+address = "0.0.0.0"
+port = 8080
+# trailing server comment
+
+[logger.console]
+; where to write
+impl = "CONSOLE"
+levels = [
+  ["DEBUG", 1]
+]
+
+[logger]
+level = "ALL"
+"""
+
+
+class _Executor(object):
+
+    "Runs each submitted function on a new thread."
+
+    def __init__(self):
+        self.count = 0
+
+    def submit(self, func, *args):
+        self.count += 1
+        thread = threading.Thread(target=func, args=args)
+        thread.start()
+
+
+class TestWaxLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.loader = WaxLoader(chunk_size=8)
+
+    def tearDown(self):
+        self.loader.close()
+
+    def _check(self, res, data):
+        exp = parse_wax(data)
+        self.assertEquals(res, exp)
+        self.assertEquals(str(res), str(exp))
+        self.assertEquals(res._fingerprint(True, True),
+            exp._fingerprint(True, True))
+
+    def test_parse(self):
+        # small chunks split the input at every possible group
+        for size in (1, 8, 64, 1 << 16):
+            loader = WaxLoader(chunk_size=size)
+            self._check(loader.parse(SAMPLE).result(), SAMPLE)
+            loader.close()
+        job = self.loader.parse_stream(cStringIO.StringIO(SAMPLE).read)
+        self._check(job.result(), SAMPLE)
+
+        # declarations split across chunks, after annotations, or after
+        # lines longer than a chunk
+        data = '; a\n[a]\nx = "%s;"\n  [b] ; b\n# [c]\n[c]\ny = 2\n' \
+            '\t[d]\n#%s\n[e]\nz = 3 ; z\n[f]\n' % ('x' * 20, '[' * 20)
+        for size in (1, 2, 3, 5, 8, 13):
+            loader = WaxLoader(chunk_size=size)
+            self._check(loader.parse(data).result(), data)
+            loader.close()
+
+    def test_scanner(self):
+        # runs end at the last declaration not following an annotation
+        scanner = _Scanner()
+        self.assertEquals(scanner.feed('[a]\nx = 1\n[b'), 0)
+        self.assertEquals(scanner.feed(']\ny = 2 ; note\n[c]\n'), 10)
+        self.assertEquals(scanner.take(10), '[a]\nx = 1\n')
+        self.assertEquals(scanner.feed('[d]'), 21)
+        self.assertEquals(scanner.take(21), '[b]\ny = 2 ; note\n[c]\n')
+        self.assertEquals((scanner.size, scanner.take(3)), (3, '[d]'))
+
+        # only new data is searched, so long runs cost linear time
+        data = ''.join(['; n\n[g%d]\nk = 1\n' % i for i in range(20000)])
+        start = time.time()
+        scanner = _Scanner()
+        for pos in range(0, len(data), 1024):
+            self.assertEquals(scanner.feed(data[pos:pos + 1024]), 0)
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEquals(scanner.take(scanner.size), data)
+
+    def test_load(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'test.wax')
+            f = open(path, 'wb')
+            f.write(SAMPLE)
+            f.close()
+            self._check(self.loader.load(path).result(), SAMPLE)
+            job = self.loader.load(os.path.join(tmp, 'missing.wax'))
+            self.assertRaises(IOError, job.result)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_errors(self):
+        data = SAMPLE.replace('level = "ALL"', 'level = ')
+        try:
+            parse_wax(data)
+        except WaxError, exc:
+            expected = str(exc)
+        job = self.loader.parse(data)
+        try:
+            job.result()
+            self.fail('expected a WaxError')
+        except WaxError, exc:
+            self.assertEquals(str(exc), expected)
+
+    def test_cancel(self):
+        started = threading.Event()
+        release = threading.Event()
+        loader = WaxLoader(workers=1)
+
+        def block(job):
+            started.set()
+            release.wait()
+            job._check()
+            return 1
+
+        first = loader.submit(block)
+        queued = loader.parse(SAMPLE)
+        seen = []
+        queued.add_done_callback(seen.append)
+        started.wait()
+        # one job at a time, so the second is still waiting
+        self.assertFalse(queued.done())
+        self.assertTrue(queued.cancel())
+        self.assertEquals(seen, [queued])
+        self.assertRaises(WaxError, first.result, 0.01)
+        self.assertTrue(first.cancel())
+        release.set()
+        loader.close()
+        self.assertRaises(WaxCancelledError, first.result)
+        self.assertRaises(WaxCancelledError, queued.result)
+        self.assertTrue(queued.cancelled())
+
+        done = self.loader.parse(SAMPLE)
+        done.result()
+        self.assertFalse(done.cancel())
+
+        # a job stopped by WaxCancelledError from its own work is cancelled
+        def stop(job):
+            raise WaxCancelledError()
+        job = self.loader.submit(stop)
+        seen = []
+        job.add_done_callback(seen.append)
+        self.assertRaises(WaxCancelledError, job.result, 5)
+        self.assertTrue(job.cancelled())
+        self.assertEquals(seen, [job])
+        self.loader.close()
+        self.assertRaises(WaxError, self.loader.parse, SAMPLE)
+
+    def test_executor(self):
+        executor = _Executor()
+        loader = WaxLoader(executor=executor)
+        jobs = [loader.parse(SAMPLE) for i in range(4)]
+        for job in jobs:
+            self._check(job.result(), SAMPLE)
+        self.assertEquals(executor.count, 4)
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == "__main__":
+    main()
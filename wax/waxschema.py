@@ -0,0 +1,305 @@
+
+# waxschema - compiled validation of Wax trees.
+#
+# Author: Patrick Hensley <spaceboy@indirect.com>
+
+
+# std
+import array
+import fnmatch
+import re
+
+# local
+from waximpl import Wax, WaxError
+
+
+__all__ = ["WaxSchema", "WaxSchemaError"]
+
+
+# JSON type names accepted by the 'type' field, and their Python types.
+# 'group' is a Wax instance, 'object' a dict value.
+TYPES = {
+    'any': None,
+    'array': (list, array.array),
+    'boolean': (bool,),
+    'group': (Wax,),
+    'integer': (int, long),
+    'null': (type(None),),
+    'number': (int, long, float),
+    'object': (dict,),
+    'string': (str, unicode),
+    }
+
+# Fields of a key description, and those which only apply to groups.
+KEY_FIELDS = set(['type', 'required', 'min', 'max', 'enum', 'items'])
+GROUP_FIELDS = set(['fields', 'patterns', 'extra'])
+
+E_BADDESC = "schema for '%s': %s"
+E_BADFIELD = "unknown field '%s'"
+E_BADTYPE = "unknown type '%s'"
+E_ENUM = "value %r is not one of %r"
+E_EXTRA = "unexpected key"
+E_MAX = "%s %s is greater than maximum %s"
+E_MIN = "%s %s is less than minimum %s"
+E_REQUIRED = "missing required key"
+E_TYPE = "expected %s, found %s"
+
+
+class WaxSchemaError(WaxError):
+
+    '''
+    Raised by WaxSchema.validate().  'errors' is the list of (path, message)
+    pairs describing each violation.
+    '''
+
+    def __init__(self, errors):
+        self.errors = errors
+        msg = '\n'.join(['%s: %s' % (path or '<top>', text)
+            for path, text in errors])
+        WaxError.__init__(self, msg)
+
+
+class WaxSchema(object):
+
+    '''
+    A declarative description of a Wax tree, compiled into a validator.
+
+    The description is a dict, or a Wax instance, describing the top-level
+    group.  A group description has the fields:
+
+      fields      - dict mapping key names to key descriptions
+      patterns    - list of (fnmatch pattern, key description) pairs, or a
+                    dict, for keys not named in 'fields'.  The first
+                    matching pattern applies.
+      extra       - whether keys matched by neither are allowed (default)
+
+    A key description has the fields:
+
+      type        - a type name, or a list of them: 'string', 'integer',
+                    'number', 'boolean', 'null', 'array', 'object' (a dict
+                    value), 'group' (a Wax instance) or 'any' (default)
+      required    - whether the key must exist
+      min, max    - bounds of a number, or of the length of a string/array
+      enum        - list of the allowed values
+      items       - key description which every item of an array must meet
+
+    plus the group fields if the key is a group.
+
+    See validate() and check().
+    '''
+
+    def __init__(self, desc):
+        self.desc = desc
+        desc = _as_dict(desc)
+        if isinstance(desc, dict):
+            for field in desc:
+                if field not in GROUP_FIELDS:
+                    raise WaxError(E_BADDESC % ('', E_BADFIELD % field))
+        self._check = _compile_group(desc, '')
+
+    def check(self, obj, coerce=False):
+        '''
+        Check 'obj' in one pass and return a list of (path, message) pairs,
+        one for each violation.  If 'coerce' is true, values are converted
+        to their described type where possible, and stored back: longs
+        which fit become ints, numeric strings become integers or numbers,
+        and 'true' / 'false' become booleans.  Interpolated values are
+        checked as resolved but not stored back.
+        '''
+        if not isinstance(obj, Wax):
+            return [('', E_TYPE % ('group', _type_name(obj)))]
+        errors = []
+        if coerce:
+            with obj._batch():
+                self._check(obj, '', errors, True)
+        else:
+            self._check(obj, '', errors, False)
+        return errors
+
+    def validate(self, obj, coerce=False):
+        '''
+        Check 'obj' as check() does, raising a WaxSchemaError listing every
+        violation found.  Returns 'obj'.
+        '''
+        errors = self.check(obj, coerce)
+        if errors:
+            raise WaxSchemaError(errors)
+        return obj
+
+
+# Implementation details are below.  You shouldn't need these for
+# typical uses of WaxSchema.
+
+
+def _as_dict(desc):
+    if isinstance(desc, Wax):
+        return desc._to_dict()
+    return desc
+
+
+def _type_name(val):
+    if isinstance(val, bool):
+        return 'boolean'
+    for name in ('integer', 'number', 'string', 'null', 'array', 'object',
+            'group'):
+        if isinstance(val, TYPES[name]):
+            return name
+    return type(val).__name__
+
+
+def _compile_group(desc, where):
+    '''
+    Return a function checking the keys of a Wax instance against the group
+    description 'desc'.
+    '''
+    if not isinstance(desc, dict):
+        raise WaxError(E_BADDESC % (where, 'expected a dict'))
+    fields = {}
+    required = []
+    for key, sub in (desc.get('fields') or {}).items():
+        sub = _as_dict(sub)
+        fields[key] = _compile_key(sub, where and where + '.' + key or key)
+        if isinstance(sub, dict) and sub.get('required'):
+            required.append(key)
+    patterns = desc.get('patterns') or []
+    if isinstance(patterns, dict):
+        patterns = patterns.items()
+    matchers = []
+    for pattern, sub in patterns:
+        match = re.compile(fnmatch.translate(pattern)).match
+        matchers.append((match, _compile_key(_as_dict(sub), pattern)))
+    extra = desc.get('extra', True)
+
+    def check_group(node, path, errors, coerce):
+        prefix = path and path + '.' or ''
+        d = node.__dict__
+        keys = node.keys()
+        for key in keys:
+            check = fields.get(key)
+            if check is None:
+                for match, check in matchers:
+                    if match(key):
+                        break
+                else:
+                    if not extra:
+                        errors.append((prefix + key, E_EXTRA))
+                    continue
+            if key in d:
+                val = d[key]
+            else:
+                val = node[key]
+            res = check(val, prefix + key, errors, coerce)
+            # interpolated strings are kept as written, see _interpolate()
+            if res is not val and not (node._interp and key in node._interp):
+                node[key] = res
+        if required:
+            present = set(keys)
+            for key in required:
+                if key not in present:
+                    errors.append((prefix + key, E_REQUIRED))
+    return check_group
+
+
+def _compile_key(desc, where):
+    '''
+    Return a function checking a value against the key description 'desc'.
+    The function returns the value, coerced if requested.
+    '''
+    if not isinstance(desc, dict):
+        raise WaxError(E_BADDESC % (where, 'expected a dict'))
+    for field in desc:
+        if field not in KEY_FIELDS and field not in GROUP_FIELDS:
+            raise WaxError(E_BADDESC % (where, E_BADFIELD % field))
+    names = desc.get('type') or 'any'
+    if isinstance(names, basestring):
+        names = [names]
+    for name in names:
+        if name not in TYPES:
+            raise WaxError(E_BADDESC % (where, E_BADTYPE % name))
+    if 'any' in names:
+        types = None
+    else:
+        types = ()
+        for name in names:
+            types += TYPES[name]
+    allow_bool = 'boolean' in names
+    expected = ' or '.join(names)
+    vmin = desc.get('min')
+    vmax = desc.get('max')
+    enum = desc.get('enum')
+    group = None
+    if 'group' in names or GROUP_FIELDS.intersection(desc):
+        group = _compile_group(desc, where)
+    items = None
+    if 'items' in desc:
+        items = _compile_key(_as_dict(desc['items']), where + '[]')
+
+    def check_key(val, path, errors, coerce):
+        if coerce:
+            val = _coerce(val, names)
+        if types is not None:
+            if not isinstance(val, types) or \
+                    (isinstance(val, bool) and not allow_bool):
+                errors.append((path, E_TYPE % (expected, _type_name(val))))
+                return val
+        if enum is not None and val not in enum:
+            errors.append((path, E_ENUM % (val, enum)))
+        if vmin is not None or vmax is not None:
+            if isinstance(val, (basestring, list, array.array)):
+                what, size = 'length', len(val)
+            elif isinstance(val, (int, long, float)):
+                what, size = 'value', val
+            else:
+                what = None
+            if what and vmin is not None and size < vmin:
+                errors.append((path, E_MIN % (what, size, vmin)))
+            if what and vmax is not None and size > vmax:
+                errors.append((path, E_MAX % (what, size, vmax)))
+        if group is not None and isinstance(val, Wax):
+            group(val, path, errors, coerce)
+        if items is not None and isinstance(val, (list, array.array)):
+            copied = False
+            for i, item in enumerate(val):
+                res = items(item, '%s[%d]' % (path, i), errors, coerce)
+                if res is not item:
+                    # lists may be shared, so copy before the first change
+                    if not copied:
+                        val = list(val)
+                        copied = True
+                    val[i] = res
+        return val
+    return check_key
+
+
+def _coerce(val, names):
+    '''
+    Convert 'val' to the first of the type names 'names' it can be
+    converted to.  Returns 'val' itself if it needs no conversion.
+    '''
+    if isinstance(val, bool):
+        return val
+    if isinstance(val, long):
+        if 'integer' in names or 'number' in names:
+            res = int(val)
+            # int() returns a long if the value does not fit
+            if isinstance(res, int):
+                return res
+        return val
+    if not isinstance(val, basestring):
+        return val
+    for name in names:
+        if name in ('string', 'any'):
+            return val
+        try:
+            if name == 'integer':
+                return int(val)
+            elif name == 'number':
+                try:
+                    return int(val)
+                except ValueError:
+                    return float(val)
+        except ValueError:
+            continue
+        if name == 'boolean' and val in ('true', 'false'):
+            return val == 'true'
+    return val
@@ -0,0 +1,168 @@
+
+# waxschema module unit tests.
+#
+# Author: Patrick Hensley <spaceboy@indirect.com>
+
+
+# std
+import unittest
+
+# local
+from waximpl import parse_wax, Wax, WaxError
+from waxschema import WaxSchema, WaxSchemaError
+
+
+SAMPLE = """
+[server]
+address = "0.0.0.0"
+port = 8080
+
+[memcache]
+hosts = ["memcache01", "memcache02"]
+timeout = 1.2
+retries = 3
+
+[logger.console]
+impl = "CONSOLE"
+level = "DEBUG"
+
+[logger.file]
+impl = "FILE"
+level = "ERROR"
+path = "/logs/wax.log"
+"""
+
+SCHEMA = {
+    'fields': {
+        'server': {
+            'type': 'group',
+            'required': True,
+            'extra': False,
+            'fields': {
+                'address': {'type': 'string', 'required': True},
+                'port': {'type': 'integer', 'min': 1, 'max': 65535},
+                },
+            },
+        'memcache': {
+            'fields': {
+                'hosts': {'type': 'array', 'min': 1,
+                    'items': {'type': 'string'}},
+                'timeout': {'type': 'number', 'max': 5},
+                'retries': {'type': ['integer', 'null']},
+                },
+            },
+        'logger': {
+            'patterns': [
+                ['*', {'fields': {
+                    'level': {'enum': ['DEBUG', 'INFO', 'ERROR'],
+                        'required': True},
+                    }}],
+                ],
+            },
+        },
+    }
+
+
+class TestWaxSchema(unittest.TestCase):
+
+    def test_valid(self):
+        w = parse_wax(SAMPLE)
+        schema = WaxSchema(SCHEMA)
+        self.assertEquals(schema.check(w), [])
+        self.assertTrue(schema.validate(w) is w)
+
+    def test_violations(self):
+        w = parse_wax(SAMPLE)
+        w.server.port = 0
+        w.server.extra = 1
+        del w.server.address
+        w.memcache.hosts = ['a', 2]
+        w.memcache.retries = True
+        w.logger.file.level = 'TRACE'
+        del w.logger.console.level
+        schema = WaxSchema(SCHEMA)
+        self.assertEquals(sorted(schema.check(w)), [
+            ('logger.console.level', 'missing required key'),
+            ('logger.file.level',
+                "value 'TRACE' is not one of ['DEBUG', 'INFO', 'ERROR']"),
+            ('memcache.hosts[1]', 'expected string, found integer'),
+            ('memcache.retries', 'expected integer or null, found boolean'),
+            ('server.address', 'missing required key'),
+            ('server.extra', 'unexpected key'),
+            ('server.port', 'value 0 is less than minimum 1'),
+            ])
+        try:
+            schema.validate(w)
+            self.fail('expected WaxSchemaError')
+        except WaxSchemaError, e:
+            self.assertEquals(len(e.errors), 7)
+            self.assertTrue(isinstance(e, WaxError))
+        self.assertEquals(WaxSchema({'fields': {'a': {'required': True}}})
+            .check(Wax()), [('a', 'missing required key')])
+
+    def test_coerce(self):
+        w = parse_wax(SAMPLE)
+        self.assertTrue(isinstance(w.server.port, long))
+        w.memcache.timeout = '1.5'
+        w.memcache.retries = '3'
+        schema = WaxSchema(SCHEMA)
+        self.assertEquals(schema.check(w, coerce=True), [])
+        self.assertTrue(isinstance(w.server.port, int))
+        self.assertEquals(w.memcache.timeout, 1.5)
+        self.assertEquals(w.memcache.retries, 3)
+
+        # list items are coerced in a copy
+        hosts = [1L, '2']
+        w = Wax(a=hosts)
+        schema = WaxSchema({'fields': {'a': {'items': {'type': 'integer'}}}})
+        self.assertEquals(schema.check(w, coerce=True), [])
+        self.assertEquals(w.a, [1, 2])
+        self.assertTrue(isinstance(w.a[0], int))
+        self.assertEquals(hosts, [1L, '2'])
+        w = Wax(a='yes', b='true')
+        schema = WaxSchema({'fields': {'a': {'type': 'boolean'},
+            'b': {'type': 'boolean'}}})
+        self.assertEquals(schema.check(w, coerce=True),
+            [('a', 'expected boolean, found string')])
+        self.assertEquals(w.b, True)
+
+        # interpolated values are checked but keep their references
+        w = parse_wax('port = "${base}"\nbase = "80"\n')._interpolate()
+        schema = WaxSchema({'fields': {'port': {'type': 'integer'},
+            'base': {'type': 'integer'}}})
+        self.assertEquals(schema.check(w, coerce=True), [])
+        self.assertEquals(str(w), 'port = "${base}"\nbase = 80\n\n')
+        self.assertEquals(w.port, 80)
+
+    def test_typed_arrays(self):
+        w = parse_wax('a = [1, 2, 3]\nb = [0.5]\n', typed_arrays=True)
+        schema = WaxSchema({'fields': {
+            'a': {'type': 'array', 'max': 2, 'items': {'type': 'integer'}},
+            'b': {'type': 'array', 'items': {'type': 'string'}},
+            }})
+        self.assertEquals(schema.check(w), [
+            ('a', 'length 3 is greater than maximum 2'),
+            ('b[0]', 'expected string, found number'),
+            ])
+
+    def test_wax_description(self):
+        desc = parse_wax('[fields.port]\ntype = "integer"\nmax = 10\n')
+        schema = WaxSchema(desc)
+        self.assertEquals(schema.check(Wax(port=11)),
+            [('port', 'value 11 is greater than maximum 10')])
+
+    def test_bad_description(self):
+        for desc in ({'fields': {'a': 1}}, {'fields': {'a': {'type': 'x'}}},
+                {'fields': {'a': {'bogus': 1}}}, [],
+                {'feilds': {'a': {'required': True}}}, {'extar': False},
+                {'type': 'group'}, Wax(fields=Wax(), extar=False)):
+            self.assertRaises(WaxError, WaxSchema, desc)
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == "__main__":
+    main()
+
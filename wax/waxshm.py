@@ -0,0 +1,313 @@
+
+# waxshm - read-only Wax views of a shared memory-mapped encoding.
+#
+# Author: Patrick Hensley <spaceboy@indirect.com>
+
+
+# std
+import cStringIO
+import mmap
+import os
+import struct
+
+# local
+import microjson
+from waximpl import E_READONLY, Wax, WaxError
+
+
+__all__ = ["WaxView", "open_view", "wax_to_view", "write_view"]
+
+
+# The encoding starts with a header holding the magic bytes, the format
+# version and the offset of the top-level group.  All offsets are relative
+# to the start of the encoding, so it can be mapped at any address.
+MAGIC = 'WAXV'
+VERSION = 1
+HEADER = struct.Struct('<4sII')
+
+# A group is its key count, followed by one entry per key in key order,
+# then the entry numbers sorted by key name for binary search.
+COUNT = struct.Struct('<I')
+ENTRY = struct.Struct('<IBq')
+
+# Value tags of an entry.  Numbers which fit in 64 bits, booleans and null
+# are stored in the entry; other values are offsets to a group or to a
+# length-prefixed string, which are stored once however many entries refer
+# to them.
+T_GROUP, T_STR, T_UNICODE, T_INT, T_LONG, T_BIGLONG, T_FLOAT, T_TRUE, \
+    T_FALSE, T_NULL, T_JSON = range(11)
+
+FLOAT = struct.Struct('<d')
+INT64 = struct.Struct('<q')
+MAX_OFFSET = (1 << 32) - 1
+MIN_INT64 = -(1 << 63)
+MAX_INT64 = (1 << 63) - 1
+
+E_BADVIEW = "not a Wax view encoding"
+E_TOOBIG = "encoding exceeds 4GB"
+
+
+class WaxView(object):
+
+    '''
+    A read-only view of a group in a Wax tree encoded by wax_to_view().
+    The buffer may be a str or an mmap, and is read in place: values are
+    decoded each time they are accessed, and nothing is cached, so processes
+    mapping the same file share its memory.
+
+    Keys are read as attributes, 'view["dotted.path"]', or with get(), and
+    groups are returned as views.  As with Wax, dotted paths continue into
+    dict values.  Lists and dicts are decoded into new objects on each
+    access.  Comments and annotations are not stored.
+    '''
+
+    __slots__ = ('_buf', '_off', '_count')
+
+    def __init__(self, buf, offset=None):
+        if offset is None:
+            if len(buf) < HEADER.size:
+                raise WaxError(E_BADVIEW)
+            magic, version, offset = HEADER.unpack_from(buf, 0)
+            if magic != MAGIC or version != VERSION:
+                raise WaxError(E_BADVIEW)
+        object.__setattr__(self, '_buf', buf)
+        object.__setattr__(self, '_off', offset)
+        object.__setattr__(self, '_count', COUNT.unpack_from(buf, offset)[0])
+
+    def __setattr__(self, key, val):
+        raise WaxError(E_READONLY % key)
+
+    def __delattr__(self, key):
+        raise WaxError(E_READONLY % key)
+
+    def __getattr__(self, key):
+        if key[0] == '_':
+            raise AttributeError(key)
+        idx = self._find(key)
+        if idx < 0:
+            raise AttributeError(key)
+        return self._value(idx)
+
+    def __getitem__(self, key):
+        curr = self
+        for part in key.split('.'):
+            if isinstance(curr, dict):
+                # like Wax, drill into dict values
+                curr = curr[part]
+                continue
+            if not isinstance(curr, WaxView):
+                raise KeyError(key)
+            idx = curr._find(part)
+            if idx < 0:
+                raise KeyError(key)
+            curr = curr._value(idx)
+        return curr
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        "Return the key names in order."
+        buf = self._buf
+        base = self._off + COUNT.size
+        return [_string(buf, ENTRY.unpack_from(buf, base + i * ENTRY.size)[0])
+            for i in xrange(self._count)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self._count
+
+    def __eq__(self, obj):
+        if isinstance(obj, WaxView):
+            obj = obj._to_wax()
+        return self._to_wax() == obj
+
+    def __ne__(self, obj):
+        return not self.__eq__(obj)
+
+    def __repr__(self):
+        return 'WaxView(%s)' % ', '.join(self.keys())
+
+    def _to_wax(self):
+        "Decode this view and the groups below it into a new Wax instance."
+        res = Wax()
+        for idx, key in enumerate(self.keys()):
+            val = self._value(idx)
+            if isinstance(val, WaxView):
+                val = val._to_wax()
+            res[key] = val
+        return res
+
+    def _find(self, key):
+        "Binary search for 'key', returning its entry number or -1."
+        buf = self._buf
+        base = self._off + COUNT.size
+        index = base + self._count * ENTRY.size
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            idx = COUNT.unpack_from(buf, index + mid * COUNT.size)[0]
+            name = _string(buf, ENTRY.unpack_from(buf,
+                base + idx * ENTRY.size)[0])
+            if name < key:
+                lo = mid + 1
+            elif name > key:
+                hi = mid
+            else:
+                return idx
+        return -1
+
+    def _value(self, idx):
+        buf = self._buf
+        tag, val = ENTRY.unpack_from(buf,
+            self._off + COUNT.size + idx * ENTRY.size)[1:]
+        if tag == T_LONG:
+            return long(val)
+        elif tag == T_STR:
+            return _string(buf, val)
+        elif tag == T_GROUP:
+            return WaxView(buf, val)
+        elif tag == T_UNICODE:
+            return _string(buf, val).decode('utf-8')
+        elif tag == T_FLOAT:
+            return FLOAT.unpack(INT64.pack(val))[0]
+        elif tag == T_TRUE:
+            return True
+        elif tag == T_FALSE:
+            return False
+        elif tag == T_NULL:
+            return None
+        elif tag == T_INT:
+            return int(val)
+        elif tag == T_BIGLONG:
+            return long(_string(buf, val))
+        return microjson.from_json(_string(buf, val))
+
+
+def wax_to_view(obj):
+    '''
+    Encode the Wax instance 'obj' for WaxView, returning a str.  Interpolated
+    values are stored resolved.
+    '''
+    out = _Writer()
+    root = out.group(obj)
+    data = out.buf.getvalue()
+    return HEADER.pack(MAGIC, VERSION, root) + data[HEADER.size:]
+
+
+def write_view(obj, path):
+    '''
+    Encode the Wax instance 'obj' into the file at 'path'.  The file is
+    replaced atomically, so processes opening it see the old encoding or the
+    new one.  On Linux, a path under /dev/shm keeps it in memory.
+    '''
+    data = wax_to_view(obj)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    f = open(tmp, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+
+def open_view(path):
+    '''
+    Map the file at 'path', written by write_view(), and return a WaxView of
+    its top-level group.  The mapping is read-only and shared with every
+    other process mapping the file.
+    '''
+    f = open(path, 'rb')
+    try:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    return WaxView(buf)
+
+
+# Implementation details are below.  You shouldn't need these for
+# typical uses of WaxView.
+
+
+def _string(buf, off):
+    "Return the length-prefixed string at offset 'off'."
+    size = COUNT.unpack_from(buf, off)[0]
+    off += COUNT.size
+    return buf[off:off + size]
+
+
+class _Writer(object):
+
+    "Appends the records of an encoding, storing each string once."
+
+    def __init__(self):
+        self.buf = cStringIO.StringIO()
+        self.buf.write('\0' * HEADER.size)
+        self.pos = HEADER.size
+        self.strings = {}
+
+    def write(self, data):
+        off = self.pos
+        if off > MAX_OFFSET:
+            raise WaxError(E_TOOBIG)
+        self.buf.write(data)
+        self.pos += len(data)
+        return off
+
+    def string(self, data):
+        off = self.strings.get(data)
+        if off is None:
+            off = self.strings[data] = \
+                self.write(COUNT.pack(len(data)) + data)
+        return off
+
+    def group(self, node):
+        "Write 'node' after the groups below it, returning its offset."
+        keys = node.keys()
+        entries = []
+        for key in keys:
+            val = node[key]
+            if isinstance(val, Wax):
+                entries.append((T_GROUP, self.group(val)))
+            elif val is True:
+                entries.append((T_TRUE, 0))
+            elif val is False:
+                entries.append((T_FALSE, 0))
+            elif val is None:
+                entries.append((T_NULL, 0))
+            elif isinstance(val, int):
+                entries.append((T_INT, val))
+            elif isinstance(val, long):
+                if MIN_INT64 <= val <= MAX_INT64:
+                    entries.append((T_LONG, val))
+                else:
+                    entries.append((T_BIGLONG, self.string(str(val))))
+            elif isinstance(val, float):
+                entries.append((T_FLOAT, INT64.unpack(FLOAT.pack(val))[0]))
+            elif isinstance(val, str):
+                entries.append((T_STR, self.string(val)))
+            elif isinstance(val, unicode):
+                entries.append((T_UNICODE, self.string(val.encode('utf-8'))))
+            else:
+                entries.append((T_JSON, self.string(microjson.to_json(val))))
+        names = [self.string(key) for key in keys]
+        chunks = [COUNT.pack(len(keys))]
+        for name, (tag, val) in zip(names, entries):
+            chunks.append(ENTRY.pack(name, tag, val))
+        order = range(len(keys))
+        order.sort(key=keys.__getitem__)
+        chunks.extend([COUNT.pack(i) for i in order])
+        return self.write(''.join(chunks))
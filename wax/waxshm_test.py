@@ -0,0 +1,110 @@
+
+# waxshm module unit tests.
+#
+# Author: Patrick Hensley <spaceboy@indirect.com>
+
+
+# std
+import os
+import shutil
+import tempfile
+import unittest
+
+# local
+from waximpl import parse_wax, Wax, WaxError
+from waxshm import WaxView, open_view, wax_to_view, write_view
+
+
+SAMPLE = """
+name = "sample"
+count = 12
+negative = -9223372036854775808
+big = 18446744073709551616
+ratio = -0.25
+enabled = true
+disabled = false
+missing = null
+greeting = "\\u201chello\\u201d"
+hosts = ["a", "b", {"c": [1, 2]}]
+limits = {"cpu": 2}
+
+[server]
+address = "0.0.0.0"
+port = 8080
+
+[logger.console]
+level = "DEBUG"
+
+[logger.file]
+level = "DEBUG"
+path = "/logs/wax.log"
+"""
+
+
+class TestWaxView(unittest.TestCase):
+
+    def test_view(self):
+        w = parse_wax(SAMPLE)
+        v = WaxView(wax_to_view(w))
+        self.assertEquals(v.keys(), w.keys())
+        self.assertEquals(list(v), w.keys())
+        self.assertEquals(len(v), len(w))
+        for key in ('name', 'count', 'negative', 'big', 'ratio', 'enabled',
+                'disabled', 'missing', 'greeting', 'hosts', 'limits'):
+            self.assertEquals(getattr(v, key), getattr(w, key))
+            self.assertEquals(type(getattr(v, key)), type(getattr(w, key)))
+        self.assertEquals(v.server.port, 8080)
+        self.assertEquals(v['logger.file.path'], '/logs/wax.log')
+        self.assertEquals(v.logger.keys(), ['console', 'file'])
+        self.assertTrue('logger.console.level' in v)
+        self.assertFalse('logger.console.impl' in v)
+        self.assertFalse('name.x' in v)
+        # dotted paths continue into dict values, as with Wax
+        self.assertEquals(v['limits.cpu'], w['limits.cpu'])
+        self.assertFalse('limits.mem' in v)
+        self.assertFalse('limits.cpu.x' in v)
+        self.assertEquals(v.get('server.missing', 1), 1)
+        self.assertRaises(AttributeError, getattr, v, 'missing_key')
+        self.assertRaises(KeyError, v.__getitem__, 'server.missing')
+        self.assertRaises(WaxError, setattr, v, 'name', 'x')
+        self.assertEquals(v._to_wax(), w)
+        self.assertEquals(v, w)
+        self.assertEquals(WaxView(wax_to_view(Wax())).keys(), [])
+
+        # ints and longs keep their types
+        v = WaxView(wax_to_view(Wax(small=3, count=w.count)))
+        self.assertEquals((type(v.small), type(v.count)), (int, long))
+
+    def test_shared_strings(self):
+        w = Wax.from_items([('g%d.level' % i, 'DEBUG') for i in range(100)])
+        data = wax_to_view(w)
+        self.assertEquals(data.count('DEBUG'), 1)
+        self.assertEquals(data.count('level'), 1)
+
+    def test_interpolated(self):
+        w = Wax(host='localhost', url='http://${host}/')
+        self.assertEquals(WaxView(wax_to_view(w._interpolate())).url,
+            'http://localhost/')
+
+    def test_file(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'test.waxv')
+            write_view(parse_wax(SAMPLE), path)
+            v = open_view(path)
+            self.assertEquals(v.server.address, '0.0.0.0')
+            self.assertEquals(os.listdir(tmp), ['test.waxv'])
+            f = open(path, 'wb')
+            f.write('nonsense')
+            f.close()
+            self.assertRaises(WaxError, open_view, path)
+        finally:
+            shutil.rmtree(tmp)
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+
+# waxwatch - reload Wax files when they change.
+#
+# Author: Patrick Hensley <spaceboy@indirect.com>
+
+
+# std
+import os
+import re
+import threading
+import time
+
+# local
+from waximpl import Wax, WaxError, WaxPatch, parse_wax, _path_copy
+
+
+__all__ = ["WaxWatcher"]
+
+
+# A group declaration at the start of a line begins a new section.
+RE_SECTION = re.compile(r'^[ \t]*\[([^\]\n]*)\]', re.M)
+
+
+class WaxWatcher(object):
+
+    '''
+    Watch a Wax file and publish a new snapshot of it each time it changes.
+
+    Changes are detected by polling the file's modification time, size and
+    inode, either by calling poll() or from a background thread started
+    with start().  A change is only loaded once the file has stayed the
+    same for 'debounce' seconds, so an editor writing the file in several
+    steps causes one reload.
+
+    The file is split into sections, one per group declaration.  When only
+    the contents of some sections change, just those sections are parsed
+    again and the groups they declare are replaced in a copy of the
+    current snapshot which shares every unchanged group with it.  Other
+    changes parse the whole file.
+
+    'wax' is the current snapshot.  It is replaced as a whole, never
+    modified, so readers either see the old tree or the new one.  Treat
+    snapshots as read-only, since unchanged groups are shared between
+    them.  Listeners are called with the new snapshot and the WaxPatch
+    from the old one.
+    '''
+
+    def __init__(self, path, interval=1.0, debounce=0.25):
+        self.path = path
+        self.interval = interval
+        self.debounce = debounce
+        self.error = None
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+        self._pending = None
+        self._sig = _signature(path)
+        self._load(_read(path))
+
+    def add_listener(self, callback):
+        '''
+        Call 'callback(wax, patch)' after each reload which changes the
+        snapshot.
+        '''
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def poll(self, now=None):
+        '''
+        Check the file once, reloading it if it changed and has since
+        settled.  Returns the WaxPatch applied, or None if the snapshot was
+        not replaced.  A file which fails to load raises WaxError or
+        IOError, which is also kept as 'error', and the current snapshot is
+        left in place.
+        '''
+        with self._lock:
+            sig = _signature(self.path)
+            if sig is None or sig == self._sig:
+                self._pending = None
+                return None
+            if now is None:
+                now = time.time()
+            if self._pending is None or self._pending[0] != sig:
+                self._pending = (sig, now)
+            if now - self._pending[1] < self.debounce:
+                return None
+            self._pending = None
+            self._sig = sig
+            try:
+                patch = self._update(_read(self.path))
+            except (WaxError, IOError), exc:
+                self.error = exc
+                raise
+            self.error = None
+        if patch:
+            for callback in list(self._listeners):
+                callback(self.wax, patch)
+            return patch
+        return None
+
+    def start(self):
+        "Poll the file every 'interval' seconds from a daemon thread."
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+            name='WaxWatcher(%s)' % self.path)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        "Stop the polling thread, waiting for it to exit."
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopped.set()
+        if thread is not threading.currentThread():
+            thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.isSet():
+            try:
+                self.poll()
+            except (WaxError, IOError):
+                # kept as self.error, retried when the file changes again
+                pass
+            self._stopped.wait(self.interval)
+
+    def _load(self, data):
+        "Parse all of 'data', replacing the snapshot and section cache."
+        self.wax = parse_wax(data)
+        self._sections = _split(data)
+        self._parsed = {}
+
+    def _reload(self, data):
+        "Parse all of 'data' and return the WaxPatch from the old snapshot."
+        old = self.wax
+        self._load(data)
+        return old._diff(self.wax)
+
+    def _update(self, data):
+        '''
+        Replace the snapshot with one for 'data', parsing only the sections
+        which changed if possible, and return the WaxPatch from the old
+        snapshot.  Only the changed groups are compared.
+        '''
+        sections = _split(data)
+        old = self._sections
+        if len(sections) != len(old):
+            return self._reload(data)
+        changed = []
+        for i, (group, text) in enumerate(sections):
+            if group != old[i][0]:
+                return self._reload(data)
+            if text != old[i][1]:
+                changed.append(i)
+        if not changed:
+            return WaxPatch()
+        names = {}
+        for group, text in sections:
+            names[group] = names.get(group, 0) + 1
+        top = self.wax
+        copied = {}
+        parsed = {}
+        ops = []
+        for i in changed:
+            group = sections[i][0]
+            if names[group] != 1:
+                return self._reload(data)
+            try:
+                prev = self._parsed.get(i) or _parse_section(*old[i])
+                curr = _parse_section(*sections[i])
+            except WaxError:
+                return self._reload(data)
+            if prev is None or curr is None:
+                return self._reload(data)
+            node = top._select_group(group)
+            new = _splice(node, prev, curr)
+            if new is None:
+                return self._reload(data)
+            ops.extend(_prefix(group, node._diff(new)))
+            top = _replace(top, group, new, copied)
+            parsed[i] = curr
+        self._parsed.update(parsed)
+        self._sections = sections
+        self.wax = top
+        return WaxPatch(ops)
+
+
+# Implementation details are below.  You shouldn't need these for
+# typical uses of WaxWatcher.
+
+
+def _signature(path):
+    "Return the (mtime, size, inode) of 'path', or None if it is missing."
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+def _read(path):
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def _split(data):
+    '''
+    Split 'data' into (group, text) sections.  The first section holds the
+    text before any group declaration and has the group ''.
+    '''
+    res = []
+    group = ''
+    pos = 0
+    for m in RE_SECTION.finditer(data):
+        res.append((group, data[pos:m.start()]))
+        group = m.group(1).strip()
+        pos = m.start()
+    res.append((group, data[pos:]))
+    return res
+
+
+def _open_annotation(text):
+    '''
+    Return whether 'text' ends with an annotation, which belongs to the key
+    or group following it.
+    '''
+    end = len(text)
+    while end > 0:
+        start = text.rfind('\n', 0, end) + 1
+        line = text[start:end].strip()
+        if line and line[0] != '#':
+            # an annotation may follow a value on the same line.  A ';'
+            # inside a string is taken for one, which is only cautious.
+            return ';' in line
+        end = start - 1
+    return False
+
+
+def _parse_section(group, text):
+    '''
+    Parse the section 'text' on its own, returning the group it declares.
+    Returns None if the section cannot be parsed apart from the rest of the
+    file: when it ends with an annotation, which belongs to the next group,
+    sets keys of other groups using dotted names, or declares a group in
+    the middle of a line.
+    '''
+    if _open_annotation(text):
+        return None
+    node = parse_wax(text)
+    for part in group and group.split('.') or ():
+        if node.keys() != [part]:
+            return None
+        node = node[part]
+    for key in node.keys():
+        if isinstance(node[key], Wax):
+            return None
+    return node
+
+
+def _splice(group, prev, curr):
+    '''
+    Return a copy of 'group' in which the keys and comments parsed from a
+    section as 'prev' are replaced by those of 'curr'.  The section's items
+    are contiguous in the group's key order, since no other section adds
+    keys or comments to it, and are replaced in place.  Returns None if the
+    group holds keys from other sections which are not groups.
+    '''
+    own = set(prev.keys())
+    new = set(curr.keys())
+    before = []
+    after = []
+    start = None
+    for key in group._key_order:
+        if isinstance(key, int) or key in own:
+            if start is None:
+                start = len(before)
+            continue
+        if key in new or not isinstance(group.__dict__.get(key), Wax):
+            return None
+        if start is None:
+            before.append(key)
+        else:
+            after.append(key)
+    if start is None and (before or after):
+        return None
+    res = Wax()
+    d = res.__dict__
+    for src, keys in ((group, before), (curr, curr._key_order),
+            (group, after)):
+        for key in keys:
+            if isinstance(key, int):
+                idx = res._comment_index
+                res._comment_index += 1
+                res._comments[idx] = src._comments[key]
+                res._key_order.append(idx)
+                continue
+            val = src.__dict__[key]
+            d[key] = val
+            res._key_order.append(key)
+            if isinstance(val, Wax):
+                res._link(key, val)
+            if key in src._annotations:
+                res._annotations[key] = src._annotations[key]
+    return res
+
+
+def _prefix(group, patch):
+    "Yield the operations of 'patch', made relative to the dotted 'group'."
+    if not group:
+        for op in patch:
+            yield op
+        return
+    for op in patch:
+        path = op[1] and group + '.' + op[1] or group
+        yield (op[0], path) + op[2:]
+
+
+def _replace(top, path, node, copied):
+    '''
+    Store 'node' at dotted 'path' in a copy of 'top' which shares every
+    other group with it.  See _path_copy().
+    '''
+    if not path:
+        copied[id(node)] = node
+        return node
+    if '.' in path:
+        group, key = path.rsplit('.', 1)
+    else:
+        group, key = '', path
+    top = _path_copy(top, group, copied)
+    parent = top._select_group(group)
+    parent.__dict__[key] = node
+    parent._link(key, node)
+    return top
@@ -0,0 +1,173 @@
+
+# waxwatch module unit tests.
+#
+# Author: Patrick Hensley <spaceboy@indirect.com>
+
+
+# std
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+# local
+from waximpl import parse_wax, Wax, WaxError
+from waxwatch import WaxWatcher
+
+
+SAMPLE = """
+# top-level settings
+name = "sample"
+
+; the listening socket
+[server]
+address = "0.0.0.0"
+port = 8080
+# trailing server comment
+
+[logger.console]
+impl = "CONSOLE"
+level = "DEBUG"
+
+[logger]
+; log everything
+level = "ALL"
+
+[logger.file]
+impl = "FILE"
+level = "ERROR"
+"""
+
+
+class TestWaxWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.wax')
+        self.mtime = 1000000000
+        self._write(SAMPLE)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, data):
+        f = open(self.path, 'wb')
+        f.write(data)
+        f.close()
+        # file systems may have coarse timestamps, so set one explicitly
+        self.mtime += 10
+        os.utime(self.path, (self.mtime, self.mtime))
+
+    def _check(self, w, data):
+        "assert the snapshot is the same as parsing 'data' from scratch"
+        exp = parse_wax(data)
+        self.assertEquals(w.wax, exp)
+        self.assertEquals(str(w.wax), str(exp))
+        self.assertEquals(w.wax._fingerprint(True, True),
+            exp._fingerprint(True, True))
+
+    def test_incremental(self):
+        w = WaxWatcher(self.path, debounce=0)
+        self._check(w, SAMPLE)
+        seen = []
+        w.add_listener(lambda wax, patch: seen.append((wax, patch)))
+
+        old = w.wax
+        data = SAMPLE.replace('port = 8080', 'port = 9090\nbacklog = 5')
+        self._write(data)
+        patch = w.poll()
+        self._check(w, data)
+        self.assertEquals(patch.paths(),
+            ['server.port', 'server.backlog', 'server'])
+        self.assertEquals(seen, [(w.wax, patch)])
+        self.assertEquals(old.server.port, 8080)
+        # unchanged groups are shared by both snapshots
+        self.assert_(w.wax.logger is old.logger)
+        self.assert_(w.wax.server is not old.server)
+
+        # edit a group which also holds groups declared before and after it
+        data = data.replace('"ALL"', '"INFO"\n# quieter')
+        self._write(data)
+        w.poll()
+        self._check(w, data)
+        self.assert_(w.wax.logger.file is old.logger.file)
+
+        # nothing to report when the contents are the same
+        self._write(data)
+        self.assertEquals(w.poll(), None)
+        self.assertEquals(len(seen), 2)
+
+    def test_full_reload(self):
+        w = WaxWatcher(self.path, debounce=0)
+        cases = [
+            # new section
+            SAMPLE + '[extra]\nkey = 1\n',
+            # renamed section
+            SAMPLE.replace('[server]', '[service]'),
+            # annotation of the following group
+            SAMPLE.replace('; the listening', '; a listening'),
+            # dotted key setting another group's key
+            SAMPLE.replace('port = 8080', 'port = 8080\nlimits.max = 3'),
+            # first key of a section which had none
+            SAMPLE.replace('[logger.console]',
+                '[logger.console]\nfirst = 1'),
+            # annotation of the following group after a value
+            SAMPLE.replace('# trailing server comment',
+                'backlog = 5 ; console output'),
+            # group declared in the middle of a line
+            SAMPLE.replace('port = 8080', 'port = 8080 [extra]\nkey = 1'),
+            ]
+        for data in cases:
+            self._write(data)
+            self.assertNotEquals(w.poll(), None)
+            self._check(w, data)
+            self._write(SAMPLE)
+            w.poll()
+            self._check(w, SAMPLE)
+
+    def test_debounce(self):
+        w = WaxWatcher(self.path, debounce=0.5)
+        self._write(SAMPLE.replace('8080', '1'))
+        self.assertEquals(w.poll(now=10.0), None)
+        self.assertEquals(w.poll(now=10.2), None)
+        # changed again before settling, so the wait starts over
+        self._write(SAMPLE.replace('8080', '2'))
+        self.assertEquals(w.poll(now=10.6), None)
+        self.assertEquals(w.wax.server.port, 8080)
+        self.assertNotEquals(w.poll(now=11.1), None)
+        self.assertEquals(w.wax.server.port, 2)
+
+    def test_error(self):
+        w = WaxWatcher(self.path, debounce=0)
+        old = w.wax
+        self._write(SAMPLE.replace('port = 8080', 'port = '))
+        self.assertRaises(WaxError, w.poll)
+        self.assert_(w.wax is old)
+        self.assert_(isinstance(w.error, WaxError))
+        self.assertEquals(w.poll(), None)
+        self._write(SAMPLE.replace('8080', '1'))
+        w.poll()
+        self.assertEquals(w.wax.server.port, 1)
+        self.assertEquals(w.error, None)
+
+    def test_thread(self):
+        w = WaxWatcher(self.path, interval=0.01, debounce=0)
+        done = threading.Event()
+        w.add_listener(lambda wax, patch: done.set())
+        w.start()
+        try:
+            self._write(SAMPLE.replace('8080', '1'))
+            done.wait(5)
+        finally:
+            w.stop()
+        self.assert_(done.isSet())
+        self.assertEquals(w.wax.server.port, 1)
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == "__main__":
+    main()